@@ -0,0 +1,45 @@
+""" Benchmark of between-channel PAC direction and delta calculation in KahData, on synthetic data.
+
+Usage: python bench_kah_data.py [number of stmc rows]
+"""
+
+import sys
+import time
+import numpy as np
+from kah_data import KahData
+from kah_synthetic import make_datasets
+from kah_legacy import LegacyKahData
+
+def time_steps(cls, datasets):
+    """ Time _set_betweenpac() and _calculate_deltas() on fresh copies of the data sets. Returns seconds and the object. """
+
+    # Build the object directly, skipping loading and filtering.
+    data = cls.__new__(cls)
+    data.stsc = datasets['stsc'].copy()
+    data.stmc = datasets['stmc'].copy()
+
+    start = time.perf_counter()
+    data._set_betweenpac()
+    data._calculate_deltas()
+
+    return time.perf_counter() - start, data
+
+if __name__ == "__main__":
+    nrow = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    # Choose the number of channels so that there are about nrow channel pairs x trials over 10 subjects.
+    nsubj, ntrial = 10, 100
+    nchan = int(np.ceil((1 + np.sqrt(1 + 8 * nrow / (nsubj * ntrial))) / 2))
+    datasets = make_datasets(nsubj=nsubj, nchan=nchan, ntrial=ntrial)
+    print('stmc rows: {}'.format(len(datasets['stmc'])))
+
+    time_legacy, legacy = time_steps(LegacyKahData, datasets)
+    time_new, new = time_steps(KahData, datasets)
+    print('row-by-row: {:.2f} s'.format(time_legacy))
+    print('vectorized: {:.2f} s ({:.0f}x faster)'.format(time_new, time_legacy / time_new))
+
+    # Memory used by the direction labels.
+    dircols = ['{}rawpacdir'.format(timewin) for timewin in ['pre', 'early', 'late']]
+    mem_legacy = legacy.stmc[dircols].memory_usage(deep=True, index=False).sum() / 2**20
+    mem_new = new.stmc[dircols].memory_usage(deep=True, index=False).sum() / 2**20
+    print('direction labels: {:.1f} MB row-by-row, {:.1f} MB categorical'.format(mem_legacy, mem_new))
@@ -0,0 +1,125 @@
+""" Closed-form fitting of the aperiodic (background) component of power spectra, for many spectra at once.
+
+In 'fixed' mode, FOOOF models log10 power as offset - exponent * log10(freq). With peak_threshold=np.inf no peaks are
+fit, so FOOOF's final background parameters are a least-squares fit of this line to the whole spectrum, which has a
+closed-form solution. FOOOF's robust initial fit, which refits only the points below a first fit, is also available.
+"""
+
+import numpy as np
+
+try:
+    from fooof import FOOOF
+    HAVE_FOOOF = True
+except ImportError:
+    HAVE_FOOOF = False
+
+# Percentile of the flattened spectrum used by FOOOF's robust background fit.
+PERCENTILE_THRESH = 0.025
+
+def _line_fit(logfreq, logpower, weights):
+    """ Weighted least-squares fit of logpower = offset - exponent * logfreq along the last axis. """
+
+    wsum = weights.sum(axis=-1)
+    xmean = (weights * logfreq).sum(axis=-1) / wsum
+    ymean = (weights * logpower).sum(axis=-1) / wsum
+    xdev = logfreq - xmean[..., None]
+    exponent = -(weights * xdev * (logpower - ymean[..., None])).sum(axis=-1) / (weights * xdev ** 2).sum(axis=-1)
+
+    return ymean + exponent * xmean, exponent
+
+def fit_aperiodic(freq, psds, freq_range=(2, 150), axis=1, robust=False):
+    """ Fit offset and exponent of the aperiodic component of many power spectra.
+
+    Parameters
+    ----------
+    freq : 1D array
+        Frequency of each PSD value.
+    psds : array
+        Power spectra, not log-transformed, with frequencies along axis. For example, 'channels x frequencies x trials'.
+    freq_range : list of two floats, optional
+        Frequency range to fit, inclusive. default: (2, 150)
+    axis : int, optional
+        Axis of psds with frequencies. default: 1
+    robust : boolean, optional
+        Return FOOOF's robust fit, which refits points at or below an initial fit, instead of the fit to the whole
+        spectrum that FOOOF returns when no peaks are fit. default: False
+
+    Returns
+    -------
+    offset : array
+        Offset of each spectrum (FOOOF background_params_[0]), with the frequency axis removed. NaN if the fit failed.
+    exponent : array
+        Exponent of each spectrum (FOOOF background_params_[1]). NaN if the fit failed.
+    ok : boolean array
+        Whether each fit succeeded. Fits fail if any power in the frequency range is not positive and finite, as FOOOF
+        fails on these spectra.
+    """
+
+    # Select the frequency range, and put frequencies last.
+    infreq = (freq >= freq_range[0]) & (freq <= freq_range[1])
+    logfreq = np.log10(freq[infreq])
+    power = np.moveaxis(np.asarray(psds), axis, -1)[..., infreq]
+    ok = np.all(np.isfinite(power) & (power > 0), axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logpower = np.where(ok[..., None], np.log10(np.where(power > 0, power, 1)), 0.)
+        offset, exponent = _line_fit(logfreq, logpower, np.ones(logpower.shape))
+
+        if robust:
+            # Flatten the spectrum by the initial fit, and refit the points at or below a low percentile of the residual.
+            flatspec = logpower - (offset[..., None] - exponent[..., None] * logfreq)
+            flatspec[flatspec < 0] = 0
+            thresh = np.percentile(flatspec, PERCENTILE_THRESH, axis=-1)
+            offset, exponent = _line_fit(logfreq, logpower, (flatspec <= thresh[..., None]).astype(float))
+
+    return np.where(ok, offset, np.nan), np.where(ok, exponent, np.nan), ok
+
+def validate(freq, psds, settings, freq_range=(2, 150), nspectra=200, seed=0):
+    """ Compare fit_aperiodic() with FOOOF on a random sample of spectra.
+
+    Parameters
+    ----------
+    freq : 1D array
+        Frequency of each PSD value.
+    psds : 'channels x frequencies x trials' array
+        Power spectra, not log-transformed.
+    settings : dict
+        Inputs to FOOOF(), as used for the fits being replaced (e.g. FOOOF_SETTINGS in kah_run_fooof_trials).
+    freq_range : list of two floats, optional
+        Frequency range to fit, inclusive. default: (2, 150)
+    nspectra : int, optional
+        Number of spectra to compare. default: 200
+    seed : int, optional
+        Random state seed for picking spectra. default: 0
+
+    Returns
+    -------
+    maxdiff : dict
+        Largest absolute difference from FOOOF in 'offset' and 'exponent', and the number of spectra where only one of
+        the two fits failed, in 'status'.
+    """
+
+    if not HAVE_FOOOF:
+        raise ImportError('fooof is required to validate aperiodic fits.')
+
+    rng = np.random.RandomState(seed)
+    chans = rng.randint(0, psds.shape[0], nspectra)
+    trials = rng.randint(0, psds.shape[2], nspectra)
+
+    offset, exponent, ok = fit_aperiodic(freq, psds[chans, :, trials], freq_range, axis=-1)
+
+    foof_model = FOOOF(**settings)
+    maxdiff = {'offset':0., 'exponent':0., 'status':0}
+    for ispec, (ichan, itrial) in enumerate(zip(chans, trials)):
+        try:
+            foof_model.fit(freq, psds[ichan, :, itrial], list(freq_range))
+        except Exception:
+            maxdiff['status'] += int(ok[ispec])
+            continue
+        if not ok[ispec]:
+            maxdiff['status'] += 1
+            continue
+        maxdiff['offset'] = max(maxdiff['offset'], abs(foof_model.background_params_[0] - offset[ispec]))
+        maxdiff['exponent'] = max(maxdiff['exponent'], abs(foof_model.background_params_[1] - exponent[ispec]))
+
+    return maxdiff
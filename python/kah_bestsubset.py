@@ -0,0 +1,218 @@
+""" Exhaustive best-subset search over predictors for classifying Kahana data.
+
+Each non-empty subset of predictors is encoded as a bitmask, with bit i set if predictors[i] is in the subset. AUCs of
+every subject, subset, and seed are stored in a memory-mapped array indexed by bitmask, along with a record of which
+subsets are done, so an interrupted search resumes from the store.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+import numpy as np
+from kah_classifier import KahClassifier, SplitCache
+
+# Files in each store.
+META = 'meta.json'
+AUC = 'auc.npy'
+DONE = 'done.npy'
+
+# Per-process state for parallel classification, set once per worker.
+_WORKER = {}
+
+def mask_predictors(mask, predictors):
+    """ Get the predictors in a subset, in the order of predictors. """
+
+    return [pred for ipred, pred in enumerate(predictors) if mask >> ipred & 1]
+
+def popcount(masks):
+    """ Get the number of predictors in each subset. """
+
+    masks = np.asarray(masks)
+    return np.array([bin(mask).count('1') for mask in masks.ravel()]).reshape(masks.shape)
+
+class SubsetStore:
+    """ Array-backed store of AUCs for every subject, predictor subset, and seed.
+
+    Parameters
+    ----------
+    storedir : string
+        Directory of the store. Created if it does not exist.
+    subjects : list of strings, optional
+        Subjects in the store. Required when creating a store, and must match when opening one.
+    predictors : list of tuples, optional
+        Predictors that subsets are drawn from. Required when creating a store, and must match when opening one.
+    nseed : int, optional
+        Number of seeds per subset. Required when creating a store, and must match when opening one.
+
+    Attributes
+    ----------
+    auc : nsubj x 2**npred x nseed memory-mapped array
+        AUC of each subject, subset, and seed. Row 0 (the empty subset) is unused.
+    done : nsubj x 2**npred memory-mapped array
+        Whether each subject and subset has been classified.
+    """
+
+    def __init__(self, storedir, subjects=None, predictors=None, nseed=None):
+        """ Open a store, creating it if it does not exist. """
+
+        self.storedir = storedir
+        metafile = os.path.join(storedir, META)
+        if predictors is not None:
+            predictors = [tuple(pred) for pred in predictors]
+
+        if os.path.isfile(metafile):
+            with open(metafile) as file:
+                meta = json.load(file)
+            meta['predictors'] = [tuple(pred) for pred in meta['predictors']]
+            for key, value in [('subjects', subjects), ('predictors', predictors), ('nseed', nseed)]:
+                if value is not None and value != meta[key]:
+                    raise ValueError('Store {} has different {} than requested.'.format(storedir, key))
+        else:
+            if subjects is None or predictors is None or nseed is None:
+                raise ValueError('subjects, predictors, and nseed are required to create a store.')
+            os.makedirs(storedir, exist_ok=True)
+            meta = {'subjects':list(subjects), 'predictors':predictors, 'nseed':nseed}
+            shape = (len(meta['subjects']), 2 ** len(meta['predictors']))
+            np.lib.format.open_memmap(os.path.join(storedir, AUC), mode='w+', dtype=np.float32, shape=shape + (nseed,))[:] = np.nan
+            np.lib.format.open_memmap(os.path.join(storedir, DONE), mode='w+', dtype=bool, shape=shape)
+
+            # Write metadata last, so a store is only opened once its arrays exist.
+            with open(metafile + '.tmp', 'w') as file:
+                json.dump(meta, file, indent=1)
+            os.replace(metafile + '.tmp', metafile)
+
+        self.subjects = meta['subjects']
+        self.predictors = meta['predictors']
+        self.nseed = meta['nseed']
+        self.auc = np.load(os.path.join(storedir, AUC), mmap_mode='r+')
+        self.done = np.load(os.path.join(storedir, DONE), mmap_mode='r+')
+
+    def add(self, isubj, masks, auc):
+        """ Record AUCs of one subject for some subsets. AUCs are flushed to disk before subsets are marked done. """
+
+        self.auc[isubj, masks] = auc
+        self.auc.flush()
+        self.done[isubj, masks] = True
+        self.done.flush()
+
+    def todo(self, isubj):
+        """ Get bitmasks of subsets not yet classified for a subject. """
+
+        return np.flatnonzero(~self.done[isubj, 1:]) + 1
+
+    def scores(self):
+        """ Get the median AUC across subjects of the median AUC across seeds, per subset. NaN for subsets not done. """
+
+        score = np.median(np.median(self.auc, axis=2), axis=0)
+        score[~np.all(self.done, axis=0)] = np.nan
+
+        return score
+
+    def top_subsets(self, size, k=10):
+        """ Get the k subsets of a given size with the highest score.
+
+        Returns
+        -------
+        subsets : list of tuples
+            (predictors, score) of each subset, from highest to lowest score.
+        """
+
+        score = self.scores()
+        masks = np.flatnonzero((popcount(np.arange(len(score))) == size) & ~np.isnan(score))
+        masks = masks[np.argsort(-score[masks], kind='stable')[:k]]
+
+        return [(mask_predictors(mask, self.predictors), float(score[mask])) for mask in masks]
+
+def _init_worker(subjects, seeds, predictors):
+    """ Give a worker the subjects' predictor matrices once, instead of sending them with every task. """
+
+    _WORKER['subjects'] = subjects
+    _WORKER['seeds'] = seeds
+    _WORKER['predictors'] = predictors
+    _WORKER['splits'] = {}
+
+def _classify_masks(isubj, masks, method):
+    """ Classify one subject with several subsets for all seeds. Returns AUCs and time spent per stage. """
+
+    # Split and scale each subject once per worker, shared by all subsets.
+    if isubj not in _WORKER['splits']:
+        _WORKER['splits'][isubj] = SplitCache(_WORKER['subjects'][isubj], _WORKER['seeds'])
+
+    clf = KahClassifier()
+    auc = np.empty([len(masks), len(_WORKER['seeds'])])
+    for imask, mask in enumerate(masks):
+        clf.predictors = mask_predictors(mask, _WORKER['predictors'])
+        auc[imask], _ = clf.classify_seeds(_WORKER['splits'][isubj], _WORKER['seeds'], method=method)
+
+    return auc, clf.timings_
+
+def best_subset(subjects, predictors, nseed, storedir, n_jobs=1, method='logistic_numpy', chunksize=256):
+    """ Classify every non-empty subset of predictors, recording AUCs in a store.
+
+    Parameters
+    ----------
+    subjects : list of PredictorMatrix() objects
+        Subjects to classify.
+    predictors : list of tuples
+        Predictors to draw subsets from. Each tuple is ('measure', 'region').
+    nseed : int
+        Number of random seeds to classify each subset with.
+    storedir : string
+        Directory of the store. Subsets already in the store are not refit.
+    n_jobs : int, optional
+        Number of processes to fit subsets over. default: 1
+    method : string, optional
+        The type of classifier to use, as in KahClassifier.classify(). default: 'logistic_numpy'
+    chunksize : int, optional
+        Number of subsets per task. default: 256
+
+    Returns
+    -------
+    store : SubsetStore() object
+        Store with AUCs of all subsets, for querying with top_subsets().
+    """
+
+    store = SubsetStore(storedir, [subject.subject for subject in subjects], predictors, nseed)
+    seeds = list(range(nseed))
+
+    # Split the subsets not yet done into chunks, per subject.
+    chunks = []
+    for isubj in range(len(subjects)):
+        todo = store.todo(isubj)
+        chunks.extend((isubj, todo[start:start + chunksize]) for start in range(0, len(todo), chunksize))
+
+    print('{} subsets of {} subjects left, in {} chunks.'.format(sum(len(masks) for _, masks in chunks), len(subjects), len(chunks)))
+
+    # Classify in this process, or over a pool of processes that is shut down even if a chunk fails.
+    if n_jobs == 1:
+        _init_worker(subjects, seeds, store.predictors)
+        pool = nullcontext()
+    else:
+        pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(subjects, seeds, store.predictors))
+
+    with pool as executor:
+        if executor is None:
+            results = (((isubj, masks), _classify_masks(isubj, masks, method)) for isubj, masks in chunks)
+        else:
+            futures = {executor.submit(_classify_masks, isubj, masks, method):(isubj, masks) for isubj, masks in chunks}
+            results = ((futures[future], future.result()) for future in as_completed(futures))
+
+        # Record each chunk as soon as it is fit.
+        timings = {}
+        start = time.perf_counter()
+        for ichunk, ((isubj, masks), (auc, timings_chunk)) in enumerate(results):
+            store.add(isubj, masks, auc)
+            for stage in timings_chunk:
+                timings[stage] = timings.get(stage, 0.) + timings_chunk[stage]
+
+            elapsed = time.perf_counter() - start
+            print('{}/{} chunks, {:.0f} s elapsed, {:.0f} s left'.format(ichunk + 1, len(chunks), elapsed, elapsed / (ichunk + 1) * (len(chunks) - ichunk - 1)))
+
+    # Report time spent per stage of classification, summed over processes.
+    clf = KahClassifier()
+    clf.timings_ = timings
+    clf.report_timings()
+
+    return store
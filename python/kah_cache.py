@@ -0,0 +1,303 @@
+""" Columnar cache of the Kahana feature CSVs, partitioned by subject.
+
+Each data set is stored as Parquet files in a directory per subject, along with a manifest describing the source CSV.
+Reading from the cache only touches the columns and subjects requested, and the cache is rebuilt whenever its source
+CSV changes.
+
+A data set can also be combined from several CSVs, such as one per subject. Each CSV is streamed in chunks into the
+partitions of its subjects, with every CSV held to the columns and data types of the data set, and only CSVs that
+changed since the last combine are reconverted.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+
+try:
+    import pyarrow
+    HAVE_PARQUET = True
+except ImportError:
+    HAVE_PARQUET = False
+
+# Name of the file describing each cached data set.
+MANIFEST = 'manifest.json'
+
+# Version of the cache layout. Caches written with another version are rebuilt.
+CACHE_VERSION = 2
+
+# Number of CSV rows to convert at a time.
+CHUNKSIZE = 500000
+
+def file_hash(path, blocksize=2**20):
+    """ Get the SHA-1 hash of a file's contents. """
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(blocksize), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+def read_manifest(cachedir):
+    """ Get the manifest of a cached data set, or None if there is no cache. """
+
+    try:
+        with open(os.path.join(cachedir, MANIFEST)) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+
+    return manifest
+
+def _write_manifest(cachedir, manifest):
+    """ Write the manifest of a cached data set, replacing any previous one atomically. """
+
+    tmpfile = os.path.join(cachedir, MANIFEST + '.tmp')
+    with open(tmpfile, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmpfile, os.path.join(cachedir, MANIFEST))
+
+def _is_unchanged(csvfile, source):
+    """ Check whether a CSV has the contents recorded in a manifest entry, updating the entry's modification time if the
+    file was only touched.
+    """
+
+    stat = os.stat(csvfile)
+    if stat.st_size != source['size']:
+        return False
+    if stat.st_mtime_ns == source['mtime_ns']:
+        return True
+
+    # File was touched. Keep the cache if the contents are the same.
+    if file_hash(csvfile) != source['sha1']:
+        return False
+    source['mtime_ns'] = stat.st_mtime_ns
+
+    return True
+
+def is_current(csvfile, cachedir):
+    """ Check whether a cached data set was converted from the current contents of its CSV.
+
+    Notes
+    -----
+    The modification time and size of the CSV are checked first. If only the modification time changed, the CSV is
+    hashed and the cache is kept if its contents are unchanged.
+    """
+
+    manifest = read_manifest(cachedir)
+    if manifest is None or 'sources' in manifest:
+        return False
+
+    mtime_ns = manifest['mtime_ns']
+    if not _is_unchanged(csvfile, manifest):
+        return False
+    if manifest['mtime_ns'] != mtime_ns:
+        _write_manifest(cachedir, manifest)
+
+    return True
+
+def convert_csv(csvfile, cachedir, dtype=None, chunksize=CHUNKSIZE):
+    """ Convert a CSV to Parquet files partitioned by subject.
+
+    Parameters
+    ----------
+    csvfile : string
+        Path to CSV to convert. Must have a 'subject' column.
+    cachedir : string
+        Directory to write the cached data set to. Any previous cache in this directory is replaced.
+    dtype : dict, optional
+        Data type of each column. default: None (inferred by Pandas)
+    chunksize : int, optional
+        Number of rows to read from the CSV at a time. default: 500000
+
+    Notes
+    -----
+    Rows from each chunk are written to a separate file per subject, so rows keep their order in the CSV.
+    """
+
+    if not HAVE_PARQUET:
+        raise ImportError('pyarrow is required for caching data sets.')
+
+    # Hash and stat the source before reading, so that edits made during conversion invalidate the cache.
+    stat = os.stat(csvfile)
+    sha1 = file_hash(csvfile)
+
+    # Build the new cache next to the old one, then swap it in.
+    tmpdir = cachedir.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    subjects = []
+    columns = None
+    for ichunk, chunk in enumerate(pd.read_csv(csvfile, dtype=dtype, chunksize=chunksize)):
+        columns = list(chunk.columns)
+        dtypes = {column:str(chunk[column].dtype) for column in chunk.columns}
+        for subject, rows in chunk.groupby('subject', sort=False):
+            if subject not in subjects:
+                subjects.append(subject)
+                os.makedirs(os.path.join(tmpdir, subject))
+            rows.to_parquet(os.path.join(tmpdir, subject, 'part-{:05d}.parquet'.format(ichunk)), index=False)
+
+    # Keep the schema of a CSV with no rows, so reads still return its columns.
+    if columns is None:
+        header = pd.read_csv(csvfile, dtype=dtype, nrows=0)
+        columns = list(header.columns)
+        dtypes = {column:str(header[column].dtype) for column in header.columns}
+
+    manifest = {'version':CACHE_VERSION, 'source':os.path.abspath(csvfile), 'mtime_ns':stat.st_mtime_ns, 'size':stat.st_size,
+                'sha1':sha1, 'columns':columns, 'dtypes':dtypes, 'subjects':subjects}
+    _write_manifest(tmpdir, manifest)
+
+    shutil.rmtree(cachedir, ignore_errors=True)
+    os.replace(tmpdir, cachedir)
+
+def combine_csvs(csvfiles, cachedir, dtype=None, chunksize=CHUNKSIZE):
+    """ Combine several CSVs into one data set partitioned by subject, converting only CSVs that changed.
+
+    Parameters
+    ----------
+    csvfiles : list of strings
+        Paths to CSVs to combine, such as one per subject. Each must have a 'subject' column, and no two can have rows
+        of the same subject. CSVs combined before but not in this list are removed from the data set.
+    cachedir : string
+        Directory of the combined data set. A data set in this directory that was not combined from CSVs is replaced.
+    dtype : dict, optional
+        Data type of each column. default: None (the types Pandas infers for the first CSV)
+    chunksize : int, optional
+        Number of rows to read from each CSV at a time. default: 500000
+
+    Returns
+    -------
+    nconverted : int
+        Number of CSVs converted. Zero if the data set was already up to date.
+
+    Notes
+    -----
+    The first CSV combined sets the columns and data types of the data set. Every later CSV must have the same columns,
+    in any order, and is cast to the same data types. Each subject's partition is built next to the old one and swapped
+    in, and the manifest is updated after each CSV, so an interrupted combine resumes with the CSV it stopped on.
+    """
+
+    if not HAVE_PARQUET:
+        raise ImportError('pyarrow is required for caching data sets.')
+
+    manifest = read_manifest(cachedir)
+    if manifest is None or 'sources' not in manifest:
+        shutil.rmtree(cachedir, ignore_errors=True)
+        os.makedirs(cachedir)
+        manifest = {'version':CACHE_VERSION, 'sources':{}, 'columns':None, 'dtypes':None, 'subjects':[]}
+
+    # Drop subjects of CSVs no longer in the data set.
+    csvfiles = [os.path.abspath(csvfile) for csvfile in csvfiles]
+    for source in [source for source in manifest['sources'] if source not in csvfiles]:
+        for subject in manifest['sources'].pop(source)['subjects']:
+            shutil.rmtree(os.path.join(cachedir, subject), ignore_errors=True)
+            manifest['subjects'].remove(subject)
+        _write_manifest(cachedir, manifest)
+
+    nconverted = 0
+    for csvfile in csvfiles:
+        source = manifest['sources'].get(csvfile)
+        if source is not None and _is_unchanged(csvfile, source):
+            continue
+
+        # Hash and stat the source before reading, so that edits made during conversion invalidate it.
+        stat = os.stat(csvfile)
+        sha1 = file_hash(csvfile)
+
+        # Write this CSV's partitions next to the current ones, holding every chunk to the data set's schema.
+        subjects = []
+        reader = pd.read_csv(csvfile, dtype=dtype if dtype is not None else manifest['dtypes'], chunksize=chunksize)
+        for ichunk, chunk in enumerate(reader):
+            if manifest['columns'] is None:
+                manifest['columns'] = list(chunk.columns)
+                manifest['dtypes'] = {column:str(chunk[column].dtype) for column in chunk.columns}
+            if sorted(chunk.columns) != sorted(manifest['columns']):
+                raise ValueError('Columns of {} do not match the data set in {}.'.format(csvfile, cachedir))
+            chunk = chunk[manifest['columns']].astype(manifest['dtypes'])
+
+            for subject, rows in chunk.groupby('subject', sort=False):
+                if subject not in subjects:
+                    owner = [other for other in manifest['sources'] if other != csvfile and subject in manifest['sources'][other]['subjects']]
+                    if owner:
+                        raise ValueError('Subject {} of {} is already in the data set from {}.'.format(subject, csvfile, owner[0]))
+                    subjects.append(subject)
+                    shutil.rmtree(os.path.join(cachedir, subject + '.tmp'), ignore_errors=True)
+                    os.makedirs(os.path.join(cachedir, subject + '.tmp'))
+                rows.to_parquet(os.path.join(cachedir, subject + '.tmp', 'part-{:05d}.parquet'.format(ichunk)), index=False)
+
+        # Swap in the new partitions, removing subjects that are no longer in this CSV.
+        previous = source['subjects'] if source is not None else []
+        for subject in previous:
+            shutil.rmtree(os.path.join(cachedir, subject), ignore_errors=True)
+            if subject not in subjects:
+                manifest['subjects'].remove(subject)
+        for subject in subjects:
+            shutil.rmtree(os.path.join(cachedir, subject), ignore_errors=True)
+            os.replace(os.path.join(cachedir, subject + '.tmp'), os.path.join(cachedir, subject))
+            if subject not in manifest['subjects']:
+                manifest['subjects'].append(subject)
+
+        manifest['sources'][csvfile] = {'mtime_ns':stat.st_mtime_ns, 'size':stat.st_size, 'sha1':sha1, 'subjects':subjects}
+        _write_manifest(cachedir, manifest)
+        nconverted += 1
+
+    # Record touched but unchanged sources.
+    _write_manifest(cachedir, manifest)
+
+    return nconverted
+
+def read_partitions(cachedir, subjects=None, columns=None):
+    """ Read cached data for some subjects and columns.
+
+    Parameters
+    ----------
+    cachedir : string
+        Directory of the cached data set.
+    subjects : list of strings, optional
+        Subjects to read, in order. Subjects that are not in the data set are skipped. default: None (all subjects)
+    columns : list of strings, optional
+        Columns to read. default: None (all columns)
+
+    Returns
+    -------
+    data : Pandas Dataframe
+        Rows for the requested subjects, in their order in the source CSV.
+    """
+
+    manifest = read_manifest(cachedir)
+    if manifest is None:
+        raise FileNotFoundError('No cached data set in {}.'.format(cachedir))
+
+    if subjects is None:
+        subjects = manifest['subjects']
+
+    # Keep columns in the order of the source CSV.
+    if columns is not None:
+        columns = [column for column in (manifest['columns'] or []) if column in columns]
+
+    files = []
+    for subject in subjects:
+        if subject in manifest['subjects']:
+            subjdir = os.path.join(cachedir, subject)
+            files.extend(os.path.join(subjdir, file) for file in sorted(os.listdir(subjdir)))
+
+    # Keep column names and types if no subject matched, or the data set has no rows.
+    if not files:
+        columns = (manifest['columns'] or []) if columns is None else columns
+        return pd.DataFrame({column:pd.Series(dtype=manifest['dtypes'][column]) for column in columns})
+
+    return pd.concat([pd.read_parquet(file, columns=columns) for file in files], ignore_index=True)
+
+if __name__ == "__main__":
+    # Convert all data sets, if they have changed since last conversion.
+    from kah_data import KahData
+
+    for dataset in KahData.paths:
+        print(dataset)
+        KahData.convert(dataset)
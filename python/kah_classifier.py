@@ -1,14 +1,16 @@
 """ Class for applying classification techniques to Kahana data """
 
+import time
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, StratifiedKFold
 from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
 from sklearn.linear_model import LogisticRegressionCV
 from sklearn.model_selection import GridSearchCV
 from sklearn.metrics import roc_auc_score
-from sklearn import utils
+from scipy import stats
 
 PREDICTORS_ALL =  [
                     ('preslope', 'T'), 
@@ -27,6 +29,217 @@ PREDICTORS_ALL =  [
                     ('normtspacmax', 'FT'), 
                 ]
 
+def resample_indices(ntrial, nresample, resample):
+    """ Get indices of trials for each resample of a set of trials.
+
+    Parameters
+    ----------
+    ntrial : int
+        Number of trials to resample.
+    nresample : int
+        Number of resamples.
+    resample : string
+        'bootstrap' to draw trials with replacement, or 'permute' to shuffle trials.
+
+    Returns
+    -------
+    indices : nresample x ntrial array
+        Trial indices for each resample. Resample i matches sklearn.utils.resample() or sklearn.utils.shuffle() with random_state=i.
+    """
+
+    if resample == 'bootstrap':
+        draw = lambda random_state: random_state.randint(0, ntrial, size=ntrial)
+    elif resample == 'permute':
+        draw = lambda random_state: random_state.permutation(ntrial)
+    else:
+        raise ValueError('Resampling method not supported.')
+
+    indices = np.empty([nresample, ntrial], dtype=np.intp)
+    for iresample in range(nresample):
+        indices[iresample] = draw(np.random.RandomState(iresample))
+
+    return indices
+
+def rank_auc(scores, labels):
+    """ Area under the ROC curve computed from ranks, for many sets of scores and labels at once.
+
+    Parameters
+    ----------
+    scores : array
+        Scores for each trial, in the last dimension. Broadcast against labels.
+    labels : array
+        Binary labels for each trial, in the last dimension.
+
+    Returns
+    -------
+    auc : array
+        AUC for each set of trials. NaN if only one class is present.
+
+    Notes
+    -----
+    AUC equals the Mann-Whitney U statistic divided by npos * nneg. Tied scores get their average rank, which gives the
+    same result as sklearn.metrics.roc_auc_score().
+    """
+
+    # Rank scores before broadcasting, so that shared scores are only ranked once.
+    ranks, labels = np.broadcast_arrays(stats.rankdata(scores, axis=-1), np.asarray(labels, dtype=bool))
+
+    npos = labels.sum(axis=-1)
+    nneg = labels.shape[-1] - npos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc = (np.sum(ranks * labels, axis=-1) - npos * (npos + 1) / 2) / (npos * nneg)
+
+    return np.where((npos > 0) & (nneg > 0), auc, np.nan)
+
+def stratified_folds(y, nfold):
+    """ Assign trials to folds as StratifiedKFold(nfold) without shuffling, which LogisticRegressionCV uses. y is (nset, ntrial). """
+
+    folds = np.empty(np.shape(y), dtype=np.intp)
+    for iset, yset in enumerate(y):
+        for ifold, (_, test) in enumerate(StratifiedKFold(nfold).split(np.zeros(len(yset)), yset)):
+            folds[iset, test] = ifold
+
+    return folds
+
+class PredictorMatrix:
+    """ All predictors and trial labels for one subject, aggregated once per trial and brain region.
+
+    Parameters
+    ----------
+    values : ntrial x (npred + 1) array
+        Predictor values in columns, followed by trial labels in the last column.
+    predictors : list of tuples
+        Predictor in each column of values. Each tuple is ('measure', 'region').
+    subject : string
+        Subject the data are from.
+
+    Attributes
+    ----------
+    labels : 1D array
+        Labels of remembered (1) vs. forgotten (0) for each trial. A view of the last column of values.
+
+    Notes
+    -----
+    Values are stored as float32 in column-major order, so each predictor is a contiguous column. Selecting a single
+    predictor or a run of neighbouring predictors returns a view without copying.
+    """
+
+    def __init__(self, values, predictors, subject):
+        """ Create a PredictorMatrix() object. """
+
+        self.values = values
+        self.predictors = [tuple(pred) for pred in predictors]
+        self.subject = subject
+        self.labels = self.values[:, -1]
+
+    @classmethod
+    def from_kahdata(cls, kahdata, predictors=PREDICTORS_ALL):
+        """ Aggregate predictors of interest from a KahData() object.
+
+        Only the measures of the predictors of interest are aggregated, with one groupby per data set. Predictors missing
+        from the data are all NaN.
+        """
+
+        # Aggregate measures of interest per trial per region.
+        stsc_measures = ['encoding'] + sorted(set(measure for measure, region in predictors if len(region) == 1 and measure in kahdata.stsc))
+        stmc_measures = sorted(set(measure for measure, region in predictors if len(region) > 1 and measure in kahdata.stmc))
+        stsc_ave = kahdata.stsc.groupby(['trial', 'lobe'])[stsc_measures].median().unstack()
+        stmc_ave = kahdata.stmc.groupby(['trial', 'direction'])[stmc_measures].median().unstack()
+
+        # Fill columns in one allocation, with labels in the last column.
+        values = np.full([stsc_ave.shape[0], len(predictors) + 1], np.nan, dtype=np.float32, order='F')
+        for ipred, (measure, region) in enumerate(predictors):
+            predave = stmc_ave if len(region) > 1 else stsc_ave
+            if (measure, region) in predave:
+                values[:, ipred] = predave[measure, region].reindex(stsc_ave.index)
+        values[:, -1] = stsc_ave['encoding', 'F']
+
+        return cls(values, predictors, kahdata.subject)
+
+    def select(self, predictors):
+        """ Get predictor values for some predictors, in the order given. """
+
+        if predictors == 'all':
+            predictors = self.predictors
+
+        missing = [tuple(pred) for pred in predictors if tuple(pred) not in self.predictors]
+        if missing:
+            raise KeyError('Predictors {} of {} were not aggregated. Pass them to kah_store.load_predictors() or '
+                           'PredictorMatrix.from_kahdata().'.format(missing, self.subject))
+        icols = [self.predictors.index(tuple(pred)) for pred in predictors]
+
+        # Evenly spaced columns can be sliced without copying.
+        step = icols[1] - icols[0] if len(icols) > 1 else 1
+        if step > 0 and icols == list(range(icols[0], icols[-1] + 1, step)):
+            return self.values[:, icols[0]:icols[-1] + 1:step]
+
+        return self.values[:, icols]
+
+class SplitCache:
+    """ Training and test splits, cross-validation folds, and standardized predictors of one subject, for many seeds.
+
+    The split for a seed depends only on the trial labels, and scaling is per predictor, so they are computed once for
+    all predictors and shared by every predictor subset. Classifying a subset then only slices precomputed arrays.
+
+    Parameters
+    ----------
+    matrix : PredictorMatrix() object
+        All predictors and trial labels for one subject.
+    seeds : list of ints
+        Random state seeds to split trials with.
+    test_size : float, optional
+        The proportion of data to be held out to test final model performance. default: 0.3
+    cv : int, optional
+        The number of folds to split each training set into. default: 5
+
+    Attributes
+    ----------
+    itrain, itest : nseed x ntrain, nseed x ntest arrays
+        Indices of training and test trials per seed, as given by train_test_split().
+    folds : nseed x ntrain array
+        Cross-validation fold of each training trial, as used by LogisticRegressionCV().
+    Xtrain, Xtest : nseed x ntrain x npred, nseed x ntest x npred arrays
+        All predictors, standardized using the mean and standard deviation of each seed's training set.
+    ytrain, ytest : nseed x ntrain, nseed x ntest arrays
+        Labels of training and test trials per seed.
+    """
+
+    def __init__(self, matrix, seeds, test_size=0.3, cv=5):
+        """ Split and scale all predictors for each seed. """
+
+        self.matrix = matrix
+        self.subject = matrix.subject
+        self.seeds = list(seeds)
+        self.test_size = test_size
+        self.cv = cv
+        self._iseed = {seed:iseed for iseed, seed in enumerate(self.seeds)}
+
+        # Split trial indices the same way train_test_split() splits predictors and labels.
+        labels = np.asarray(matrix.labels, dtype=float)
+        splits = [train_test_split(np.arange(len(labels)), test_size=test_size, shuffle=True, stratify=labels, random_state=seed) for seed in self.seeds]
+        self.itrain = np.array([split[0] for split in splits])
+        self.itest = np.array([split[1] for split in splits])
+        self.ytrain, self.ytest = labels[self.itrain], labels[self.itest]
+        self.folds = stratified_folds(self.ytrain, cv)
+
+        # Scale using the mean and variance of each training set, as StandardScaler() does.
+        predvals = np.asarray(matrix.values[:, :-1], dtype=float)
+        self.Xtrain, self.Xtest = predvals[self.itrain], predvals[self.itest]
+        mean = self.Xtrain.mean(axis=1, keepdims=True)
+        std = self.Xtrain.std(axis=1, keepdims=True)
+        std[std == 0] = 1
+        self.Xtrain = (self.Xtrain - mean) / std
+        self.Xtest = (self.Xtest - mean) / std
+
+    def split(self, seeds, predictors):
+        """ Get standardized training and test predictors, labels, and folds of some seeds and predictors. """
+
+        iseeds = [self._iseed[seed] for seed in seeds]
+        icols = [self.matrix.predictors.index(tuple(pred)) for pred in predictors]
+
+        return (self.Xtrain[np.ix_(iseeds, range(self.Xtrain.shape[1]), icols)], self.Xtest[np.ix_(iseeds, range(self.Xtest.shape[1]), icols)],
+                self.ytrain[iseeds], self.ytest[iseeds], self.folds[iseeds])
+
 class KahClassifier:
     """ Predict trial outcome (remembered vs. forgotten) using electrophysiological features before and during stimulus presentation. 
     
@@ -45,7 +258,7 @@ class KahClassifier:
 
     Attributes
     ----------
-    predvals : Pandas Dataframe
+    predvals : ntrial x npred array
         Features aggregated per trial and brain region. Used ultimately for classification.
     labels : 1D array
         Labels of remembered (1) vs. forgotten (0) for each trial. Used ultimately for classification.
@@ -55,8 +268,16 @@ class KahClassifier:
         Predicted probabilities of forgotten (column 0) vs remembered (column 1) for holdout data.
     roc_auc_ : float
         Area under the ROC curve for holdout data.
+    roc_auc_resample_ : 1D array
+        If resampling, area under the ROC curve for each resampled holdout set.
+    prob_resample_ : ntrial x 2 x nresample array
+        If resampling and keep_prob_resample is True, predicted probabilities for each resampled holdout set.
     estimator_ : classifier object
         Final best classifier fit to all data.
+    C_seeds_ : 1D array
+        Best C for each seed, from classify_seeds().
+    timings_ : dict
+        Total seconds spent in each stage of aggregation and classification, summed over all calls.
 
     """
 
@@ -69,25 +290,31 @@ class KahClassifier:
         self.cv = cv
         self.test_size = test_size
         self.seed = seed
+        self.timings_ = {}
     
-    def classify(self, kahdata, method, hyperparameters=None, resample=None, nresample=1000, need_aggregate=True):
+    def classify(self, kahdata, method, hyperparameters=None, resample=None, nresample=1000, need_aggregate=True, keep_prob_resample=False, fit_final=True):
         """ Predict trial outcome using classifier type of interest. 
         
         Parameters
         ----------
-        kahdata : KahData() object
-            Data from subject(s) to classify
+        kahdata : KahData(), PredictorMatrix(), or SplitCache() object
+            Data from subject(s) to classify. A SplitCache() must include self.seed.
         method : string
-            The type of classifier to use. Choices include 'logistic', 'SVM'
+            The type of classifier to use. Choices include 'logistic' (sklearn), 'logistic_numpy' (batched NumPy solver)
         hyperparameters : dict, optional
             Hyperparameters to try ({'C':[0.1, 1, 10, 100], 'kernel':['linear', 'rbf]}). 
-            Defaults determined by individual classifier functions.
+            Defaults determined by individual classifier functions. If only one value of C is given, it is used without cross-validation.
         resample : string, optional
             Method to resample test set. Options are 'bootstrap', 'permute', or None. default: None
         nresample : int, optional
             Number of resampling runs to do, ignored if no resampling. default: 1000
         need_aggregate : boolean, optional
             True if kahdata has not been aggregated into the final predictors, False otherwise. default: True
+        keep_prob_resample : boolean, optional
+            Save predicted probabilities for each resampled test set in prob_resample_. default: False
+        fit_final : boolean, optional
+            Also fit final_estimator_ to all data. Set to False if only holdout performance is needed, and call fit_final()
+            later if necessary. default: True
 
         """
 
@@ -101,66 +328,220 @@ class KahClassifier:
         # Split data into a training and test set.
         # The training set will be used for k-fold cross validation to pick optimal hyperparameters.
         # The test set will be used to evaluate performance of a full model fit over the training set using the best hyperparameter.
-        Xtrain, Xtest, ytrain, ytest = train_test_split(self.predvals, self.labels, test_size=self.test_size, shuffle=True, stratify=self.labels, random_state=self.seed)
-
-        # Scale features using the mean and variance of the training data.
-        Xtrain, Xtest, _ = self._standardscale_features(Xtrain, Xtest)
-
-        # Choose classification method.       
-        if method == 'logistic': # for logistic regression.
-            classify_method = self._logistic_regression
+        # If kahdata is a SplitCache() object, the split and scaled data are sliced from it.
+        if isinstance(kahdata, SplitCache):
+            with self._time_stage('split'):
+                Xtrain, Xtest, ytrain, ytest, _ = (data[0] for data in kahdata.split([self.seed], self.predictors))
         else:
-            raise ValueError('Classification method not supported.')
+            with self._time_stage('split'):
+                Xtrain, Xtest, ytrain, ytest = train_test_split(self.predvals, self.labels, test_size=self.test_size, shuffle=True, stratify=self.labels, random_state=self.seed)
+
+            # Scale features using the mean and variance of the training data.
+            with self._time_stage('scale'):
+                Xtrain, Xtest, _ = self._standardscale_features(Xtrain, Xtest)
 
         # Create classifier object.
-        clf = classify_method()
+        clf = self._get_classify_method(method)()
 
         # Fit a model on all of the training data. In the case of multiple C, perform k-fold cross-validation on the training set.
-        clf.fit(Xtrain, ytrain)
+        with self._time_stage('fit'):
+            clf.fit(Xtrain, ytrain)
 
-        # Get probability of class labels (forgotten in column 0, forgotten in column 1) for the test set.
-        self.prob_ = clf.predict_proba(Xtest)
+        with self._time_stage('evaluate'):
+            # Get probability of class labels (forgotten in column 0, forgotten in column 1) for the test set.
+            self.prob_ = clf.predict_proba(Xtest)
 
-        # Calculate AUC of ROC curve for the test set.
-        self.roc_auc_ = roc_auc_score(ytest, self.prob_[:, 1], average='weighted')
+            # Calculate AUC of ROC curve for the test set.
+            self.roc_auc_ = roc_auc_score(ytest, self.prob_[:, 1], average='weighted')
 
         # Calculate resampled AUC values, if necessary.
         if resample:
             # For saving output.
             self.resample = resample
-            self.prob_resample_ = np.empty([len(ytest), 2, nresample])
-            self.roc_auc_resample_ = np.empty([nresample])
 
-            for iresample in range(nresample):
+            with self._time_stage('resample'):
+                # Get indices of test trials for all resamples at once.
+                # Bootstrap both Xtest and ytest to get precision of AUC measurement, or permute ytest labels to get null distribution of AUC.
+                resample_idx = resample_indices(len(ytest), nresample, resample)
+
+                # Predictions are per trial, so resampled predictions are resampled rows of the test set predictions.
+                ytest_resample = np.asarray(ytest)[resample_idx]
                 if resample == 'bootstrap':
-                    # Bootstrap both Xtest and ytest to get precision of AUC measurement
-                    Xtest_resample, ytest_resample = utils.resample(Xtest, ytest, random_state=iresample)
-                elif resample == 'permute':
-                    # Permute ytest labels to get null distribution of AUC.
-                    Xtest_resample = Xtest
-                    ytest_resample = utils.shuffle(ytest, random_state=iresample)
+                    score_resample = self.prob_[resample_idx, 1]
                 else:
-                    raise ValueError('Resampling method not supported.')
-            
-                # Get probability of class labels (forgotten in column 0, forgotten in column 1) for the resampled test set.
-                prob_resample = clf.predict_proba(Xtest_resample)
-                self.prob_resample_[:, :, iresample] = prob_resample
+                    score_resample = self.prob_[:, 1]
+
+                # Calculate AUC of ROC curve for all resampled test sets.
+                self.roc_auc_resample_ = rank_auc(score_resample, ytest_resample)
 
-                # Calculate AUC of ROC curve for the resampled test set.
-                self.roc_auc_resample_[iresample] = roc_auc_score(ytest_resample, prob_resample[:, 1], average='weighted')
+                # Save probability of class labels (forgotten in column 0, forgotten in column 1) for each resampled test set.
+                if keep_prob_resample:
+                    if resample == 'bootstrap':
+                        prob_resample = self.prob_[resample_idx]
+                    else:
+                        prob_resample = np.broadcast_to(self.prob_, (nresample,) + self.prob_.shape)
+                    self.prob_resample_ = np.moveaxis(prob_resample, 0, -1).copy()
 
         # Save estimator used for performance assessment.
         self.roc_estimator_ = clf
 
+        # Find optimal hyperparameters for full data, if necessary.
+        if fit_final:
+            self.fit_final(kahdata, method, hyperparameters, need_aggregate=False)
+
+    def fit_final(self, kahdata, method, hyperparameters=None, need_aggregate=True):
+        """ Fit a model on all data, both training and test, re-scaled using all data.
+
+        Parameters
+        ----------
+        kahdata : KahData() or PredictorMatrix() object
+            Data from subject(s) to classify
+        method : string
+            The type of classifier to use. Choices include 'logistic' (sklearn), 'logistic_numpy' (batched NumPy solver)
+        hyperparameters : dict, optional
+            Hyperparameters to try, as in classify(). If only one value of C is given, the model is fit with it directly.
+        need_aggregate : boolean, optional
+            True if kahdata has not been aggregated into the final predictors, False otherwise. default: True
+
+        Returns
+        -------
+        final_estimator_ : classifier object
+            Final best classifier fit to all data.
+        """
+
+        # Save hyperparameter values.
+        self.hyperparameters = hyperparameters
+
+        # Get predictor values and trial labels, if necessary.
+        if need_aggregate:
+            self._set_predictors_labels(kahdata)
+
         # Re-initialize estimator to find optimal hyperparameters for full data. 
-        clf = classify_method()
+        clf = self._get_classify_method(method)()
 
-        # Fit a model on all data, both training and test, re-scaled using all data. 
-        clf.fit(StandardScaler().fit(self.predvals).transform(self.predvals), self.labels)
+        with self._time_stage('refit'):
+            clf.fit(StandardScaler().fit(self.predvals).transform(self.predvals), self.labels)
 
         # Save model for all data.
         self.final_estimator_ = clf
 
+        return clf
+
+    def classify_seeds(self, kahdata, seeds, hyperparameters=None, resample=None, nresample=1000, need_aggregate=True, method='logistic_numpy'):
+        """ Predict trial outcome for many random seeds at once.
+
+        Equivalent to calling classify() once per seed, without the final refit to all data. With method='logistic_numpy',
+        all seeds, cross-validation folds, and values of C are fit in one vectorized call.
+
+        Parameters
+        ----------
+        kahdata : KahData(), PredictorMatrix(), or SplitCache() object
+            Data from subject(s) to classify. Pass a SplitCache() to reuse splits and scaling across predictor subsets.
+        seeds : list of ints
+            Random state seeds, each giving a different split of training and test sets.
+        hyperparameters : dict, optional
+            Values of C to try ({'C':[0.1, 1, 10, 100]}), or the number of values on a log scale. default: {'C':10}
+        resample : string, optional
+            Method to resample test set. Options are 'bootstrap', 'permute', or None. default: None
+        nresample : int, optional
+            Number of resampling runs to do, ignored if no resampling. default: 1000
+        need_aggregate : boolean, optional
+            True if kahdata has not been aggregated into the final predictors, False otherwise. default: True
+        method : string, optional
+            The type of classifier to use. Other methods than 'logistic_numpy' call classify() per seed. default: 'logistic_numpy'
+
+        Returns
+        -------
+        roc_auc : 1D array
+            Area under the ROC curve for holdout data, per seed.
+        roc_auc_resample : nseed x nresample array
+            If resampling, area under the ROC curve for each resampled holdout set, per seed.
+        """
+
+        # Imported here, since kah_logistic uses rank_auc() from this module.
+        from kah_logistic import cv_logistic_l2
+
+        # Get predictor values and trial labels, if necessary.
+        if need_aggregate:
+            self._set_predictors_labels(kahdata)
+
+        # Classify one seed at a time, for methods without a batched solver.
+        if method != 'logistic_numpy':
+            roc_auc = np.empty([len(seeds)])
+            roc_auc_resample = np.empty([len(seeds), nresample]) if resample else None
+            for iseed, seed in enumerate(seeds):
+                self.seed = seed
+                self.classify(kahdata, method, hyperparameters=hyperparameters, resample=resample, nresample=nresample, need_aggregate=False, fit_final=False)
+                roc_auc[iseed] = self.roc_auc_
+                if resample:
+                    roc_auc_resample[iseed] = self.roc_auc_resample_
+
+            return roc_auc, roc_auc_resample
+
+        # Defaults for C values to test.
+        self.hyperparameters = hyperparameters if hyperparameters else {'C':10}
+        Cs = self.hyperparameters['C']
+        Cs = np.logspace(-4, 4, Cs) if np.ndim(Cs) == 0 else np.asarray(Cs, dtype=float)
+
+        # Split trials into training and test sets for each seed and scale them, as in classify(), unless already done.
+        if not isinstance(kahdata, SplitCache):
+            with self._time_stage('split'):
+                matrix = PredictorMatrix(np.column_stack([self.predvals, self.labels]), self.predictors, None)
+                kahdata = SplitCache(matrix, seeds, test_size=self.test_size, cv=self.cv)
+
+        with self._time_stage('split'):
+            Xtrain, Xtest, ytrain, ytest, folds = kahdata.split(seeds, self.predictors)
+
+        # Fit all seeds, folds, and values of C, then refit each training set with its best C.
+        with self._time_stage('fit'):
+            coef, intercept, self.C_seeds_, _ = cv_logistic_l2(Xtrain, ytrain, folds, Cs)
+
+        # Decision values rank test trials the same way as predicted probabilities.
+        with self._time_stage('evaluate'):
+            decision = (Xtest @ coef[..., None])[..., 0] + intercept[:, None]
+            roc_auc = rank_auc(decision, ytest)
+
+        if not resample:
+            return roc_auc, None
+
+        with self._time_stage('resample'):
+            resample_idx = resample_indices(ytest.shape[1], nresample, resample)
+            ytest_resample = ytest[:, resample_idx]
+            if resample == 'bootstrap':
+                score_resample = decision[:, resample_idx]
+            else:
+                score_resample = decision[:, None, :]
+            roc_auc_resample = rank_auc(score_resample, ytest_resample)
+
+        return roc_auc, roc_auc_resample
+
+    def report_timings(self):
+        """ Print total time spent in each stage, and its share of the total. """
+
+        total = sum(self.timings_.values())
+        for stage, seconds in sorted(self.timings_.items(), key=lambda item: -item[1]):
+            print('{:>10}: {:8.2f} s ({:5.1%})'.format(stage, seconds, seconds / total if total else 0))
+
+    @contextmanager
+    def _time_stage(self, stage):
+        """ Add time spent in a block of code to the total for a stage. """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings_[stage] = self.timings_.get(stage, 0.) + time.perf_counter() - start
+
+    def _get_classify_method(self, method):
+        """ Get the function that creates a classifier object for a classification method. """
+
+        if method == 'logistic': # for logistic regression.
+            return self._logistic_regression
+        elif method == 'logistic_numpy': # for logistic regression with the NumPy solver, same results as 'logistic'.
+            return self._logistic_regression_numpy
+        else:
+            raise ValueError('Classification method not supported.')
+
     def _standardscale_features(self, Xtrain, Xtest):
         """ Scale features to have zero mean and unit variance. """
 
@@ -180,10 +561,28 @@ class KahClassifier:
         if not self.hyperparameters:
             self.hyperparameters = {'C':10}
 
+        # A single C needs no cross-validation. The fit is the same as the refit done by LogisticRegressionCV.
+        if np.ndim(self.hyperparameters['C']) == 1 and len(self.hyperparameters['C']) == 1:
+            return LogisticRegression(C=self.hyperparameters['C'][0], penalty='l2', solver='liblinear', class_weight='balanced', random_state=self.seed)
+
         clf = LogisticRegressionCV(Cs=self.hyperparameters['C'], cv=self.cv, scoring=self.scoring, penalty='l2', solver='liblinear', class_weight='balanced', random_state=self.seed)
         
         return clf
 
+    def _logistic_regression_numpy(self):
+        """ Classify using logistic regression, fit with the batched NumPy solver. """
+
+        # Imported here, since kah_logistic uses rank_auc() from this module.
+        from kah_logistic import LogisticL2CV
+
+        # Defaults for C values to test.
+        if not self.hyperparameters:
+            self.hyperparameters = {'C':10}
+
+        clf = LogisticL2CV(Cs=self.hyperparameters['C'], cv=self.cv)
+
+        return clf
+
     def _set_predictors_labels(self, kahdata):
         """ Extract predictors of interest from KahData() object, aggregating across channels and channel pairs. 
         
@@ -192,29 +591,22 @@ class KahClassifier:
         For each trial, there will be one value for each feature for each region.
         In the case of multichannel data, there will be one value for each feature for each region combination.
 
-        """
+        If kahdata is a PredictorMatrix() or SplitCache() object, predictors have already been aggregated and are only selected.
 
-        # Aggregate all measures per trial per region.
-        stsc_ave = kahdata.stsc.pivot_table(index=['trial', 'lobe'], aggfunc = np.median).unstack()
-        stmc_ave = kahdata.stmc.pivot_table(index=['trial', 'direction'], aggfunc = np.median).unstack()
+        """
 
         # If all predictors are being used, get tuples of all the column names.
         if self.predictors == 'all':
             self.predictors = PREDICTORS_ALL
 
-        # Initialize data frame.
-        self.predvals = pd.DataFrame()
-
-        # Concatenate each desired predictor column to the predvals data frame.
-        for pred in self.predictors:
-
-            # Extract region and measure name.
-            measure, region = pred
+        with self._time_stage('aggregate'):
+            # Aggregate only the measures needed for the predictors of interest, if not done already.
+            if isinstance(kahdata, SplitCache):
+                kahdata = kahdata.matrix
+            elif not isinstance(kahdata, PredictorMatrix):
+                kahdata = PredictorMatrix.from_kahdata(kahdata, self.predictors)
 
-            if len(region) > 1: # between-channel measures
-                self.predvals = pd.concat([self.predvals, stmc_ave[measure, region]], axis=1)
-            else: # within-channel measures
-                self.predvals = pd.concat([self.predvals, stsc_ave[measure, region]], axis=1)
+            self.predvals = kahdata.select(self.predictors)
 
-        # Get labels for each trial (0 for forgotten, 1 for remembered).
-        self.labels = np.array(stsc_ave['encoding', 'F'])
\ No newline at end of file
+            # Get labels for each trial (0 for forgotten, 1 for remembered).
+            self.labels = kahdata.labels
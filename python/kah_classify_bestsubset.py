@@ -0,0 +1,37 @@
+""" Script for classifying encoded vs. forgotten trials for Kahana data with every subset of predictors. """
+
+from kah_save_subject_data import SUBJECT_STORES
+from kah_store import load_predictors
+from kah_classifier import PREDICTORS_ALL
+from kah_bestsubset import best_subset
+
+def classify_bestsubset(subj_type, nseed, predictors, storedir, n_jobs=1):
+    """ Classify all non-empty subsets of predictors, and print the top subsets of each size. """
+
+    subjects = load_predictors(SUBJECT_STORES[subj_type[0]], subjects=subj_type[1], predictors=predictors)
+
+    if predictors == 'all':
+        predictors = PREDICTORS_ALL
+
+    # Classify subsets not already in the store.
+    store = best_subset(subjects, predictors, nseed, storedir, n_jobs=n_jobs)
+
+    for size in range(1, len(predictors) + 1):
+        print('Top subsets with {} predictors:'.format(size))
+        for subset, score in store.top_subsets(size, k=5):
+            print('    {:.3f} {}'.format(score, subset))
+
+    return store
+
+if __name__ == "__main__":
+    # Pick subject data based on exclusion criteria.
+    good_auc_theta = ['R1020J', 'R1032D', 'R1045E', 'R1059J', 'R1075J', 'R1142N', 'R1147P', 'R1162N', 'R1166D', 'R1175N'] # 10/13
+
+    # Tuple format is (data type, subjects to include)
+    subj_type = ('theta', good_auc_theta)
+    nseed = 200
+    predictors = 'all'
+    storedir = 'bestsubset_theta_classifiableonly_all_nseed_200'
+    n_jobs = 1
+
+    classify_bestsubset(subj_type, nseed, predictors, storedir, n_jobs=n_jobs)
@@ -1,43 +1,85 @@
 """ Script for performing classification of encoded vs. forgotten trials for Kahana data. """
 
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 import numpy as np
 import pickle
-from kah_save_subject_data import SUBJECT_FILES
+from kah_save_subject_data import SUBJECT_STORES
+from kah_store import load_predictors
 from kah_classifier import KahClassifier
 from kah_data import SUBJECTS
 
-def classify_encoding(subj_type, nseed, nresample, predictors, filename):  
-    """ Classify data using given subject data and desired predictors, with or without resampling, repeated nseed number of times. """
+# Per-process state for parallel classification, set once per worker.
+_WORKER = {}
 
-    with open(SUBJECT_FILES[subj_type[0]], 'rb') as file:
-        subjects = pickle.load(file) 
-        if subj_type[1]:
-            subjects = [subj for subj in subjects if subj.subject in subj_type[1]]
+def _init_worker(subjects, predictors):
+    """ Give a worker the subjects' predictor matrices once, instead of sending them with every task. """
+
+    _WORKER['subjects'] = subjects
+    _WORKER['predictors'] = predictors
+
+def _classify_seeds(isubj, seeds, nresample, method):
+    """ Classify one subject for several seeds. Returns AUCs, resampled AUCs, and time spent per stage. """
+
+    subject = _WORKER['subjects'][isubj]
+    clf = KahClassifier(predictors=_WORKER['predictors'])
+    clf._set_predictors_labels(subject)
+
+    auc, auc_resample = clf.classify_seeds(subject, list(seeds), resample='permute' if nresample > 0 else None, nresample=nresample, need_aggregate=False, method=method)
+
+    return auc, auc_resample, clf.timings_
+
+def classify_encoding(subj_type, nseed, nresample, predictors, filename, n_jobs=1, chunksize=50, method='logistic'):  
+    """ Classify data using given subject data and desired predictors, with or without resampling, repeated nseed number of times.
+
+    Seeds are classified in chunks of chunksize seeds, over n_jobs processes. Each seed is classified independently, so
+    results do not depend on n_jobs or chunksize. With method='logistic_numpy', each chunk of seeds is fit in one
+    vectorized call, giving the same AUCs as 'logistic' within solver tolerance.
+    """
+
+    subjects = load_predictors(SUBJECT_STORES[subj_type[0]], subjects=subj_type[1], predictors=predictors)
 
     auc = np.empty([len(subjects), nseed])
     if nresample > 0:
         auc_resample = np.empty([len(subjects), nseed, nresample])
 
-    # Initialize classifier object.
-    clf = KahClassifier(predictors=predictors)
+    # Per subject, fit Logistic Regression models using various values of C, in chunks of seeds.
+    # hyp = {'C':[1e-15, 1e-14, 1e-13, 1e-12, 1e-11, 1e-10, 1e-9, 1e-8, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 10, 100, 1000, 10000, 100000, 1000000]}
+    chunks = [(isubj, range(start, min(start + chunksize, nseed))) for isubj in range(len(subjects)) for start in range(0, nseed, chunksize)]
+
+    # Classify in this process, or over a pool of processes that is shut down even if a chunk fails.
+    if n_jobs == 1:
+        _init_worker(subjects, predictors)
+        pool = nullcontext()
+    else:
+        pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(subjects, predictors))
+
+    with pool as executor:
+        if executor is None:
+            results = (((isubj, seeds), _classify_seeds(isubj, seeds, nresample, method)) for isubj, seeds in chunks)
+        else:
+            futures = {executor.submit(_classify_seeds, isubj, seeds, nresample, method):(isubj, seeds) for isubj, seeds in chunks}
+            results = ((futures[future], future.result()) for future in as_completed(futures))
 
-    # Per subject, fit Logistic Regression models using various values of C. 
-    for isubj in range(len(subjects)):    
-        print(subjects[isubj].subject)
-
-        # Set predictors and labels for current subject.
-        clf._set_predictors_labels(subjects[isubj])
-
-        # hyp = {'C':[1e-15, 1e-14, 1e-13, 1e-12, 1e-11, 1e-10, 1e-9, 1e-8, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 10, 100, 1000, 10000, 100000, 1000000]}
-    
-        for seed in range(nseed):
-            if np.mod(seed, 500) == 0:
-                print(seed)
-            clf.seed = seed
-            clf.classify(subjects[isubj], 'logistic', hyperparameters=None, resample='permute', nresample=nresample, need_aggregate=False)
-            auc[isubj, seed]= clf.roc_auc_
+        # Collect results as they finish, and report progress.
+        timings = {}
+        start = time.perf_counter()
+        for ichunk, ((isubj, seeds), (auc_chunk, auc_resample_chunk, timings_chunk)) in enumerate(results):
+            auc[isubj, seeds.start:seeds.stop] = auc_chunk
             if nresample > 0:
-                auc_resample[isubj, seed, :] = clf.roc_auc_resample_
+                auc_resample[isubj, seeds.start:seeds.stop, :] = auc_resample_chunk
+            for stage in timings_chunk:
+                timings[stage] = timings.get(stage, 0.) + timings_chunk[stage]
+
+            elapsed = time.perf_counter() - start
+            print('{}/{} chunks ({} seeds of {}), {:.0f} s elapsed, {:.0f} s left'.format(
+                ichunk + 1, len(chunks), len(seeds), subjects[isubj].subject, elapsed, elapsed / (ichunk + 1) * (len(chunks) - ichunk - 1)))
+
+    # Report time spent per stage of classification, summed over processes.
+    clf = KahClassifier(predictors=predictors)
+    clf.timings_ = timings
+    clf.report_timings()
 
     # Save to disk.
     if nresample > 0:
@@ -64,5 +106,7 @@ if __name__ == "__main__":
         ('earlyhfa', 'F'),
         ]
     filename = 'kah_all_all_nseed_1000_nresample_0_predictors_top3.pickle'
+    n_jobs = 1
+    method = 'logistic_numpy'
 
-    classify_encoding(subj_type, nseed, nresample, predictors, filename)
\ No newline at end of file
+    classify_encoding(subj_type, nseed, nresample, predictors, filename, n_jobs=n_jobs, method=method)
\ No newline at end of file
@@ -1,73 +1,21 @@
-import numpy as np
-import pickle
-from kah_save_subject_data import SUBJECT_FILES
-from kah_classifier import KahClassifier, PREDICTORS_ALL
 import os 
+from kah_save_subject_data import SUBJECT_STORES
+from kah_store import load_predictors
+from kah_classifier import PREDICTORS_ALL
+from kah_stepforward import stepforward
 from kah_data import SUBJECTS
 
-def classify_stepforward(subj_type, nseed, predictors, foldername):  
+def classify_stepforward(subj_type, nseed, predictors, foldername, n_jobs=1, racing=False):  
     # Pick subject data based on exclusion criteria.
-    with open(SUBJECT_FILES[subj_type[0]], 'rb') as file:
-        subjects = pickle.load(file) 
-        if subj_type[1]:
-            subjects = [subj for subj in subjects if subj.subject in subj_type[1]]
-
-    filename = foldername + '/kah_stepforward_npred{}_ipred{}.pickle'
-
-    # Start by considering all possible features.
-    top_features = []
+    subjects = load_predictors(SUBJECT_STORES[subj_type[0]], subjects=subj_type[1], predictors=predictors)
 
     if predictors == 'all':
         predictors = PREDICTORS_ALL
-    
-    # Build one-, then two-, then three- ... feature models, each time building on the most predictive previous models.
-    for npred in range(len(predictors)):
-        predictors_available = [pred for pred in predictors if pred not in top_features]
-        
-        # If all n-feature models have already been built, extract known top features.
-        if os.path.isfile(filename.format(npred, len(predictors_available) - 1)):
-            top_features.append(_get_top_feature(filename, npred, predictors_available))
-            continue
-        
-        print('Fitting models with {} features.'.format(npred + 1))
-        for ipred, predictor in enumerate(predictors_available):
-            # If current n-feature model has already been built, skip to the next.
-            if os.path.isfile(filename.format(npred, ipred)):
-                continue
-                
-            print('{}/{}'.format(ipred, len(predictors_available) - 1))
-            
-            auc_subset = np.empty([len(subjects), nseed])
-
-            clf = KahClassifier(predictors=[*top_features, predictor])
 
-            for isubj in range(len(subjects)):    
-                clf._set_predictors_labels(subjects[isubj])
-                for seed in range(nseed):
-                    # Classify using top features and each of the potential features left.
-                    clf.seed = seed           
-                    clf.classify(subjects[isubj], 'logistic', hyperparameters=None, need_aggregate=False)
-                    auc_subset[isubj, seed] = clf.roc_auc_
-                
-            # Save each new feature combo to disk.
-            kah_stepforward = {'auc_subset':auc_subset, 'predictors_available':predictors_available, 'subject_id':[subj.subject for subj in subjects]}
-            with open(filename.format(npred, ipred), 'wb') as file:
-                pickle.dump(kah_stepforward, file) 
-        
-        # Find and add new top feature to list.
-        top_features.append(_get_top_feature(filename, npred, predictors_available))
-
-def _get_top_feature(filename, npred, predictors_available):
-    auc_allsubsets = []
-    for ipred in range(len(predictors_available)):
-        with open(filename.format(npred, ipred), 'rb') as file:
-            auc_curr = pickle.load(file)['auc_subset'] 
-            if ipred == 0:
-                auc_allsubsets = auc_curr
-            else:
-                auc_allsubsets = np.dstack((auc_allsubsets, auc_curr))
-
-    return predictors_available[np.argmax(np.median(np.median(auc_allsubsets, axis=1), axis=0))]
+    # Build one-, then two-, then three- ... feature models, each time building on the most predictive previous models.
+    # AUCs are recorded in a database in foldername, and models already recorded are not refit.
+    os.makedirs(foldername, exist_ok=True)
+    return stepforward(subjects, predictors, nseed, os.path.join(foldername, 'kah_stepforward.sqlite'), n_jobs=n_jobs, racing=racing)
 
 if __name__ == "__main__":
     # Pick subject data based on exclusion criteria.
@@ -96,4 +44,7 @@ if __name__ == "__main__":
                     ('normtspacmax', 'FT'), 
                 ]
 
-    classify_stepforward(subj_type, nseed, predictors, foldername)
\ No newline at end of file
+    n_jobs = 1
+    racing = False # set to True to drop clearly worse candidates early
+
+    classify_stepforward(subj_type, nseed, predictors, foldername, n_jobs=n_jobs, racing=racing)
\ No newline at end of file
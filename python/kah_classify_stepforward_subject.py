@@ -1,83 +1,30 @@
-import numpy as np
-import pickle
-from kah_save_subject_data import SUBJECT_FILES
-from kah_classifier import KahClassifier, PREDICTORS_ALL
 import os 
+from kah_save_subject_data import SUBJECT_STORES
+from kah_store import load_predictors
+from kah_classifier import PREDICTORS_ALL
+from kah_stepforward import stepforward
 from kah_data import SUBJECTS
 
-def classify_stepforward_subject(subj_type, nseed, predictors, foldername):  
+def classify_stepforward_subject(subj_type, nseed, predictors, foldername, n_jobs=1, racing=False):  
     subj_type, subject_id = subj_type
 
     # Pick subject data based on exclusion criteria.
-    with open(SUBJECT_FILES[subj_type], 'rb') as file:
-        subjects = pickle.load(file) 
-        if subj_type[1]:
-            subjects = [subj for subj in subjects if subj.subject in subject_id]
+    subjects = load_predictors(SUBJECT_STORES[subj_type], subjects=subject_id, predictors=predictors)
 
     if predictors == 'all':
         predictors = PREDICTORS_ALL
     
-    # Set file name to save output to.
-    filename = foldername + '/kah_stepforward_{}_npred{}_ipred{}.pickle'
+    # Set database to record AUCs in.
+    os.makedirs(foldername, exist_ok=True)
+    dbfile = os.path.join(foldername, 'kah_stepforward_subject.sqlite')
 
     # Stepforward individually for each subject.
-    for isubj in range(len(subjects)):
-        print(subject_id[isubj])
-        
-        # Start by considering all possible features.
-        top_features = []
+    top_features = {}
+    for subject in subjects:
+        print(subject.subject)
+        top_features[subject.subject] = stepforward([subject], predictors, nseed, dbfile, n_jobs=n_jobs, racing=racing)
 
-        # Build one-, then two-, then three- ... feature models, each time building on the most predictive previous models.
-        for npred in range(len(predictors)):
-            predictors_available = [pred for pred in predictors if pred not in top_features]
-        
-            # If all n-feature models have already been built, extract known top features.
-            if os.path.isfile(filename.format(subject_id[isubj], npred, len(predictors_available) - 1)):
-                top_features.append(_get_top_feature(filename, subject_id[isubj], npred, predictors_available))
-                print('Adding feature {}'.format(top_features[-1]))
-                continue
-        
-            print('Fitting models with {} features.'.format(npred + 1))
-            for ipred, predictor in enumerate(predictors_available):
-                # If current n-feature model has already been built, skip to the next.
-                if os.path.isfile(filename.format(subject_id[isubj], npred, ipred)):
-                    continue
-                
-                print('{}/{}'.format(ipred, len(predictors_available) - 1))
-            
-                auc_subset = np.empty([nseed])
-                for seed in range(nseed):
-                    # Classify using top features and each of the potential features left.
-                    clf = KahClassifier(predictors=[*top_features, predictor], seed=seed)
-                    clf.classify(subjects[isubj], 'logistic', hyperparameters=None)
-                    auc_subset[seed] = clf.roc_auc_
-                
-                # Save each new feature combo to disk.
-                kah_stepforward = {'auc_subset':auc_subset, 'predictors_available':predictors_available}
-                with open(filename.format(subject_id[isubj], npred, ipred), 'wb') as file:
-                    pickle.dump(kah_stepforward, file) 
-        
-            # Find and add new top feature to list.
-            top_features.append(_get_top_feature(filename, subject_id[isubj], npred, predictors_available))
-            print('Current list of top features: {}'.format(top_features))
-
-def _get_top_feature(filename, subject, npred, predictors_available):
-    # Return single feature if only one is provided.
-    if len(predictors_available) == 1:
-        return predictors_available[0]
-    
-    # Aggregate all models with npred number of features.
-    auc_allsubsets = []
-    for ipred in range(len(predictors_available)):
-        with open(filename.format(subject, npred, ipred), 'rb') as file:
-            auc_curr = pickle.load(file)['auc_subset'] 
-            if ipred == 0:
-                auc_allsubsets = auc_curr
-            else:
-                auc_allsubsets = np.vstack((auc_allsubsets, auc_curr))
-    
-    # Average across seeds, then find the feature corresponding to highest AUC.
-    return predictors_available[np.argmax(np.median(auc_allsubsets, axis=1))]
+    return top_features
 
 if __name__ == "__main__":
     # Pick subject data based on exclusion criteria.
@@ -94,4 +41,7 @@ if __name__ == "__main__":
     predictors = 'all'
     foldername = 'stepforward_theta_all_nseed_200_subject'
 
-    classify_stepforward_subject(subj_type, nseed, predictors, foldername)
\ No newline at end of file
+    n_jobs = 1
+    racing = False # set to True to drop clearly worse candidates early
+
+    classify_stepforward_subject(subj_type, nseed, predictors, foldername, n_jobs=n_jobs, racing=racing)
\ No newline at end of file
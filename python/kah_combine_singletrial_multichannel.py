@@ -1,11 +1,19 @@
-""" Script for combining Kahana singletrial_multichannel CSVs across subjects. """
+""" Script for combining Kahana singletrial_multichannel CSVs across subjects.
 
-import glob, os
-import pandas as pd 
+Each subject's CSV is streamed in chunks into the columnar cache of the 'stmc' data set, partitioned by subject, so the
+CSVs are never all held in memory. Only subjects whose CSVs changed since the last run are reconverted. KahData reads
+the combined data set from the cache.
+"""
+
+import os
+import kah_cache
+from kah_data import KahData, subject_csvs, csv_dtypes
 
 if __name__ == "__main__":
-    # Concatenate DFs across subjects.
-    df = pd.concat(map(pd.read_csv, glob.glob(os.path.join('', '/Users/Rogue/Documents/Research/Projects/KAH/csv/*singletrial_multichannel*'))))
+    # Find each subject's CSV. The pattern excludes the combined CSV written by earlier versions of this script.
+    csvfiles = subject_csvs(KahData.csvpath, 'stmc')
+    print('{} subject CSVs found.'.format(len(csvfiles)))
 
-    # Save full CSV.
-    df.to_csv('/Users/Rogue/Documents/Research/Projects/KAH/csv/kah_singletrial_multichannel.csv', sep=',')
+    # Stream changed CSVs into the cache, with data types from the shared header.
+    nconverted = kah_cache.combine_csvs(csvfiles, os.path.join(KahData.cachepath, 'stmc'), dtype=csv_dtypes(csvfiles[0]))
+    print('{} of {} subject CSVs converted.'.format(nconverted, len(csvfiles)))
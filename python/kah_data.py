@@ -1,7 +1,14 @@
 """ Class for loading Kahana features from CSV. """
 
+import copy
+import glob
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 import numpy as np
+import kah_cache
 
 # Global variables for accessing data sets.
 SINGLECHAN = ['sc', 'stsc'] # single-channel data sets
@@ -15,6 +22,72 @@ THETAS = [['thetachan'], ['thetachan'], ['thetachanA', 'thetachanB'], ['thetacha
 
 SUBJECTS = ['R1020J', 'R1034D', 'R1045E', 'R1059J', 'R1075J', 'R1080E', 'R1142N', 'R1149N', 'R1154D', 'R1162N', 'R1166D', 'R1167M', 'R1175N', 'R1001P', 'R1003P', 'R1006P', 'R1018P', 'R1036M', 'R1039M', 'R1060M', 'R1066P', 'R1067P', 'R1069M', 'R1086M', 'R1089P', 'R1112M', 'R1136N', 'R1177M']
 
+# Directory containing the CSVs. Can be overridden with the KAH_CSVPATH environment variable or KahData.set_csvpath().
+CSVPATH = os.environ.get('KAH_CSVPATH', '/Users/Rogue/Documents/Research/Projects/KAH/csv/')
+
+# Directory containing the columnar cache of the CSVs. Defaults to a 'cache' folder next to the CSVs.
+CACHEPATH = os.environ.get('KAH_CACHEPATH', os.path.join(CSVPATH, 'cache'))
+
+# CSV file name for each data set.
+CSVFILES = {'stsc':'kah_singletrial_singlechannel.csv',
+            'stmc':'kah_singletrial_multichannel.csv',
+            'sc':'kah_singlechannel.csv',
+            'mc':'kah_multichannel.csv'}
+
+# Per-subject CSV files for data sets saved one subject at a time. If any exist, they are combined into the data set's
+# cache in place of the full CSV.
+SUBJECT_CSVFILES = {'stmc':'kah_singletrial_multichannel_*.csv'}
+
+# Data types of identifier columns. All other columns are features and are read as floats.
+ID_DTYPES = {'subject':str, 'channel':str, 'channelA':str, 'channelB':str,
+             'lobe':str, 'lobeA':str, 'lobeB':str, 'region':str, 'regionA':str, 'regionB':str, 'direction':str,
+             'pair':np.int64, 'trial':np.int64, 'encoding':np.int64, 'thetabump':np.int64}
+
+# Inputs to KahData() that only exclude channels or channel pairs.
+EXCLUSIONS = ['enforce_theta', 'exclude_theta', 'enforce_phase']
+
+# Feature columns always needed for marking theta channels and computing between-channel PAC.
+REQUIRED_FEATURES = ['posttheta', 'pvalposttheta', 'thetabump'] + \
+                    ['{}rawpac{}'.format(timewin, direction) for timewin in ['pre', 'early', 'late'] for direction in ['AB', 'BA']]
+
+# Time windows of features that are also calculated as a change from the pre-stimulus window (e.g. 'earlythetadelta').
+DELTA_TIMEWINS = ['early', 'late']
+
+def feature_sources(feature):
+    """ Get the columns a feature is calculated from: the time window and pre-stimulus columns of a delta feature (e.g.
+    'earlytheta' and 'pretheta' for 'earlythetadelta'), or the feature itself.
+    """
+
+    for timewin in DELTA_TIMEWINS:
+        if feature.startswith(timewin) and feature.endswith('delta'):
+            measure = feature[len(timewin):-len('delta')]
+            return [timewin + measure, 'pre' + measure]
+
+    return [feature]
+
+def subject_csvs(csvpath, dataset):
+    """ Get paths of a data set's per-subject CSVs, sorted by name. Empty if the data set has none. """
+
+    if dataset not in SUBJECT_CSVFILES:
+        return []
+
+    return sorted(glob.glob(os.path.join(csvpath, SUBJECT_CSVFILES[dataset])))
+
+def csv_dtypes(csvfile):
+    """ Get explicit data types for every column in a CSV, based on its header. """
+
+    columns = pd.read_csv(csvfile, nrows=0).columns
+    return {column:ID_DTYPES.get(column, np.float64) for column in columns}
+
+class _LazyDataset:
+    """ Class attribute that loads a data set from CSV the first time it is accessed. """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return owner.load(self.name)
+
 class KahData:
     """ Load Kahana data from CSV files. 
 
@@ -23,7 +96,8 @@ class KahData:
     subject : string or 'all', optional
         Subject(s) for which to classify trial outcome. default: 'all'
     include_region : string or list of strings, optional
-        Regions or lobes to include during feature calculation. default: None (include all)
+        Regions or lobes to include during feature calculation. A string keeps every region that is a substring of it
+        (e.g. 'lpfc' also keeps 'pfc'). default: None (include all)
     enforce_theta : boolean, optional
         Keep only channels and channel pairs in which theta was present. default: False
     enforce_phase : boolean, optional
@@ -34,11 +108,18 @@ class KahData:
     theta_threshlevel : float, optional
         Threshold for detecting theta. For 'pval', this is the p-value threshold. For 'percent', this is the % trials threshold. Ignored
         for 'bump'. default: None
+    features : list of strings, optional
+        Feature columns to load. Identifier columns and features needed for theta detection and between-channel PAC are always
+        loaded, and delta features (e.g. 'earlythetadelta') load the columns they are calculated from. Raises KeyError for
+        features that cannot be loaded or calculated. Include 'phasepair' to mark phase-encoding pairs in 'stmc'.
+        default: None (load all columns)
     
     Attributes
     ----------
     csvpath : string
         Path to directory containing CSVs.
+    cachepath : string
+        Path to directory containing the columnar cache of each CSV, used if pyarrow is installed.
     paths : dictionary
         Paths to each CSV. Each CSV contains features from different segments of data, described below.
     stsc : Pandas Dataframe
@@ -47,19 +128,36 @@ class KahData:
         Single-trial, multi-channel features. Examples include between-channel PAC.
     sc : Pandas Dataframe
         Single-channel features. Examples include p-values for theta power and HFA.
+    mc : Pandas Dataframe
+        Multi-channel features. Examples include the number of theta phase-encoding episodes per channel pair. Only loaded
+        to enforce phase encoding or mark phase-encoding pairs ('phasepair'). If it is missing and all features are
+        requested, every pair is marked as non-encoding, with a warning.
+
+    Notes
+    -----
+    The full data sets are class attributes shared by all KahData() objects. Each CSV is only read the first time
+    its data set is accessed (e.g. KahData.stsc or creating a KahData() object), and is then kept in memory.
+
+    If pyarrow is installed, each CSV is converted once to Parquet files partitioned by subject, and reconverted
+    whenever the CSV changes. A KahData() object for a single subject, or with a subset of features, then only reads
+    that subject's rows and the needed columns, without loading the full data sets.
     """
 
     # Set path information.
-    csvpath = '/Users/Rogue/Documents/Research/Projects/KAH/csv/'
-    paths = {'stsc':csvpath + 'kah_singletrial_singlechannel.csv', 
-             'stmc':csvpath + 'kah_singletrial_multichannel.csv',
-             'sc':csvpath + 'kah_singlechannel.csv'}
+    csvpath = CSVPATH
+    cachepath = CACHEPATH
+    paths = {dataset:os.path.join(CSVPATH, CSVFILES[dataset]) for dataset in CSVFILES}
 
-    # Load data from each CSV.
-    for path in paths:
-        exec(path + ' = pd.read_csv(paths[path])')
+    # Full data sets, loaded from CSV on first access.
+    stsc = _LazyDataset()
+    stmc = _LazyDataset()
+    sc = _LazyDataset()
+    mc = _LazyDataset()
 
-    def __init__(self, subject='all', include_regions=None, enforce_theta=False, enforce_phase=False, theta_threshtype='bump', theta_threshlevel=None, exclude_theta=False):
+    # Data sets that have already been loaded.
+    _loaded = {}
+
+    def __init__(self, subject='all', include_regions=None, enforce_theta=False, enforce_phase=False, theta_threshtype='bump', theta_threshlevel=None, exclude_theta=False, features=None):
         """ Create a KahData() object. """
 
         # Set input parameters. 
@@ -70,6 +168,7 @@ class KahData:
         self.theta_threshtype = theta_threshtype
         self.theta_threshlevel = theta_threshlevel
         self.exclude_theta = exclude_theta
+        self.features = features
 
         if self.enforce_theta and self.exclude_theta:
             raise ValueError('Theta power should not be enforced and simultaneous used to exclude channels.')
@@ -77,19 +176,184 @@ class KahData:
         # Extract data of interest based on subject, channel exclusion, and features of interest.
         self._set_data()
 
+    @classmethod
+    def set_csvpath(cls, csvpath, cachepath=None):
+        """ Set the directory containing the CSVs, and forget any data sets loaded from the previous directory. """
+
+        cls.csvpath = csvpath
+        cls.cachepath = cachepath if cachepath else os.path.join(csvpath, 'cache')
+        cls.paths = {dataset:os.path.join(csvpath, CSVFILES[dataset]) for dataset in CSVFILES}
+        cls.clear()
+
+    @classmethod
+    def convert(cls, dataset):
+        """ Convert a data set to the columnar cache, if the cache is missing or out of date. Returns the cache directory.
+
+        Data sets with per-subject CSVs are combined from those, reconverting only the subjects whose CSVs changed.
+        """
+
+        cachedir = os.path.join(cls.cachepath, dataset)
+        csvfiles = subject_csvs(cls.csvpath, dataset)
+        if csvfiles:
+            kah_cache.combine_csvs(csvfiles, cachedir, dtype=csv_dtypes(csvfiles[0]))
+        elif not kah_cache.is_current(cls.paths[dataset], cachedir):
+            kah_cache.convert_csv(cls.paths[dataset], cachedir, dtype=csv_dtypes(cls.paths[dataset]))
+
+        return cachedir
+
+    @classmethod
+    def columns(cls, dataset):
+        """ Get the names of all columns in a data set without loading it. """
+
+        if kah_cache.HAVE_PARQUET:
+            return kah_cache.read_manifest(cls.convert(dataset))['columns']
+
+        return list(pd.read_csv((subject_csvs(cls.csvpath, dataset) or [cls.paths[dataset]])[0], nrows=0).columns)
+
+    @classmethod
+    def load(cls, dataset, subject=None, columns=None):
+        """ Get a data set, reading it from the cache or CSV if it has not been loaded yet.
+
+        Parameters
+        ----------
+        dataset : string
+            Data set to load. One of 'stsc', 'stmc', 'sc', or 'mc'.
+        subject : string, optional
+            Only get rows for this subject. default: None (all subjects)
+        columns : list of strings, optional
+            Only get these columns. default: None (all columns)
+
+        Notes
+        -----
+        Full data sets are kept in memory. Subsets are read from the columnar cache every time if it is available,
+        and are taken from the full data set otherwise.
+        """
+
+        if (subject is not None or columns is not None) and kah_cache.HAVE_PARQUET and dataset not in cls._loaded:
+            return kah_cache.read_partitions(cls.convert(dataset), subjects=None if subject is None else [subject], columns=columns)
+
+        if dataset not in cls._loaded:
+            if kah_cache.HAVE_PARQUET:
+                cls._loaded[dataset] = kah_cache.read_partitions(cls.convert(dataset))
+            else:
+                paths = subject_csvs(cls.csvpath, dataset) or [cls.paths[dataset]]
+                cls._loaded[dataset] = pd.concat([pd.read_csv(path, dtype=csv_dtypes(path)) for path in paths], ignore_index=True)
+
+        data = cls._loaded[dataset]
+        if subject is not None:
+            data = data[data['subject'] == subject]
+        if columns is not None:
+            data = data[[column for column in data.columns if column in columns]]
+
+        return data
+
+    @classmethod
+    def exists(cls, dataset):
+        """ Check whether a data set has been loaded or has a CSV to load it from. """
+
+        return dataset in cls._loaded or bool(subject_csvs(cls.csvpath, dataset)) or os.path.isfile(cls.paths[dataset])
+
+    @classmethod
+    def clear(cls):
+        """ Free memory used by loaded data sets. They will be reloaded on next access. """
+
+        cls._loaded.clear()
+
     def _set_data(self):
         """ Extract data based on the inputs to init. """
         
-        # Initial data is all trials across all channels and subjects from KahData.
+        # Initial data is all trials across all channels and subjects from KahData, or only the subject and features needed.
+        # Full data sets are shallow copies, so that adding columns does not change the data sets shared by all objects.
         for dataset in DATASETS:
-            setattr(self, dataset, getattr(KahData, dataset))
+            if self.subject == 'all' and self.features is None:
+                setattr(self, dataset, getattr(KahData, dataset).copy(deep=False))
+            else:
+                subject = None if self.subject == 'all' else self.subject
+                setattr(self, dataset, KahData.load(dataset, subject=subject, columns=self._get_columns(dataset)))
+
+        # Phase encoding per channel pair, only used to mark phase-encoding pairs. It is required to enforce phase encoding
+        # or to get 'phasepair' as a feature, and is otherwise only loaded if all features are requested and it exists.
+        self.mc = None
+        if self.enforce_phase or (self.features is not None and 'phasepair' in self.features):
+            self.mc = KahData.load('mc', subject=None if self.subject == 'all' else self.subject, columns=['subject', 'pair', 'encodingepisodes'])
+        elif self.features is None:
+            if KahData.exists('mc'):
+                self.mc = KahData.load('mc', subject=None if self.subject == 'all' else self.subject, columns=['subject', 'pair', 'encodingepisodes'])
+            else:
+                warnings.warn('{} not found, so no channel pairs are marked as phase-encoding (phasepair = 0).'.format(KahData.paths['mc']))
 
         self._set_subject()
         self._set_region()
         self._set_theta()
-        # self._set_phasepair()
+        self._set_phasepair()
         self._set_betweenpac()
         self._calculate_deltas()
+        self._check_features()
+        self._set_exclusions()
+
+    @classmethod
+    def build_variants(cls, variants, subject='all', **kwargs):
+        """ Create KahData() objects that differ only in which channels and channel pairs are excluded.
+
+        Parameters
+        ----------
+        variants : dict of dicts
+            Exclusion inputs for each variant, keyed by variant name. Keys of each dict can be 'enforce_theta', 'exclude_theta',
+            and 'enforce_phase'. An empty dict keeps all channels.
+        subject : string or 'all', optional
+            Subject(s) to load. default: 'all'
+        **kwargs
+            Other inputs to KahData(), shared by all variants.
+
+        Returns
+        -------
+        data : dict of KahData() objects
+            One object per variant, keyed by variant name.
+
+        Notes
+        -----
+        Loading, subject and region selection, theta marking, and derived features are computed once. Each variant then only
+        removes rows from the shared data sets.
+        """
+
+        for exclusions in variants.values():
+            for key in exclusions:
+                if key not in EXCLUSIONS:
+                    raise ValueError('Variants can only differ in {}, not {}.'.format(EXCLUSIONS, key))
+            if exclusions.get('enforce_theta') and exclusions.get('exclude_theta'):
+                raise ValueError('Theta power should not be enforced and simultaneous used to exclude channels.')
+
+        # Build data without any exclusions, marking phase-encoding pairs if any variant enforces phase encoding.
+        if kwargs.get('features') is not None and 'phasepair' not in kwargs['features'] and any(exclusions.get('enforce_phase') for exclusions in variants.values()):
+            kwargs = dict(kwargs, features=list(kwargs['features']) + ['phasepair'])
+        shared = cls(subject=subject, **kwargs)
+
+        data = {}
+        for name, exclusions in variants.items():
+            # Copies share data sets with the shared object until rows are removed.
+            data[name] = copy.copy(shared)
+            for key in EXCLUSIONS:
+                setattr(data[name], key, exclusions.get(key, False))
+            data[name]._set_exclusions()
+
+        return data
+
+    def _get_columns(self, dataset):
+        """ Get the columns of a data set needed for the features of interest, or None if all columns are needed. """
+
+        if self.features is None:
+            return None
+
+        needed = list(ID_DTYPES) + REQUIRED_FEATURES + [source for feature in self.features for source in feature_sources(feature)]
+        return [column for column in KahData.columns(dataset) if column in needed]
+
+    def _check_features(self):
+        """ Check that every feature of interest was loaded or calculated. """
+
+        if self.features is not None:
+            missing = [feature for feature in self.features if not any(feature in getattr(self, dataset) for dataset in DATASETS)]
+            if missing:
+                raise KeyError('Features {} are not in any data set and cannot be calculated.'.format(missing))
 
     def _set_subject(self):
         """ Remove subjects, if necessary. """
@@ -104,23 +368,26 @@ class KahData:
 
         if self.include_regions:
             for idata, dataset in enumerate(DATASETS):
+                # Keep rows in which all channels are in the regions of interest. Membership is tested once per unique region
+                # with 'in', so a string of regions keeps every region that is a substring of it, as before.
+                datacurr = getattr(self, dataset)
+                rows_keep = np.ones(len(datacurr), dtype=bool)
                 for region in REGIONS[idata]:
-                    datacurr = getattr(self, dataset)
-                    rows_keep = np.array([True if region_ in self.include_regions else False for region_ in datacurr[region]])
-                    setattr(self, dataset, datacurr.iloc[rows_keep, :])
+                    regions_keep = [region_ for region_ in pd.unique(datacurr[region]) if region_ in self.include_regions]
+                    rows_keep &= datacurr[region].isin(regions_keep).to_numpy()
+                setattr(self, dataset, datacurr[rows_keep])
 
     def _set_theta(self):
-        """ Determine theta channels and remove non-theta channels, if necessary. """
+        """ Mark channels and channel pairs that have theta. """
 
         # Mark channels that have theta.
         if self.theta_threshtype == 'pval':
             thetachan = self.sc[self.sc['pvalposttheta'] < self.theta_threshlevel]['channel']
         elif self.theta_threshtype == 'percent':
-            thetachan = []
-            for chan in self.sc['channel']:
-                ntheta_trial = np.sum(self.stsc[self.stsc['channel'] == chan]['posttheta'] > 0)
-                thetachan.append((ntheta_trial / len(self.stsc['trial'].unique())) > self.theta_threshlevel)
-            thetachan = self.sc[thetachan]['channel']
+            # Count trials with theta per channel, in one pass over all trials.
+            ntheta_trial = (self.stsc['posttheta'] > 0).groupby(self.stsc['channel']).sum()
+            ntheta_trial = self.sc['channel'].map(ntheta_trial).fillna(0)
+            thetachan = self.sc[(ntheta_trial / self.stsc['trial'].nunique(dropna=False)) > self.theta_threshlevel]['channel']
         elif self.theta_threshtype == 'bump':
             thetachan = self.sc[self.sc['thetabump'] == 1]['channel']
         else:
@@ -128,7 +395,10 @@ class KahData:
 
         for idata, dataset in enumerate(DATASETS):
             for theta, channel in zip(THETAS[idata], CHANNELS[idata]):
-                getattr(self, dataset)[theta] = [1 if chan in list(thetachan) else 0 for chan in getattr(self, dataset)[channel]]
+                getattr(self, dataset)[theta] = getattr(self, dataset)[channel].isin(thetachan).astype(np.int64)
+
+    def _set_exclusions(self):
+        """ Remove channels and channel pairs based on theta and phase encoding, if necessary. """
 
         # Exclude channels with or without prominent theta, if necessary.
         if self.enforce_theta or self.exclude_theta:
@@ -147,60 +417,126 @@ class KahData:
                 datacurr = getattr(self, multi)
                 setattr(self, multi, datacurr[datacurr['thetachanA'] + datacurr['thetachanB'] == targets[1]])
 
+        # Remove non-encoding pairs, if necessary.
+        if self.enforce_phase:
+            for multi in MULTICHAN:
+                datacurr = getattr(self, multi)
+                setattr(self, multi, datacurr[datacurr['phasepair'] == 1])
+
     def _set_phasepair(self):
-        """ Mark phase-encoding pairs and remove non-encoding pairs, if necessary. """
+        """ Mark phase-encoding pairs. Without phase encoding per pair, pairs are only marked if all features were requested,
+        as non-encoding.
+        """
+
+        if self.mc is None:
+            if self.features is None:
+                for multi in MULTICHAN:
+                    getattr(self, multi)['phasepair'] = 0
+            return
 
         # Use encoding episodes from individualized or canonical theta bands.
         episodes_to_use = 'encodingepisodes'
 
-        # Mark channel pairs showing significant phase encoding.
-        phasepair = self.mc[self.mc[episodes_to_use] > 0]['pair']
+        # Mark channel pairs showing significant phase encoding. Pairs are numbered per subject.
+        phasepair = pd.MultiIndex.from_frame(self.mc.loc[self.mc[episodes_to_use] > 0, ['subject', 'pair']])
         for multi in MULTICHAN:
-            getattr(self, multi)['phasepair'] = [1 if pair in list(phasepair) else 0 for pair in getattr(self, multi)['pair']]
-
-        # Remove non-encoding pairs, if necessary.
-        if self.enforce_phase: 
-            for multi in MULTICHAN:
-                datacurr = getattr(self, multi)
-                setattr(self, multi, datacurr[datacurr['phasepair'] == 1])
+            datacurr = getattr(self, multi)
+            datacurr['phasepair'] = pd.MultiIndex.from_frame(datacurr[['subject', 'pair']]).isin(phasepair).astype(np.int64)
 
     def _set_betweenpac(self):
         """ Determine per-trial, between-channel PAC values based the direction (AB or BA) in which PAC is strongest for that trial. """
 
+        # Construct region pair labels once. Every ordered pair of regions is a category, so the label for the AB and BA
+        # direction of each channel pair can be looked up from the region codes.
+        regions = pd.Categorical(pd.concat([self.stmc['regionA'], self.stmc['regionB']], ignore_index=True).fillna('nan'))
+        nregion = len(regions.categories)
+        codesA, codesB = np.split(regions.codes.astype(np.int64), 2)
+        pairlabels = ['{}-{}'.format(regionA, regionB) for regionA in regions.categories for regionB in regions.categories]
+        pairAB = codesA * nregion + codesB
+        pairBA = codesB * nregion + codesA
+
         # Determine PAC values individually per time window.
         timewins = ['pre', 'early', 'late']
         for timewin in timewins:
             # Set current time window.
             colcurr = '{}rawpac'.format(timewin)
+            pacAB = self.stmc[colcurr + 'AB'].to_numpy()
+            pacBA = self.stmc[colcurr + 'BA'].to_numpy()
 
             # Set PAC as that in the maximal direction.
             # NOTE: Because PAC direction is set for individual trials, a pair could be TF in one trial and FT in another.
-            self.stmc[colcurr] = np.maximum(self.stmc[colcurr + 'AB'], self.stmc[colcurr + 'BA'])
+            self.stmc[colcurr] = np.maximum(pacAB, pacBA)
 
             # Determine if PAC is stronger in direction AB or direction BA.
-            ab = self.stmc[colcurr + 'AB'] > self.stmc[colcurr + 'BA']
+            ab = pacAB > pacBA
             self.stmc[colcurr + 'ABorBA'] = ab
 
-            # Construct region pair label using individual channel regions. This label corresponds to the AB direction.
-            regionpair = ['{}-{}'.format(regionA, regionB) for regionA, regionB in zip(self.stmc['regionA'], self.stmc['regionB'])]
+            # Make a direction label using the region pair label, flipped if PAC was stronger in the BA direction.
+            self.stmc[colcurr + 'dir'] = pd.Categorical.from_codes(np.where(ab, pairAB, pairBA), categories=pairlabels)
 
-            # Make a direction label using the region pair label. Flip the region pair label if PAC was stronger in the BA direction.
-            self.stmc[colcurr + 'dir'] = [pair if ab_ else '{}-{}'.format(pair.split('-')[1], pair.split('-')[0]) for pair, ab_ in zip(regionpair, ab)]
-    
     def _calculate_deltas(self):
-        timewins = ['early', 'late']
+        """ Calculate the change of each feature from the pre-stimulus window, for features that were loaded. """
+
+        timewins = DELTA_TIMEWINS
 
         for feature in ['theta', 'hfa', 'slope', 'rawpac']:
             for timewin in timewins:
                 colcurr = '{}{}'.format(timewin, feature)
                 baseline = 'pre{}'.format(feature)
+                if colcurr not in self.stsc or baseline not in self.stsc:
+                    continue
                 self.stsc[colcurr + 'delta'] = self.stsc[colcurr] - self.stsc[baseline]
 
         for timewin in timewins:
             colcurr = '{}rawpac'.format(timewin)
-            baseline = [ab if aborba else ba for aborba, ab, ba in zip(self.stmc[colcurr + 'ABorBA'], self.stmc['prerawpacAB'], self.stmc['prerawpacBA'])]
+            baseline = np.where(self.stmc[colcurr + 'ABorBA'], self.stmc['prerawpacAB'], self.stmc['prerawpacBA'])
             self.stmc[colcurr + 'delta'] = self.stmc[colcurr] - baseline
 
+def _build_subject(subject, variants, kwargs):
+    """ Build all variants for one subject. """
+
+    return KahData.build_variants(variants, subject=subject, **kwargs)
+
+def _init_worker(csvpath, cachepath):
+    """ Use the same data directories in worker processes as in the main process. """
+
+    KahData.set_csvpath(csvpath, cachepath)
 
+def build_subjects(subjects, variants, n_jobs=1, verbose=False, **kwargs):
+    """ Create KahData() objects for each subject and variant, optionally over several processes.
 
+    Parameters
+    ----------
+    subjects : list of strings
+        Subjects to build data for.
+    variants : dict of dicts
+        Exclusion inputs for each variant, keyed by variant name. See KahData.build_variants().
+    n_jobs : int, optional
+        Number of processes to use. default: 1
+    verbose : boolean, optional
+        Print each subject once it is built. default: False
+    **kwargs
+        Other inputs to KahData(), shared by all subjects and variants.
+
+    Returns
+    -------
+    data : dict of lists of KahData() objects
+        One list per variant, keyed by variant name, with one object per subject in the order of subjects.
+    """
 
+    build = partial(_build_subject, variants=variants, kwargs=kwargs)
+    subject_data = []
+    if n_jobs == 1:
+        for subject in subjects:
+            subject_data.append(build(subject))
+            if verbose:
+                print(subject)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(KahData.csvpath, KahData.cachepath)) as executor:
+            # Results arrive in the order of subjects, so progress is reported from the main process.
+            for subject, subjdata in zip(subjects, executor.map(build, subjects)):
+                subject_data.append(subjdata)
+                if verbose:
+                    print(subject)
+
+    return {name:[subjdata[name] for subjdata in subject_data] for name in variants}
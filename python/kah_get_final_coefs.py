@@ -2,40 +2,41 @@
 
 import numpy as np
 import pickle
-from kah_save_subject_data import SUBJECT_FILES
+from kah_save_subject_data import SUBJECT_STORES
+from kah_store import load_predictors
 from kah_classifier import KahClassifier, PREDICTORS_ALL
 from kah_data import SUBJECTS
 from scipy import stats
 
+# Top three predictors of the step-forward search.
+PREDICTORS_TOP3 = [('posthfa', 'T'), ('posthfa', 'F'), ('normtspacmax', 'TF')]
+
 def get_final_coefs(subj_type, predictors, filename):  
     """ Classify data using given subject data and desired predictors and get model coefficients with same C across subjects. """
 
-    # Load data.
-    with open(SUBJECT_FILES[subj_type[0]], 'rb') as file:
-        subjects = pickle.load(file) 
-        if subj_type[1]:
-            subjects = [subj for subj in subjects if subj.subject in subj_type[1]]
+    # Load data, aggregating any predictors that are not cached yet.
+    subjects = load_predictors(SUBJECT_STORES[subj_type[0]], subjects=subj_type[1], predictors=predictors)
     
-    # Per subject, fit Logistic Regression models using various values of C. 
+    # Per subject, fit Logistic Regression models on all data using various values of C. 
     # Save the C value associated with highest CV performance.
     C_best = np.empty(len(subjects))
+    classifiers = []
 
     for isubj in range(len(subjects)):    
         print(subjects[isubj].subject)
     
         clf = KahClassifier(predictors=predictors)
-        clf.classify(subjects[isubj], 'logistic', hyperparameters=None)
-        C_best[isubj] = clf.final_estimator_.C_
+        C_best[isubj] = clf.fit_final(subjects[isubj], 'logistic', hyperparameters=None).C_[0]
+        classifiers.append(clf)
 
     # Get the most common C value across subjects.
     C_mode = stats.mode(C_best).mode
 
-    # Refit models using the common C and save the coefficients.
+    # Refit models using only the common C and save the coefficients. Predictors are already aggregated.
     coefs = np.empty([len(subjects), len(predictors)])
 
-    for isubj in range(len(subjects)):
-        clf.classify(subjects[isubj], 'logistic', hyperparameters={'C':[C_mode]})
-        coefs[isubj, :] = clf.final_estimator_.coef_
+    for isubj, clf in enumerate(classifiers):
+        coefs[isubj, :] = clf.fit_final(subjects[isubj], 'logistic', hyperparameters={'C':[C_mode]}, need_aggregate=False).coef_
 
     # Save to disk.
     kah = {'C_best':C_best, 'C_mode':C_mode, 'coefs':coefs, 'subject_id':subj_type[1], 'predictors':predictors}
@@ -51,7 +52,7 @@ if __name__ == "__main__":
 
     # Tuple format is (data type, subjects to include)
     subj_type = ('theta', good_auc)
-    predictors = [('posthfa', 'T'), ('posthfa', 'F'), ('normtspacmax', 'TF')]
+    predictors = PREDICTORS_TOP3
     filename = 'kah_theta_classifiableonly_predictors_top3_coefs.pickle'
 
     get_final_coefs(subj_type, predictors, filename)
\ No newline at end of file
@@ -0,0 +1,71 @@
+""" Original row-by-row implementations of KahData() steps that have since been vectorized, as a reference for tests and
+benchmarks.
+"""
+
+import numpy as np
+from kah_data import KahData, DATASETS, REGIONS, CHANNELS, THETAS, SINGLECHAN, MULTICHAN
+
+class LegacyKahData(KahData):
+    """ KahData() with the original row-by-row implementations. """
+
+    def _set_region(self):
+        if self.include_regions:
+            for idata, dataset in enumerate(DATASETS):
+                for region in REGIONS[idata]:
+                    datacurr = getattr(self, dataset)
+                    rows_keep = np.array([True if region_ in self.include_regions else False for region_ in datacurr[region]])
+                    setattr(self, dataset, datacurr.iloc[rows_keep, :])
+
+    def _set_theta(self):
+        if self.theta_threshtype == 'pval':
+            thetachan = self.sc[self.sc['pvalposttheta'] < self.theta_threshlevel]['channel']
+        elif self.theta_threshtype == 'percent':
+            thetachan = []
+            for chan in self.sc['channel']:
+                ntheta_trial = np.sum(self.stsc[self.stsc['channel'] == chan]['posttheta'] > 0)
+                thetachan.append((ntheta_trial / len(self.stsc['trial'].unique())) > self.theta_threshlevel)
+            thetachan = self.sc[thetachan]['channel']
+        elif self.theta_threshtype == 'bump':
+            thetachan = self.sc[self.sc['thetabump'] == 1]['channel']
+
+        for idata, dataset in enumerate(DATASETS):
+            for theta, channel in zip(THETAS[idata], CHANNELS[idata]):
+                getattr(self, dataset)[theta] = [1 if chan in list(thetachan) else 0 for chan in getattr(self, dataset)[channel]]
+
+        if self.enforce_theta or self.exclude_theta:
+            if self.exclude_theta:
+                targets = [0, 0]
+            elif self.enforce_theta:
+                targets = [1, 2]
+
+            for single in SINGLECHAN:
+                datacurr = getattr(self, single)
+                setattr(self, single, datacurr[datacurr['thetachan'] == targets[0]])
+
+            for multi in MULTICHAN:
+                datacurr = getattr(self, multi)
+                setattr(self, multi, datacurr[datacurr['thetachanA'] + datacurr['thetachanB'] == targets[1]])
+
+    def _set_betweenpac(self):
+        timewins = ['pre', 'early', 'late']
+        for timewin in timewins:
+            colcurr = '{}rawpac'.format(timewin)
+            self.stmc[colcurr] = np.maximum(self.stmc[colcurr + 'AB'], self.stmc[colcurr + 'BA'])
+            ab = self.stmc[colcurr + 'AB'] > self.stmc[colcurr + 'BA']
+            self.stmc[colcurr + 'ABorBA'] = ab
+            regionpair = ['{}-{}'.format(regionA, regionB) for regionA, regionB in zip(self.stmc['regionA'], self.stmc['regionB'])]
+            self.stmc[colcurr + 'dir'] = [pair if ab_ else '{}-{}'.format(pair.split('-')[1], pair.split('-')[0]) for pair, ab_ in zip(regionpair, ab)]
+
+    def _calculate_deltas(self):
+        timewins = ['early', 'late']
+
+        for feature in ['theta', 'hfa', 'slope', 'rawpac']:
+            for timewin in timewins:
+                colcurr = '{}{}'.format(timewin, feature)
+                baseline = 'pre{}'.format(feature)
+                self.stsc[colcurr + 'delta'] = self.stsc[colcurr] - self.stsc[baseline]
+
+        for timewin in timewins:
+            colcurr = '{}rawpac'.format(timewin)
+            baseline = [ab if aborba else ba for aborba, ab, ba in zip(self.stmc[colcurr + 'ABorBA'], self.stmc['prerawpacAB'], self.stmc['prerawpacBA'])]
+            self.stmc[colcurr + 'delta'] = self.stmc[colcurr] - baseline
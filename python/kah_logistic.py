@@ -0,0 +1,207 @@
+""" Batched L2-penalized logistic regression, for fitting many small classification problems in one vectorized call.
+
+Solves the same problem as sklearn's LogisticRegression(penalty='l2', solver='liblinear', class_weight='balanced'):
+
+    min_w  0.5 * ||w||^2 + C * sum_i weight_i * log(1 + exp(-t_i * w.x_i))
+
+where t_i is -1 or 1, x_i includes a constant 1 for the intercept, and the intercept is penalized like the coefficients.
+Problems are solved with Newton's method, batched over any leading dimensions.
+"""
+
+import numpy as np
+from scipy.special import expit
+from kah_classifier import rank_auc, stratified_folds
+
+# Newton iterations stop when all steps are smaller than this.
+TOL = 1e-10
+MAX_ITER = 100
+
+def balanced_weights(y):
+    """ Get per-trial weights that balance classes, as with class_weight='balanced'. y is (..., ntrial) of 0 and 1. """
+
+    y = np.asarray(y, dtype=bool)
+    npos = y.sum(axis=-1, keepdims=True)
+    nneg = y.shape[-1] - npos
+
+    return np.where(y, y.shape[-1] / (2 * npos), y.shape[-1] / (2 * nneg))
+
+def fit_logistic_l2(X, y, weights, C, max_iter=MAX_ITER, tol=TOL):
+    """ Fit a batch of L2-penalized logistic regression problems.
+
+    Parameters
+    ----------
+    X : (..., ntrial, npred) array
+        Predictor values. Leading dimensions are broadcast against y, weights, and C.
+    y : (..., ntrial) array
+        Labels, 0 or 1.
+    weights : (..., ntrial) array
+        Weight of each trial. Trials with zero weight are left out of the fit.
+    C : (...) array
+        Inverse of regularization strength.
+    max_iter : int, optional
+        Maximum number of Newton iterations. default: 100
+    tol : float, optional
+        Stop once every coefficient changes by less than this. default: 1e-10
+
+    Returns
+    -------
+    coef : (..., npred) array
+        Coefficients.
+    intercept : (...) array
+        Intercepts.
+    """
+
+    # Append a constant predictor for the intercept.
+    X = np.concatenate([X, np.ones(X.shape[:-1] + (1,))], axis=-1)
+    y = np.asarray(y, dtype=float)
+    Cw = np.asarray(C, dtype=float)[..., None] * weights # per-trial penalty weight
+    batch = np.broadcast_shapes(X.shape[:-2], y.shape[:-1], Cw.shape[:-1])
+    Xt = np.swapaxes(X, -1, -2)
+    eye = np.eye(X.shape[-1])
+
+    def objective(w, z):
+        return 0.5 * np.sum(w ** 2, axis=-1) + np.sum(Cw * (np.logaddexp(0, z) - y * z), axis=-1)
+
+    w = np.zeros(batch + (X.shape[-1],))
+    z = np.zeros(batch + (X.shape[-2],))
+    for _ in range(max_iter):
+        # Newton step.
+        prob = expit(z)
+        grad = w + (Xt @ (Cw * (prob - y))[..., None])[..., 0]
+        hess = Xt @ (X * (Cw * prob * (1 - prob))[..., None]) + eye
+        step = np.linalg.solve(hess, grad[..., None])[..., 0]
+
+        # Halve steps that do not decrease the objective.
+        fcurr = objective(w, z)
+        scale = np.ones(batch)
+        for _ in range(30):
+            wnew = w - scale[..., None] * step
+            znew = (X @ wnew[..., None])[..., 0]
+            worse = objective(wnew, znew) > fcurr + 1e-12 * np.abs(fcurr)
+            if not np.any(worse):
+                break
+            scale = np.where(worse, scale / 2, scale)
+
+        w, z = wnew, znew
+        if np.max(np.abs(scale[..., None] * step), initial=0) < tol:
+            break
+
+    return w[..., :-1], w[..., -1]
+
+def cv_logistic_l2(Xtrain, ytrain, folds, Cs):
+    """ Choose C by cross-validated AUC and refit with the best C, for a batch of training sets.
+
+    This is the procedure of LogisticRegressionCV(scoring='roc_auc', refit=True) with the liblinear solver: class weights
+    are balanced over each whole training set, all folds and values of C are fit, the C with highest mean AUC across folds
+    is chosen, and the model is refit to the whole training set with that C.
+
+    Parameters
+    ----------
+    Xtrain : (nset, ntrial, npred) array
+        Predictor values of each training set.
+    ytrain : (nset, ntrial) array
+        Labels of each training set, 0 or 1.
+    folds : (nset, ntrial) array
+        Cross-validation fold of each trial, from 0 to nfold - 1.
+    Cs : 1D array
+        Values of C to try.
+
+    Returns
+    -------
+    coef : (nset, npred) array
+        Coefficients refit with the best C.
+    intercept : (nset) array
+        Intercepts refit with the best C.
+    C_best : (nset) array
+        Best C for each training set.
+    scores : (nset, nfold, nC) array
+        AUC of each fold's held-out trials for each C.
+    """
+
+    Cs = np.asarray(Cs, dtype=float)
+    nset, ntrial = ytrain.shape
+    nfold = folds.max() + 1
+    weights = balanced_weights(ytrain)
+
+    # Fit every fold and C at once. Dimensions are set x fold x C x trial.
+    infold = folds[:, :, None] == np.arange(nfold)[None, None, :] # set x trial x fold
+    foldweights = (weights[:, :, None] * ~infold).transpose(0, 2, 1)[:, :, None, :]
+    coef, intercept = fit_logistic_l2(Xtrain[:, None, None], ytrain[:, None, None], foldweights, Cs[None, None, :])
+    decision = (Xtrain[:, None, None] @ coef[..., None])[..., 0] + intercept[..., None]
+
+    # Score each fold on its held-out trials.
+    scores = np.empty([nset, nfold, len(Cs)])
+    for ifold in range(nfold):
+        for iset in range(nset):
+            heldout = infold[iset, :, ifold]
+            scores[iset, ifold] = rank_auc(decision[iset, ifold][:, heldout], ytrain[iset, heldout])
+
+    # Refit all training data with the best C (first best, as in sklearn).
+    C_best = Cs[np.argmax(scores.sum(axis=1), axis=1)]
+    coef, intercept = fit_logistic_l2(Xtrain, ytrain, weights, C_best)
+
+    return coef, intercept, C_best, scores
+
+class LogisticL2CV:
+    """ Drop-in for LogisticRegressionCV(penalty='l2', solver='liblinear', class_weight='balanced', scoring='roc_auc'), fit with
+    the batched NumPy solver.
+
+    Parameters
+    ----------
+    Cs : int or list of floats, optional
+        Values of C to try, or the number of values on a log scale between 1e-4 and 1e4. default: 10
+    cv : int, optional
+        Number of stratified folds. default: 5
+
+    Attributes
+    ----------
+    coef_ : 1 x npred array
+        Coefficients refit to all data with the best C.
+    intercept_ : 1D array
+        Intercept refit to all data with the best C.
+    C_ : 1D array
+        Best C.
+    Cs_ : 1D array
+        Values of C tried.
+    scores_ : nfold x nC array
+        AUC of each fold's held-out trials for each C. None if only one C was given.
+    """
+
+    def __init__(self, Cs=10, cv=5):
+        """ Initialize LogisticL2CV object. """
+
+        self.Cs = Cs
+        self.cv = cv
+
+    def fit(self, X, y):
+        """ Fit the model to predictors X (ntrial x npred) and labels y. """
+
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.Cs_ = np.logspace(-4, 4, self.Cs) if np.ndim(self.Cs) == 0 else np.asarray(self.Cs, dtype=float)
+        self.classes_ = np.array([0., 1.])
+
+        # A single C needs no cross-validation.
+        if len(self.Cs_) == 1:
+            coef, intercept = fit_logistic_l2(X, y, balanced_weights(y), self.Cs_[0])
+            self.coef_, self.intercept_, self.C_, self.scores_ = coef[None], np.array([intercept]), self.Cs_, None
+            return self
+
+        coef, intercept, C_best, scores = cv_logistic_l2(X[None], y[None], stratified_folds(y[None], self.cv), self.Cs_)
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.C_ = C_best
+        self.scores_ = scores[0]
+
+        return self
+
+    def decision_function(self, X):
+        """ Get the decision value of each trial. """
+
+        return np.asarray(X, dtype=float) @ self.coef_[0] + self.intercept_[0]
+
+    def predict_proba(self, X):
+        """ Get probability of forgotten (column 0) and remembered (column 1) for each trial. """
+
+        prob = expit(self.decision_function(X))
+        return np.column_stack([1 - prob, prob])
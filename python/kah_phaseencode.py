@@ -0,0 +1,312 @@
+""" Phase encoding of Kahana data: whether theta phase, or the phase difference between two channels, predicts trial outcome.
+
+Follows kah_calculatephaseencode.m and kah_getphaseencoding.m. Circular statistics of remembered and forgotten trials are
+computed at every sample, for every channel and channel pair, and phase-encoding episodes are runs of samples where the
+channel pair's phase difference predicts outcome. The statistics match circ_corrcl(), circ_wwtest(), and circ_cmtest()
+of the CircStat toolbox.
+
+Statistics are computed for many trial labelings at once, the observed outcomes and any number of permutations, as
+matrix products of the phase data with the labels. Samples are processed in chunks, and the channels and pairs of each
+chunk in blocks sized so that no intermediate array is larger than a memory budget, however many pairs, trials, or
+permutations there are.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from kah_tspac import pair_indices
+
+# Circular statistics available, and the name of each one's test statistic.
+TESTTYPES = {'corrcl':'rho', 'wwtest':'F', 'cmtest':'P'}
+
+# Number of samples to compute statistics for at a time.
+CHUNKSIZE = 50
+
+# Largest intermediate array when computing statistics, in bytes.
+MAXBYTES = 2**24
+
+def _corr(x, y):
+    """ Pearson correlation along the last axis of x with each row of y. Returns an array of shape x.shape[:-1] + (len(y),). """
+
+    xdev = x - x.mean(axis=-1, keepdims=True)
+    ydev = y - y.mean(axis=-1, keepdims=True)
+
+    return (xdev @ ydev.T) / np.sqrt(np.sum(xdev ** 2, axis=-1, keepdims=True) * np.sum(ydev ** 2, axis=-1))
+
+def circ_corrcl(phase, labels):
+    """ Circular-linear correlation of phase with each labeling of trials.
+
+    Parameters
+    ----------
+    phase : array
+        Phase, with trials along the last axis.
+    labels : 'labelings x trials' array
+        Trial outcomes (0 or 1) of each labeling.
+
+    Returns
+    -------
+    rho : array
+        Correlation, shaped phase.shape[:-1] + (labelings,).
+    pval : array
+        Parametric p-value of each correlation.
+    """
+
+    labels = np.asarray(labels, dtype=float)
+    sinphase, cosphase = np.sin(phase), np.cos(phase)
+    rxs = _corr(sinphase, labels)
+    rxc = _corr(cosphase, labels)
+
+    # Correlation of sine and cosine, per series.
+    sindev = sinphase - sinphase.mean(axis=-1, keepdims=True)
+    cosdev = cosphase - cosphase.mean(axis=-1, keepdims=True)
+    rcs = np.sum(sindev * cosdev, axis=-1, keepdims=True) / np.sqrt(np.sum(sindev ** 2, axis=-1, keepdims=True) * np.sum(cosdev ** 2, axis=-1, keepdims=True))
+
+    rho = np.sqrt((rxc ** 2 + rxs ** 2 - 2 * rxc * rxs * rcs) / (1 - rcs ** 2))
+
+    return rho, stats.chi2.sf(phase.shape[-1] * rho ** 2, 2)
+
+def circ_kappa(r):
+    """ Approximate concentration of a von Mises distribution from a mean resultant length, as circ_kappa() of a scalar. """
+
+    return np.where(r < 0.53, 2 * r + r ** 3 + 5 * r ** 5 / 6,
+                    np.where(r < 0.85, -0.4 + 1.39 * r + 0.43 / (1 - r), 1 / (r ** 3 - 4 * r ** 2 + 3 * r)))
+
+def circ_wwtest(phase, labels):
+    """ Watson-Williams test (circular one-way ANOVA) for a difference in mean phase between the two groups of trials of
+    each labeling. Returns the F statistic and its p-value, shaped as in circ_corrcl().
+    """
+
+    labels = np.asarray(labels, dtype=float)
+    ntrial = phase.shape[-1]
+    cosphase, sinphase = np.cos(phase), np.sin(phase)
+
+    # Resultant lengths of both groups and of all trials.
+    n1 = labels.sum(axis=-1)
+    n2 = ntrial - n1
+    cos1, sin1 = cosphase @ labels.T, sinphase @ labels.T
+    cosall, sinall = cosphase.sum(axis=-1, keepdims=True), sinphase.sum(axis=-1, keepdims=True)
+    resultant1 = np.hypot(cos1, sin1)
+    resultant2 = np.hypot(cosall - cos1, sinall - sin1)
+    resultant = np.hypot(cosall, sinall)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = 1 + 3 / (8 * circ_kappa((resultant1 + resultant2) / ntrial))
+        F = beta * (ntrial - 2) * (resultant1 + resultant2 - resultant) / (ntrial - (resultant1 + resultant2))
+
+    return F, stats.f.sf(F, 1, ntrial - 2)
+
+def circ_median(phase):
+    """ Circular median along the last axis, as circ_median(). Compares every pair of trials, so use on small chunks.
+
+    Several trials can balance the trials on either side, so as in circ_median() the first in trial order is used.
+    """
+
+    phase = np.mod(phase, 2 * np.pi)
+    ntrial = phase.shape[-1]
+
+    # Count trials on either side of each trial.
+    dist = np.angle(np.exp(1j * (phase[..., :, None] - phase[..., None, :])))
+    dm = np.abs(np.sum(dist >= 0, axis=-2) - np.sum(dist <= 0, axis=-2))
+
+    # The median is the trial with balanced sides, or the mean of the first two such trials if there are an even number.
+    if ntrial % 2 == 1:
+        median = np.angle(np.exp(1j * np.take_along_axis(phase, np.argmin(dm, axis=-1)[..., None], axis=-1)[..., 0]))
+    else:
+        first = np.argsort(dm, axis=-1, kind='stable')[..., :2]
+        candidates = np.take_along_axis(phase, first, axis=-1)
+        both = np.take_along_axis(dm, first[..., 1:], axis=-1)[..., 0] == dm.min(axis=-1)
+        median = np.angle(np.exp(1j * candidates[..., 0]) + both * np.exp(1j * candidates[..., 1]))
+
+    # Take the opposite direction if it is closer to the mean.
+    mean = np.angle(np.sum(np.exp(1j * phase), axis=-1))
+    flip = np.abs(np.angle(np.exp(1j * (mean - median)))) > np.abs(np.angle(np.exp(1j * (mean - median - np.pi))))
+
+    return np.where(flip, np.mod(median + np.pi, 2 * np.pi), median)
+
+def circ_cmtest(phase, labels):
+    """ Circular median test for a difference in median phase between the two groups of trials of each labeling. Returns
+    the P statistic and its p-value, shaped as in circ_corrcl().
+
+    The median of all trials is taken in the given trial order, which circ_cmtest() sets to the trials of the first
+    group followed by those of the second. Put trials in that order to match circ_cmtest() exactly.
+    """
+
+    labels = np.asarray(labels, dtype=float)
+    ntrial = phase.shape[-1]
+
+    # The median of all trials does not depend on labels, so it is computed once. Loop over leading dimensions to bound
+    # memory of the pairwise comparisons.
+    median = np.empty(phase.shape[:-1])
+    for index in np.ndindex(phase.shape[:-2]):
+        median[index] = circ_median(phase[index])
+
+    # Count trials below the median in each group.
+    below = (np.angle(np.exp(1j * (phase - median[..., None]))) < 0).astype(float)
+    m1 = below @ labels.T
+    nbelow = below.sum(axis=-1, keepdims=True)
+    m2 = nbelow - m1
+    n1 = labels.sum(axis=-1)
+    n2 = ntrial - n1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        P = ntrial ** 2 / (nbelow * (ntrial - nbelow)) * (m1 ** 2 / n1 + m2 ** 2 / n2) - ntrial * nbelow / (ntrial - nbelow)
+
+    return P, stats.chi2.sf(P, 1)
+
+def phase_encoding_stats(phase, outcome, testtype='corrcl', nperm=0, seed=0, chunksize=CHUNKSIZE, maxbytes=MAXBYTES):
+    """ Compute phase-encoding statistics at every sample, for every channel and channel pair.
+
+    Parameters
+    ----------
+    phase : 'channels x times x trials' array
+        Theta phase. Can be memory-mapped, and is read a chunk of samples at a time.
+    outcome : 1D array
+        Outcome (remembered or not) of each trial.
+    testtype : string, optional
+        'corrcl' (circular-linear correlation), 'wwtest' (Watson-Williams test), or 'cmtest' (circular median test).
+        default: 'corrcl'
+    nperm : int, optional
+        Number of trial permutations for permutation p-values. default: 0 (parametric p-values only)
+    seed : int, optional
+        Random state seed for permutations. default: 0
+    chunksize : int, optional
+        Largest number of samples to compute at a time. default: 50
+    maxbytes : int, optional
+        Largest size of an intermediate array, in bytes. Channels and pairs are computed in blocks of this size, and
+        fewer samples are computed at a time if needed. default: 2**24 (16 MB)
+
+    Returns
+    -------
+    results : dict of arrays
+        'statchan' and 'pvalchan' ('channels x times'), for the phase of each channel, and 'statpair' and 'pvalpair'
+        ('pairs x times'), for the phase difference (A - B) of each pair in the order of kah_tspac.pair_indices(). With
+        permutations, also 'permpvalchan' and 'permpvalpair', the fraction of permutations with at least as large a
+        statistic, counting the observed outcomes as one permutation.
+
+    Notes
+    -----
+    Each test holds up to about eight intermediate arrays of up to maxbytes at once, in addition to the output arrays and
+    the phase of all channels for one chunk of samples.
+    """
+
+    if testtype not in TESTTYPES:
+        raise ValueError('Test type is not recognized.')
+    test = {'corrcl':circ_corrcl, 'wwtest':circ_wwtest, 'cmtest':circ_cmtest}[testtype]
+
+    # Label trials with the observed outcomes, then with each permutation. Trials are ordered remembered first, as
+    # circ_wwtest() and circ_cmtest() order them, which only matters for ties in the circular median.
+    outcome = np.asarray(outcome).astype(bool)
+    order = np.concatenate([np.flatnonzero(outcome), np.flatnonzero(~outcome)])
+    rng = np.random.RandomState(seed)
+    labels = np.array([outcome] + [rng.permutation(outcome) for _ in range(nperm)])[:, order]
+
+    nchan, nsamp, ntrial = phase.shape
+    chanA, chanB = pair_indices(nchan)
+
+    # Intermediate arrays are 'series x samples x trials' or 'series x samples x labelings', and the circular median
+    # compares every pair of trials of one series at a time.
+    width = max(ntrial, len(labels))
+    if testtype == 'cmtest':
+        chunksize = min(chunksize, max(1, maxbytes // (8 * ntrial ** 2)))
+    chunksize = min(chunksize, max(1, maxbytes // (8 * width)))
+    blocksize = max(1, maxbytes // (8 * chunksize * width))
+
+    results = {'statchan':np.empty([nchan, nsamp]), 'pvalchan':np.empty([nchan, nsamp]),
+               'statpair':np.empty([len(chanA), nsamp]), 'pvalpair':np.empty([len(chanA), nsamp])}
+    if nperm:
+        results['permpvalchan'] = np.empty([nchan, nsamp])
+        results['permpvalpair'] = np.empty([len(chanA), nsamp])
+
+    for start in range(0, nsamp, chunksize):
+        chunk = slice(start, min(start + chunksize, nsamp))
+        phasechunk = np.asarray(phase[:, chunk])[..., order]
+
+        # Channels, then pairs, a block at a time.
+        for series, nseries in [('chan', nchan), ('pair', len(chanA))]:
+            for bstart in range(0, nseries, blocksize):
+                block = slice(bstart, bstart + blocksize)
+                if series == 'chan':
+                    phaseseries = phasechunk[block]
+                else:
+                    phaseseries = phasechunk[chanA[block]] - phasechunk[chanB[block]]
+
+                stat, pval = test(phaseseries, labels)
+                results['stat' + series][block, chunk] = stat[..., 0]
+                results['pval' + series][block, chunk] = pval[..., 0]
+                if nperm:
+                    results['permpval' + series][block, chunk] = np.sum(stat >= stat[..., :1], axis=-1) / (nperm + 1)
+
+    return results
+
+def _get_episodes(thresh):
+    """ Get 0-based [start, end] samples (inclusive) of runs of True, as in util_getepisode(). """
+
+    edges = np.diff(np.concatenate([[0], thresh.astype(np.int8), [0]]))
+
+    return np.stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1], axis=-1)
+
+def encoding_episodes(results, times, sampthresh, statthreshtype='pvalue', timeoi=(0, 1.6), episodetype='all'):
+    """ Find phase-encoding episodes of each channel pair, and summarize them as in kah_getphaseencoding.m.
+
+    Parameters
+    ----------
+    results : dict of arrays
+        Output of phase_encoding_stats().
+    times : 1D array
+        Time of each sample, in seconds.
+    sampthresh : float
+        Episodes must be longer than this number of samples. For example, a quarter theta cycle is fs / thetacf * 0.25.
+    statthreshtype : string, optional
+        'pvalue' (parametric p-value of the pair < 0.05), 'permutation' (permutation p-value of the pair < 0.05), or
+        'relative' (squared statistic of the pair larger than that of either channel alone). default: 'pvalue'
+    timeoi : list of two floats, optional
+        Episodes must start after and end before these times, in seconds. default: (0, 1.6)
+    episodetype : string, optional
+        Which episodes to keep: 'all', 'first', 'longest', or 'strongest'. default: 'all'
+
+    Returns
+    -------
+    episodes : Pandas Dataframe
+        One row per pair, with 1-based 'pair', 'encodingonset' (start of the first episode), 'encodinglength' (total
+        duration of episodes), 'encodingstrength' (mean squared statistic over episodes), and 'encodingepisodes' (number
+        of episodes), as in the multi-channel data set.
+    """
+
+    chanA, chanB = pair_indices(results['statchan'].shape[0])
+    statpair = results['statpair']
+    if statthreshtype == 'pvalue':
+        thresh = results['pvalpair'] < 0.05
+    elif statthreshtype == 'permutation':
+        thresh = results['permpvalpair'] < 0.05
+    elif statthreshtype == 'relative':
+        thresh = (statpair ** 2 > results['statchan'][chanA] ** 2) & (statpair ** 2 > results['statchan'][chanB] ** 2)
+    else:
+        raise ValueError('Threshold type not recognized for detecting phase encoding.')
+
+    rows = []
+    for ipair in range(len(chanA)):
+        # Keep episodes long enough, and within the time window of interest.
+        episodes = _get_episodes(thresh[ipair])
+        episodes = episodes[np.diff(episodes, axis=1)[:, 0] > sampthresh]
+        episodes = episodes[(times[episodes[:, 0]] > timeoi[0]) & (times[episodes[:, 1]] < timeoi[1])]
+
+        # Choose episodes of interest.
+        if len(episodes) and episodetype != 'all':
+            if episodetype == 'first':
+                keep = 0
+            elif episodetype == 'longest':
+                keep = int(np.argmax(np.diff(episodes, axis=1)[:, 0]))
+            elif episodetype == 'strongest':
+                keep = int(np.argmax([np.mean(statpair[ipair, start:end + 1] ** 2) for start, end in episodes]))
+            else:
+                raise ValueError('Episode type not recognized.')
+            episodes = episodes[keep:keep + 1]
+
+        strength = np.concatenate([statpair[ipair, start:end + 1] ** 2 for start, end in episodes]) if len(episodes) else np.array([])
+        rows.append({'pair':ipair + 1,
+                     'encodingonset':times[episodes[:, 0]].min() if len(episodes) else np.nan,
+                     'encodinglength':np.sum(times[episodes[:, 1]] - times[episodes[:, 0]]),
+                     'encodingstrength':strength.mean() if len(strength) else np.nan,
+                     'encodingepisodes':len(episodes)})
+
+    return pd.DataFrame(rows)
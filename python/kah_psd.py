@@ -0,0 +1,251 @@
+""" Reading Kahana PSDs from .mat files one block of channels at a time, and saving FOOOF output as dense arrays.
+
+PSDs saved by MATLAB with -v7.3 are HDF5 files, which are read lazily with h5py so that only the requested channels are
+loaded. Older .mat files cannot be read partially, so they are loaded whole and blocks are sliced from memory.
+
+FOOOF output is saved as numeric arrays, with NaN for failed fits and peak parameters padded to a fixed number of peaks.
+Each array is written to a .mat file for MATLAB, and to a .npy file in a folder of the same name for memory-mapping.
+Output can be tagged with a key that hashes the input PSD file and the fit settings, so that reruns skip outputs whose
+inputs and settings are unchanged. The hash of each PSD file is recorded next to it, and only recomputed when the file's
+size or modification time changes.
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import scipy.io as sio
+
+try:
+    import h5py
+    HAVE_H5PY = True
+except ImportError:
+    HAVE_H5PY = False
+
+# Start of the text header of MATLAB v7.3 files.
+V73_HEADER = b'MATLAB 7.3 MAT-file'
+
+# Fit status codes in FOOOF output.
+FIT_OK = 0
+FIT_FAILED = 1
+
+# File in each FOOOF output folder with the key of its inputs, written after all arrays.
+KEY = 'key.txt'
+
+# File in each FOOOF output folder with the hash of its input PSD file, and the size and modification time it was hashed at.
+SOURCE = 'source.json'
+
+def is_hdf5_mat(path):
+    """ Check whether a .mat file was saved with -v7.3, i.e. as an HDF5 file. """
+
+    with open(path, 'rb') as file:
+        return file.read(len(V73_HEADER)) == V73_HEADER
+
+class PSDFile:
+    """ PSDs of one subject and time window, read one block of channels at a time.
+
+    Parameters
+    ----------
+    path : string
+        Path to a .mat file with 'freq' and 'psds', where PSDs are 'channels x frequencies x trials'.
+
+    Attributes
+    ----------
+    freq : 1D array
+        Frequency of each PSD value.
+    shape : tuple
+        Shape of the PSDs, 'channels x frequencies x trials'.
+    streaming : boolean
+        True if blocks are read from disk as needed, False if the whole file was loaded.
+    """
+
+    def __init__(self, path):
+        """ Open a PSD file, loading only its frequencies if possible. """
+
+        self.path = path
+        self.streaming = is_hdf5_mat(path)
+
+        if self.streaming:
+            if not HAVE_H5PY:
+                raise ImportError('h5py is required to read -v7.3 .mat files.')
+
+            # MATLAB stores arrays column-major, so HDF5 datasets have dimensions reversed.
+            self._file = h5py.File(path, 'r')
+            self._psds = self._file['psds']
+            self.freq = np.squeeze(self._file['freq'][()])
+            self.shape = self._psds.shape[::-1]
+        else:
+            mat_contents = sio.loadmat(path, variable_names=['freq', 'psds'])
+            self._file = None
+            self._psds = mat_contents['psds']
+            self.freq = np.squeeze(mat_contents['freq'])
+            self.shape = self._psds.shape
+
+    def read(self, chans):
+        """ Get PSDs of a contiguous range of channels, as 'channels x frequencies x trials'. """
+
+        if self.streaming:
+            return np.ascontiguousarray(self._psds[:, :, chans.start:chans.stop].transpose(2, 1, 0))
+
+        return self._psds[chans.start:chans.stop]
+
+    def blocks(self, chanblock):
+        """ Get ranges of channels in blocks of up to chanblock channels. """
+
+        return [range(start, min(start + chanblock, self.shape[0])) for start in range(0, self.shape[0], chanblock)]
+
+    def mean_trials(self, chanblock):
+        """ Get the mean PSD across trials per channel, as 'channels x frequencies', reading a block at a time. """
+
+        return np.concatenate([np.mean(self.read(chans), axis=2) for chans in self.blocks(chanblock)])
+
+    def close(self):
+        """ Close the file, if it is open. """
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def pad_peaks(peak_params):
+    """ Pad variable numbers of peaks per channel to a fixed width.
+
+    Parameters
+    ----------
+    peak_params : list of npeak x 3 arrays
+        FOOOF peak_params_ (center frequency, amplitude, bandwidth) per channel. None for failed fits.
+
+    Returns
+    -------
+    peaks : nchan x maxpeak x 3 array
+        Peak parameters per channel, padded with NaN.
+    npeaks : 1D array
+        Number of peaks per channel.
+    """
+
+    npeaks = np.array([0 if params is None else len(params) for params in peak_params], dtype=np.int32)
+    peaks = np.full([len(peak_params), max(npeaks.max(initial=0), 1), 3], np.nan)
+    for ichan, params in enumerate(peak_params):
+        if npeaks[ichan]:
+            peaks[ichan, :npeaks[ichan]] = params
+
+    return peaks, npeaks
+
+def peaks_cell(peaks, npeaks):
+    """ Get the peaks of each channel as an 'npeaks x 3' array, in an object array that scipy.io.savemat() saves as a cell
+    array. Channels without peaks, including failed fits, get an empty '0 x 3' array.
+    """
+
+    cell = np.empty(len(npeaks), dtype=object)
+    for ichan, npeak in enumerate(npeaks):
+        cell[ichan] = np.array(peaks[ichan, :npeak], dtype=float)
+
+    return cell
+
+def file_sha256(path, recordfile=None):
+    """ Get the SHA-256 hash of a file's contents.
+
+    If recordfile is given, the hash is recorded there with the size and modification time it was computed at, and is
+    reused while both are unchanged, so unchanged files are not read again. The record is kept apart from the file, so
+    input data directories are never written to. If the record cannot be written, the hash is still returned.
+    """
+
+    stat = os.stat(path)
+    if recordfile is not None:
+        try:
+            with open(recordfile) as file:
+                record = json.load(file)
+            if record['path'] == os.path.abspath(path) and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+                return record['sha256']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+
+    if recordfile is not None:
+        try:
+            os.makedirs(os.path.dirname(recordfile), exist_ok=True)
+            with open(recordfile + '.tmp', 'w') as file:
+                json.dump({'path':os.path.abspath(path), 'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'sha256':digest.hexdigest()}, file)
+            os.replace(recordfile + '.tmp', recordfile)
+        except OSError:
+            pass
+
+    return digest.hexdigest()
+
+def fooof_key(psd_path, settings, path=None):
+    """ Get a key for FOOOF output, from the contents of the input PSD file and a dict of fit settings.
+
+    The key changes if the PSD file or any setting changes, and not otherwise. If the path of the output is given, the
+    PSD file's hash is recorded in the output's folder, and the PSD file is only read again if its size or modification
+    time changed since (see file_sha256()).
+    """
+
+    recordfile = None if path is None else os.path.join(os.path.splitext(path)[0], SOURCE)
+    digest = hashlib.sha256()
+    digest.update(file_sha256(psd_path, recordfile).encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+    return digest.hexdigest()
+
+def is_cached(path, key):
+    """ Check whether FOOOF output at path was completely saved with the given key. """
+
+    keyfile = os.path.join(os.path.splitext(path)[0], KEY)
+    if not os.path.isfile(keyfile) or not os.path.isfile(path):
+        return False
+
+    with open(keyfile) as file:
+        return file.read().strip() == key
+
+def save_fooof(path, arrays, key=None, mat_arrays=None):
+    """ Save FOOOF output arrays to a .mat file, and as .npy files in a folder with the same name without extension.
+
+    Arrays in mat_arrays, such as cell arrays for MATLAB scripts, are only saved to the .mat file. Each file is written to
+    a temporary file and then renamed, and the key, if given, is written last, so an interrupted save is never mistaken
+    for a complete one by is_cached().
+    """
+
+    # Invalidate any earlier key before replacing the arrays.
+    npydir = os.path.splitext(path)[0]
+    keyfile = os.path.join(npydir, KEY)
+    if os.path.isfile(keyfile):
+        os.remove(keyfile)
+
+    # Arrays for memory-mapping.
+    os.makedirs(npydir, exist_ok=True)
+    for name, values in arrays.items():
+        tmpfile = os.path.join(npydir, name + '.npy.tmp')
+        with open(tmpfile, 'wb') as file:
+            np.save(file, np.asarray(values))
+        os.replace(tmpfile, os.path.join(npydir, name + '.npy'))
+
+    # Arrays for MATLAB.
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as file:
+        sio.savemat(file, {**arrays, **(mat_arrays or {})})
+    os.replace(tmpfile, path)
+
+    if key is not None:
+        with open(keyfile + '.tmp', 'w') as file:
+            file.write(key)
+        os.replace(keyfile + '.tmp', keyfile)
+
+def load_fooof(path, memory_map=True):
+    """ Load FOOOF output arrays saved by save_fooof(), memory-mapping them if possible. """
+
+    npydir = os.path.splitext(path)[0]
+    if os.path.isdir(npydir):
+        return {os.path.splitext(file)[0]:np.load(os.path.join(npydir, file), mmap_mode='r' if memory_map else None)
+                for file in sorted(os.listdir(npydir)) if file.endswith('.npy')}
+
+    mat_contents = sio.loadmat(path)
+    return {name:values for name, values in mat_contents.items() if not name.startswith('__')}
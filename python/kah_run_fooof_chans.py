@@ -1,40 +1,210 @@
-""" Script for FOOOFing Kahana PSDs (average PSD across trials) per channel per subject. """
+""" Script for FOOOFing Kahana PSDs (average PSD across trials) per channel per subject.
 
+Fitting and reporting are separate stages. Fits are saved as parameter arrays along with the mean PSDs they were fit to,
+and reports are rendered afterwards from the saved output, either one FOOOF report per channel or one multi-page summary
+per subject, over a pool of processes.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 from fooof import FOOOF
-import scipy.io as sio
 import numpy as np
 from kah_data import SUBJECTS
+from kah_psd import PSDFile, pad_peaks, peaks_cell, save_fooof, load_fooof, fooof_key, is_cached, FIT_OK, FIT_FAILED
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+    HAVE_MPL = True
+except ImportError:
+    HAVE_MPL = False
+
+# Location of PSDs and FOOOF output, in a folder per subject, and of reports.
+DATAPATH = '/Volumes/DATAHD/Active/KAH/'
+FIGPATH = '/Users/Rogue/Documents/Research/Projects/KAH/figures/'
+
+# Number of channels to read at a time when averaging PSDs across trials, and to render per task.
+CHANBLOCK = 8
+
+# FOOOF settings. Bandlimits [0.5, 4] for [-800, 1600]
+FOOOF_SETTINGS = {'background_mode':'fixed', 'peak_width_limits':[1, 12], 'peak_threshold':1}
+
+# Frequency range over which to model PSD. Use a low frequency range to optimize theta fits.
+# A more broadband range ([2, 50]) includes massive beta that swaps all estimates.
+FREQ_RANGE = [2, 55]
+
+# Rows and columns of channels per page of a summary report.
+SUMMARY_GRID = (4, 4)
+
+def psd_file(subject):
+    """ Get path of a subject's PSDs. """
+
+    return DATAPATH + subject + '/psd/' + subject + '_FR1_psd_-800_1600.mat'
+
+def fooof_file(subject):
+    """ Get path of a subject's FOOOF fits per channel. """
+
+    return DATAPATH + subject + '/fooof/' + subject + '_FR1_fooof_-800_1600_chans_newfooof.mat'
+
+def fit_subject(subject, overwrite=False):
+    """ Fit the mean PSD across trials of each channel of a subject, and save the fit parameters.
+
+    Saves 'peaks' ('channels x peaks x [frequency, amplitude, bandwidth]', padded with NaN past each channel's 'npeaks'),
+    'background' ('channels x [offset, exponent]'), 'r_squared', 'error', and 'status' of each fit, along with 'freq' and
+    the mean 'psds' the fits were made to, for rendering reports later. The .mat file also keeps the 'fooof' cell array of
+    each channel's 'npeaks x 3' peaks read by kah_2_psd_1_calculatetheta_chans.m. Skips subjects already fit with the same
+    PSDs and settings, unless overwrite is True.
+    """
+
+    print(subject)
+    key = fooof_key(psd_file(subject), {'fooof':FOOOF_SETTINGS, 'freq_range':FREQ_RANGE}, fooof_file(subject))
+    if not overwrite and is_cached(fooof_file(subject), key):
+        print('Skipping, already fit.')
+        return
+
+    # Load frequency axis and mean power spectra across trials, as 'channels x frequencies', a block of channels at a time.
+    with PSDFile(psd_file(subject)) as psdfile:
+        freq = psdfile.freq
+        psds = psdfile.mean_trials(CHANBLOCK)
+
+    # Initialize FOOOF model.
+    foof_model = FOOOF(**FOOOF_SETTINGS)
+
+    # Initialize output (FOOOF parameters and fit status), one for each channel.
+    nchan = psds.shape[0]
+    peak_params = [None] * nchan
+    background = np.full([nchan, 2], np.nan)
+    r_squared = np.full(nchan, np.nan)
+    error = np.full(nchan, np.nan)
+    status = np.full(nchan, FIT_FAILED, dtype=np.int8)
+
+    # Fit model per channel using the mean PSD across trials.
+    for ichan in range(nchan):
+        try:
+            foof_model.fit(freq, psds[ichan, :], FREQ_RANGE)
+        except Exception:
+            print('Skipping channel {}'.format(ichan))
+            continue
+        peak_params[ichan] = foof_model.peak_params_
+        background[ichan] = foof_model.background_params_
+        r_squared[ichan] = foof_model.r_squared_
+        error[ichan] = foof_model.error_
+        status[ichan] = FIT_OK
+
+    peaks, npeaks = pad_peaks(peak_params)
+    save_fooof(fooof_file(subject), {'peaks':peaks, 'npeaks':npeaks, 'background':background, 'r_squared':r_squared,
+                                     'error':error, 'status':status, 'freq':freq, 'psds':psds}, key,
+               mat_arrays={'fooof':peaks_cell(peaks, npeaks)})
+
+def _render_channels(subject, chans):
+    """ Save a FOOOF report per channel, refitting each channel's saved mean PSD. Returns the number of reports saved. """
+
+    fits = load_fooof(fooof_file(subject))
+    freq = np.squeeze(fits['freq'])
+    foof_model = FOOOF(**FOOOF_SETTINGS)
+
+    figdir = FIGPATH + subject + '/fooof_output/'
+    os.makedirs(figdir, exist_ok=True)
+    for ichan in chans:
+        if fits['status'][ichan] != FIT_OK:
+            continue
+        foof_model.fit(freq, np.asarray(fits['psds'][ichan]), FREQ_RANGE)
+        foof_model.save_report(file_name=figdir + str(ichan))
+        plt.close('all')
+
+    return len(chans)
+
+def _render_summary(subject):
+    """ Save one PDF per subject with the mean PSD, aperiodic fit, and peaks of every channel, several channels per page.
+    Returns the number of channels plotted.
+    """
+
+    fits = load_fooof(fooof_file(subject))
+    freq = np.squeeze(fits['freq'])
+    infreq = (freq >= FREQ_RANGE[0]) & (freq <= FREQ_RANGE[1])
+    nchan = len(fits['status'])
+    perpage = SUMMARY_GRID[0] * SUMMARY_GRID[1]
+
+    figdir = FIGPATH + subject + '/'
+    os.makedirs(figdir, exist_ok=True)
+    with PdfPages(figdir + subject + '_fooof_chans_summary.pdf') as pdf:
+        for start in range(0, nchan, perpage):
+            fig, axes = plt.subplots(*SUMMARY_GRID, figsize=(16, 12), squeeze=False)
+            for ax, ichan in zip(axes.ravel(), range(start, start + perpage)):
+                if ichan >= nchan:
+                    ax.axis('off')
+                    continue
+
+                # Spectrum and aperiodic fit, in log10 power as FOOOF fits them.
+                ax.plot(freq[infreq], np.log10(fits['psds'][ichan][infreq]), 'k', linewidth=1)
+                if fits['status'][ichan] == FIT_OK:
+                    offset, exponent = fits['background'][ichan]
+                    ax.plot(freq[infreq], offset - exponent * np.log10(freq[infreq]), 'b--', linewidth=1)
+                    for center, _, bandwidth in fits['peaks'][ichan][:fits['npeaks'][ichan]]:
+                        ax.axvspan(center - bandwidth / 2, center + bandwidth / 2, color='r', alpha=0.2)
+                    ax.set_title('Channel {}: exp {:.2f}, R2 {:.2f}'.format(ichan, exponent, fits['r_squared'][ichan]), fontsize=8)
+                else:
+                    ax.set_title('Channel {}: fit failed'.format(ichan), fontsize=8)
+                ax.tick_params(labelsize=6)
+
+            fig.tight_layout()
+            pdf.savefig(fig)
+            plt.close(fig)
+
+    return nchan
+
+def render_reports(subjects, summary=True, n_jobs=1, chanblock=CHANBLOCK):
+    """ Render reports of saved FOOOF fits.
+
+    Parameters
+    ----------
+    subjects : list of strings
+        Subjects to render reports for. Subjects must already be fit with fit_subject().
+    summary : boolean, optional
+        Save one multi-page summary PDF per subject. Otherwise, save a FOOOF report per channel. default: True
+    n_jobs : int, optional
+        Number of processes to render over. default: 1
+    chanblock : int, optional
+        Number of channels per task, for reports per channel. default: 8
+    """
+
+    if not HAVE_MPL:
+        raise ImportError('matplotlib is required to render reports.')
+
+    # Split reports into tasks: one per subject for summaries, or one per block of channels.
+    if summary:
+        tasks = [(_render_summary, (subject,)) for subject in subjects]
+    else:
+        tasks = []
+        for subject in subjects:
+            nchan = len(load_fooof(fooof_file(subject))['status'])
+            tasks.extend((_render_channels, (subject, range(start, min(start + chanblock, nchan)))) for start in range(0, nchan, chanblock))
+
+    # Render in this process, or over a pool of processes that is shut down even if a task fails.
+    pool = nullcontext() if n_jobs == 1 else ProcessPoolExecutor(max_workers=n_jobs)
+    with pool as executor:
+        if executor is None:
+            results = (func(*args) for func, args in tasks)
+        else:
+            results = (future.result() for future in as_completed([executor.submit(func, *args) for func, args in tasks]))
+
+        for itask, _ in enumerate(results):
+            print('{}/{} reports rendered'.format(itask + 1, len(tasks)))
 
 if __name__ == "__main__":
+    overwrite = False # refit subjects even if their PSDs and settings are unchanged
+    report = None # None to only fit, 'summary' for a PDF per subject, or 'channels' for a FOOOF report per channel
+    n_jobs = 1
+
     # Find theta peaks and bandwidths for each channel per subject.
     for subject in SUBJECTS:
-        print(subject)
-        
-        # Load data.
-        mat_contents = sio.loadmat('/Volumes/DATAHD/Active/KAH/' + subject + '/psd/' + subject + '_FR1_psd_-800_1600.mat')
-        
-        # Extract frequency axis and power spectra. PSDs are 'channels x frequencies x trials'. 
-        freq = np.squeeze(mat_contents['freq'])
-        psds = mat_contents['psds']
-        
-        # Initialize FOOOF model.
-        # Bandlimits [0.5, 4] for [-800, 1600]
-        foof_model = FOOOF(background_mode='fixed', peak_width_limits=[1, 12], peak_threshold=1)
-
-        # Define frequency range over which to model PSD. Use a low frequency range to optimize theta fits.
-        # A more broadband range ([2, 50]) includes massive beta that swaps all estimates.
-        freq_range = [2, 55]
-            
-        # Initialize output (list of FOOOF oscillation parameters), one for each channel.
-        output = [[] for ichan in range(psds.shape[0])]
-        
-        # Fit model per channel using the mean PSD across trials. 
-        for ichan in range(psds.shape[0]):
-            foof_model.fit(freq, np.mean(psds[ichan, :, :], axis=1), freq_range)
-            foof_model.save_report(file_name='/Users/Rogue/Documents/Research/Projects/KAH/figures/' + subject + '/fooof_output/' + str(ichan))
-            output[ichan] = foof_model.peak_params_
-        
-        # Save to .mat file.
-        sio.savemat('/Volumes/DATAHD/Active/KAH/' + subject + '/fooof/' + subject + '_FR1_fooof_-800_1600_chans_newfooof.mat', {'fooof':output})
+        fit_subject(subject, overwrite=overwrite)
+
+    # Render reports from the saved fits.
+    if report is not None:
+        render_reports(SUBJECTS, summary=(report == 'summary'), n_jobs=n_jobs)
 
     print('Done.')
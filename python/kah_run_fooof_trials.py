@@ -1,64 +1,192 @@
 """ Script for FOOOFing Kahana PSDs per trial per channel per subject. """
 
-from fooof import FOOOF
-import scipy.io as sio
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import numpy as np
+from kah_aperiodic import fit_aperiodic, HAVE_FOOOF
+from kah_psd import PSDFile, save_fooof, fooof_key, is_cached, FIT_OK, FIT_FAILED
+
+if HAVE_FOOOF:
+    from fooof import FOOOF
 
 SUBJECTS = ['R1020J', 'R1032D', 'R1033D', 'R1034D', 'R1045E', 'R1059J', 'R1075J', 'R1080E', 'R1120E', 'R1135E', 'R1142N', 'R1147P', 'R1149N', 'R1151E', 'R1154D', 'R1162N', 'R1166D', 'R1167M', 'R1175N']
 
-def run_fooof_trials(timewin, padlabel):
-    """ Use FOOOF to get individual trial slope and HFA (offset) measurements. """
-    for subject in SUBJECTS:
-        print(subject)
-        
-        # Load data.
-        mat_contents = sio.loadmat('/Volumes/DATAHD/Active/KAH/' + subject + '/psd/' + subject + '_FR1_psd_' + str(timewin[0]) + '_' + str(timewin[1]) + padlabel + '.mat')
-        
-        # Extract frequency axis and power spectra. PSDs are 'channels x frequencies x trials'. 
-        freq = np.squeeze(mat_contents['freq'])
-        psds = mat_contents['psds']
-        
-        # Initialize FOOOF model.
-        foof_model = FOOOF(background_mode='fixed', peak_width_limits=[2.5, 12], peak_threshold=np.inf)
-            
-        # Initialize output (list of FOOOF oscillation parameters), one for each channel and trial.
-        slopes = [[[] for _ in range(psds.shape[-1])] for _ in range(psds.shape[0])]
-        hfa = [[[] for _ in range(psds.shape[-1])] for _ in range(psds.shape[0])]
-        
-        # Fit model per channel per trial.
-        for ichan in range(psds.shape[0]):
-            for itrial in range(psds.shape[-1]):
-                # Fit for slope and HFA.
-                try:
-                    foof_model.fit(freq, psds[ichan, :, itrial], [2, 150])
-                except Exception:
-                    print('Skipping channel {}, trial {} because of slope'.format(ichan, itrial))
-                    continue
-                hfa[ichan][itrial] = foof_model.background_params_[0]
-                slopes[ichan][itrial] = foof_model.background_params_[1]
-
-                # # Fit for HFA.
-                # try:
-                #     foof_model.fit(freq, psds[ichan, :, itrial], [2, 150])
-                # except Exception:
-                #     print('Skipping channel {}, trial {} because of hfa'.format(ichan, itrial))
-                #     continue
-                # hfa[ichan][itrial] = foof_model.background_params_[0]
-        
-        # Save to .mat file.
-        sio.savemat('/Volumes/DATAHD/Active/KAH/' + subject + '/fooof/' + subject + '_FR1_fooof_' + str(timewin[0]) + '_' + str(timewin[1]) + padlabel + '_slopes_hfa.mat', {'slopes':slopes, 'hfa':hfa})
+# Location of PSDs and FOOOF output, in a folder per subject.
+DATAPATH = '/Volumes/DATAHD/Active/KAH/'
+
+# Number of channels to fit per task.
+CHANBLOCK = 8
+
+# FOOOF settings and frequency range to fit. Part of the key of each output, so changing them refits all outputs.
+FOOOF_SETTINGS = {'background_mode':'fixed', 'peak_width_limits':[2.5, 12], 'peak_threshold':np.inf}
+FREQ_RANGE = [2, 150]
+
+# Per-process FOOOF model, created once per worker.
+_WORKER = {}
+
+def psd_file(subject, timewin, padlabel):
+    """ Get path of a subject's PSDs for a time window. """
+
+    return DATAPATH + subject + '/psd/' + subject + '_FR1_psd_' + str(timewin[0]) + '_' + str(timewin[1]) + padlabel + '.mat'
+
+def fooof_file(subject, timewin, padlabel):
+    """ Get path of a subject's slopes and HFA for a time window. """
+
+    return DATAPATH + subject + '/fooof/' + subject + '_FR1_fooof_' + str(timewin[0]) + '_' + str(timewin[1]) + padlabel + '_slopes_hfa.mat'
+
+def _init_worker():
+    """ Initialize one FOOOF model per worker, reused for every fit. """
+
+    _WORKER['fooof'] = FOOOF(**FOOOF_SETTINGS)
+
+def _fit_block(freq, psds, chans):
+    """ Fit a block of channels per trial. PSDs are 'channels x frequencies x trials', or the path of a PSD file to read
+    the block from.
+
+    Returns slopes, HFA, and fit status per channel per trial, as 'channels x trials' arrays, with NaN for failed fits.
+    """
+
+    foof_model = _WORKER['fooof']
+
+    # Read only this block of channels, if PSDs were not passed in.
+    if isinstance(psds, str):
+        with PSDFile(psds) as psdfile:
+            psds = psdfile.read(chans)
+
+    slopes = np.full([psds.shape[0], psds.shape[-1]], np.nan)
+    hfa = np.full([psds.shape[0], psds.shape[-1]], np.nan)
+    status = np.full([psds.shape[0], psds.shape[-1]], FIT_FAILED, dtype=np.int8)
+
+    for ichan in range(psds.shape[0]):
+        for itrial in range(psds.shape[-1]):
+            # Fit for slope and HFA.
+            try:
+                foof_model.fit(freq, psds[ichan, :, itrial], FREQ_RANGE)
+            except Exception:
+                print('Skipping channel {}, trial {} because of slope'.format(chans[ichan], itrial))
+                continue
+            hfa[ichan, itrial] = foof_model.background_params_[0]
+            slopes[ichan, itrial] = foof_model.background_params_[1]
+            status[ichan, itrial] = FIT_OK
+
+    return slopes, hfa, status
+
+def _report_progress(job, nfit, njob, start):
+    """ Print a finished output, with the number of outputs done, time elapsed, and an estimate of time left. """
+
+    elapsed = time.perf_counter() - start
+    print('{} {}: {}/{} done, {:.0f} s elapsed, {:.0f} s left'.format(job[0], list(job[1]), nfit, njob, elapsed, elapsed / nfit * (njob - nfit)))
+
+def job_key(subject, timewin, padlabel, engine):
+    """ Get the key of a subject and time window's output, from its PSD file and the fit settings. """
+
+    return fooof_key(psd_file(subject, timewin, padlabel), {'engine':engine, 'fooof':FOOOF_SETTINGS, 'freq_range':FREQ_RANGE},
+                     fooof_file(subject, timewin, padlabel))
+
+def run_fooof_trials(timewins, padlabel, n_jobs=1, chanblock=CHANBLOCK, engine='fooof', overwrite=False):
+    """ Use FOOOF to get individual trial slope and HFA (offset) measurements.
+
+    Each subject and time window is split into blocks of channels, which are fit over n_jobs processes. Output files are
+    written as soon as all blocks of a subject and time window are fit. PSDs saved with -v7.3 are read one block at a
+    time, by the process fitting the block, so memory use is bounded by the block size. Older PSD files are loaded whole,
+    one or two subjects at a time.
+
+    Slopes and HFA are saved as 'channels x trials' arrays with NaN for failed fits, along with the status of each fit
+    (FIT_OK or FIT_FAILED in kah_psd).
+
+    With engine='aperiodic', blocks are instead fit with the closed-form aperiodic fit in kah_aperiodic, which gives the
+    same slopes and HFA as FOOOF with no peaks.
+
+    Outputs are keyed by a hash of their PSD file and the fit settings (see job_key()). Unless overwrite is True, outputs
+    already saved with the same key are skipped, so an interrupted run resumes with the first unfinished output.
+    """
+
+    if engine not in ['fooof', 'aperiodic']:
+        raise ValueError("engine must be 'fooof' or 'aperiodic'.")
+    if engine == 'fooof' and not HAVE_FOOOF:
+        raise ImportError("fooof is required for engine='fooof'. Use engine='aperiodic' for closed-form fits.")
+
+    # Skip outputs whose PSDs and settings are unchanged.
+    jobs, keys = [], {}
+    for timewin in timewins:
+        for subject in SUBJECTS:
+            job = (subject, tuple(timewin))
+            keys[job] = job_key(subject, timewin, padlabel, engine)
+            if overwrite or not is_cached(fooof_file(subject, timewin, padlabel), keys[job]):
+                jobs.append(job)
+    print('{} of {} outputs left to fit.'.format(len(jobs), len(keys)))
+    njob, start = len(jobs), time.perf_counter()
+
+    # Closed-form fits are vectorized over channels and trials, so each block is fit in one call.
+    if engine == 'aperiodic':
+        for ijob, job in enumerate(jobs):
+            subject, timewin = job
+            with PSDFile(psd_file(subject, timewin, padlabel)) as psdfile:
+                fits = [fit_aperiodic(psdfile.freq, psdfile.read(chans), FREQ_RANGE) for chans in psdfile.blocks(chanblock)]
+            hfa, slopes, ok = (np.concatenate(fit) for fit in zip(*fits))
+            status = np.where(ok, FIT_OK, FIT_FAILED).astype(np.int8)
+            save_fooof(fooof_file(subject, timewin, padlabel), {'slopes':slopes, 'hfa':hfa, 'status':status}, keys[job])
+            _report_progress(job, ijob + 1, njob, start)
+        print('Done.')
+        return
+
+    # Serially, fit blocks in this process.
+    if n_jobs == 1:
+        _init_worker()
+        for ijob, job in enumerate(jobs):
+            subject, timewin = job
+            with PSDFile(psd_file(subject, timewin, padlabel)) as psdfile:
+                fits = [_fit_block(psdfile.freq, psdfile.read(chans), chans) for chans in psdfile.blocks(chanblock)]
+            slopes, hfa, status = (np.concatenate(fit) for fit in zip(*fits))
+            save_fooof(fooof_file(subject, timewin, padlabel), {'slopes':slopes, 'hfa':hfa, 'status':status}, keys[job])
+            _report_progress(job, ijob + 1, njob, start)
+        print('Done.')
+        return
+
+    # In parallel, keep a few jobs' blocks queued, opening the next job's PSDs as earlier jobs finish.
+    jobs = iter(jobs)
+    pending, results, nblocks = {}, {}, {}
+    nfit = 0
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker) as executor:
+        while True:
+            # Queue blocks until every worker has about two blocks to fit.
+            while len(pending) < 2 * n_jobs:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                with PSDFile(psd_file(job[0], job[1], padlabel)) as psdfile:
+                    blocks = psdfile.blocks(chanblock)
+                    results[job] = [None] * len(blocks)
+                    nblocks[job] = len(blocks)
+                    for iblock, chans in enumerate(blocks):
+                        # Workers read streamable files themselves. Otherwise, send the block.
+                        psds = psdfile.path if psdfile.streaming else psdfile.read(chans)
+                        pending[executor.submit(_fit_block, psdfile.freq, psds, chans)] = (job, iblock)
+
+            if not pending:
+                break
+
+            # Collect finished blocks, and save jobs with all blocks fit.
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, iblock = pending.pop(future)
+                results[job][iblock] = future.result()
+                nblocks[job] -= 1
+                if nblocks[job] == 0:
+                    slopes, hfa, status = (np.concatenate(fit) for fit in zip(*results[job]))
+                    save_fooof(fooof_file(job[0], job[1], padlabel), {'slopes':slopes, 'hfa':hfa, 'status':status}, keys[job])
+                    del results[job], nblocks[job]
+
+                    nfit += 1
+                    _report_progress(job, nfit, njob, start)
 
     print('Done.')
 
 if __name__ == "__main__":
     padlabel =  ''
- 
-    timewin = [-800, 0]
-    run_fooof_trials(timewin, padlabel)
-
-    timewin = [0, 800]
-    run_fooof_trials(timewin, padlabel)
-
-    timewin = [800, 1600]
-    run_fooof_trials(timewin, padlabel)
+    timewins = [[-800, 0], [0, 800], [800, 1600]]
+    n_jobs = 1
+    engine = 'fooof' # or 'aperiodic' for closed-form fits; check agreement first with kah_aperiodic.validate(freq, psds, FOOOF_SETTINGS, FREQ_RANGE)
+    overwrite = False # refit outputs even if their PSDs and settings are unchanged
 
+    run_fooof_trials(timewins, padlabel, n_jobs=n_jobs, engine=engine, overwrite=overwrite)
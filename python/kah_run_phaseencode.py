@@ -0,0 +1,110 @@
+""" Script for detecting phase-encoding episodes of every channel pair per subject, updating the 'mc' data set.
+
+Replaces kah_calculatephaseencode.m and kah_getphaseencoding.m. The phase-encoding columns of kah_multichannel.csv are
+recomputed per subject, and its other columns (pair labels and ages) are kept.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+from kah_data import KahData, CSVFILES
+from kah_psd import is_hdf5_mat, HAVE_H5PY
+from kah_tspac import memmap_timeseries
+from kah_phaseencode import phase_encoding_stats, encoding_episodes
+
+if HAVE_H5PY:
+    import h5py
+
+SUBJECTS = ['R1020J', 'R1032D', 'R1033D', 'R1034D', 'R1045E', 'R1059J', 'R1075J', 'R1080E', 'R1120E', 'R1135E', 'R1142N', 'R1147P', 'R1149N', 'R1151E', 'R1154D', 'R1162N', 'R1166D', 'R1167M', 'R1175N']
+
+# Location of theta phase.
+DATAPATH = '/Volumes/voyteklab/tamtra/data/KAH/'
+
+# Local directory for memory-mapped copies of theta phase, shared with kah_run_tspac.py.
+CACHEPATH = '/Volumes/DATAHD/Active/KAH/cache/timeseries/'
+
+# Individual ('cf') or canonical theta phase.
+THETALABEL = 'cf'
+
+# Theta frequency episode lengths are measured in for canonical theta phase. For individual theta phase, the subject's
+# mean theta center frequency across channels is used instead, as in kah_getphaseencoding.m.
+THETACF = 6
+
+# Individual theta bands per channel, from kah_2_psd_1_calculatetheta_chans.m, with one cell per subject in the order of
+# info.subj when the bands were saved. Check BANDS_SUBJECTS against kah_info.m if the bands were saved for other subjects.
+BANDSFILE = '/Volumes/DATAHD/Active/KAH/FR1_thetabands_-800_1600_chans.mat'
+BANDS_SUBJECTS = SUBJECTS
+
+# Episode detection settings of kah_getphaseencoding.m.
+TESTTYPE = 'corrcl'
+STATTHRESHTYPE = 'pvalue'
+NPERM = 0
+TIMEOI = (0, 1.6)
+
+# Columns of the 'mc' data set set here.
+ENCODING_COLUMNS = ['encodingonset', 'encodinglength', 'encodingstrength', 'encodingepisodes']
+
+def theta_cf(subject):
+    """ Get the theta frequency a subject's episode lengths are measured in: the mean center of the subject's theta bands
+    across channels for individual theta phase, or THETACF for canonical theta phase.
+    """
+
+    if THETALABEL != 'cf':
+        return THETACF
+
+    if is_hdf5_mat(BANDSFILE):
+        if not HAVE_H5PY:
+            raise ImportError('h5py is required to read -v7.3 .mat files.')
+        with h5py.File(BANDSFILE, 'r') as file:
+            bands = [file[ref][()].T for ref in file['bands'][()].ravel()]
+    else:
+        bands = list(sio.loadmat(BANDSFILE, variable_names=['bands'])['bands'].ravel())
+
+    if len(bands) != len(BANDS_SUBJECTS):
+        raise ValueError('{} has theta bands of {} subjects, but BANDS_SUBJECTS has {}.'.format(BANDSFILE, len(bands), len(BANDS_SUBJECTS)))
+
+    # Center of each channel's band, averaged over channels with a band.
+    return np.nanmean(np.mean(bands[BANDS_SUBJECTS.index(subject)], axis=1))
+
+def run_phaseencode(subject, encoding):
+    """ Get phase-encoding episodes of every channel pair of one subject, as 1-based pairs with ENCODING_COLUMNS. """
+
+    phase, times = memmap_timeseries(DATAPATH + 'thetaphase/' + subject + '_FR1_thetaphase_' + THETALABEL + '_-800_1600.mat', CACHEPATH)
+    fs = 1 / np.median(np.diff(times))
+
+    # Episodes must be longer than a quarter theta cycle.
+    results = phase_encoding_stats(phase, encoding, testtype=TESTTYPE, nperm=NPERM)
+    episodes = encoding_episodes(results, times, fs / theta_cf(subject) * 0.25, statthreshtype=STATTHRESHTYPE, timeoi=TIMEOI)
+    episodes.insert(0, 'subject', subject)
+
+    return episodes
+
+if __name__ == "__main__":
+    mcfile = os.path.join(KahData.csvpath, CSVFILES['mc'])
+    pairinfo = pd.read_csv(mcfile)
+
+    encoding = []
+    for subject in SUBJECTS:
+        print(subject)
+        trials = KahData.load('stsc', subject=subject, columns=['subject', 'trial', 'encoding']).drop_duplicates('trial').sort_values('trial')
+        episodes = run_phaseencode(subject, trials['encoding'].to_numpy())
+
+        npair = (pairinfo['subject'] == subject).sum()
+        if npair != len(episodes):
+            raise ValueError('{} has {} channel pairs in its phase data but {} in {}.'.format(subject, len(episodes), npair, CSVFILES['mc']))
+        encoding.append(episodes)
+
+    # Replace the phase-encoding columns of the recomputed subjects, keeping the rest of the data set.
+    encoding = pd.concat(encoding, ignore_index=True).set_index(['subject', 'pair'])
+    pairinfo = pairinfo.set_index(['subject', 'pair'])
+    for column in ENCODING_COLUMNS:
+        if column not in pairinfo:
+            pairinfo[column] = np.nan
+        pairinfo.loc[encoding.index, column] = encoding[column]
+
+    tmpfile = mcfile + '.tmp'
+    pairinfo.reset_index().to_csv(tmpfile, index=False)
+    os.replace(tmpfile, mcfile)
+
+    print('Done.')
@@ -0,0 +1,86 @@
+""" Script for calculating between-channel tsPAC per subject, saved as per-subject 'stmc' CSVs.
+
+Replaces kah_4_pac_1_calculatetspac_between.m, kah_calculatepac.m, and kah_4_pac_3_aggregatesubjects.m for
+between-channel PAC. Each subject's CSV is picked up by kah_combine_singletrial_multichannel.py.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from kah_data import KahData
+from kah_tspac import TIMEWINS, TSPAC_TIMEWIN, memmap_timeseries, window_indices, pair_indices, random_shifts, read_mat_array, calculate_tspac, stmc_rows, validate
+
+SUBJECTS = ['R1020J', 'R1032D', 'R1033D', 'R1034D', 'R1045E', 'R1059J', 'R1075J', 'R1080E', 'R1120E', 'R1135E', 'R1142N', 'R1147P', 'R1149N', 'R1151E', 'R1154D', 'R1162N', 'R1166D', 'R1167M', 'R1175N']
+
+# Location of theta phase, HFA, and surrogate shifts, in folders per data type.
+DATAPATH = '/Volumes/voyteklab/tamtra/data/KAH/'
+
+# Local directory for memory-mapped copies of theta phase and HFA, converted once from the .mat files.
+CACHEPATH = '/Volumes/DATAHD/Active/KAH/cache/timeseries/'
+
+# Individual ('cf') or canonical theta phase.
+THETALABEL = 'cf'
+
+def shift_file(subject, timewin):
+    """ Get path of a subject's surrogate shifts for a time window, from kah_4_pac_0_shifttrials.m. """
+
+    return DATAPATH + 'shifttrials/' + subject + '_FR1_pac_between_ts_trialshifts_default_' + str(timewin[0]) + '_' + str(timewin[1]) + '.mat'
+
+def output_file(subject):
+    """ Get path of a subject's 'stmc' CSV. """
+
+    return os.path.join(KahData.csvpath, 'kah_singletrial_multichannel_' + subject + '.csv')
+
+def run_tspac(subject, pairinfo, encoding, seed=0):
+    """ Calculate tsPAC of every time window for one subject, as 'stmc' rows.
+
+    Surrogate shifts are read from the shifts saved for the MATLAB pipeline if they exist, so normalized PAC can be
+    reproduced. Otherwise, they are drawn with the given seed.
+    """
+
+    phase, times = memmap_timeseries(DATAPATH + 'thetaphase/' + subject + '_FR1_thetaphase_' + THETALABEL + '_-800_1600.mat', CACHEPATH)
+    hfa, hfatimes = memmap_timeseries(DATAPATH + 'hfa/' + subject + '_FR1_hfa_-800_1600.mat', CACHEPATH)
+
+    npair = len(pair_indices(phase.shape[0])[0])
+    if npair != len(pairinfo):
+        raise ValueError('{} has {} channel pairs in its phase data but {} in its pair info.'.format(subject, npair, len(pairinfo)))
+
+    # PAC of each time window, then of the whole encoding period for the strongest direction.
+    pac = {}
+    for timewin, edges in list(TIMEWINS.items()) + [('tspac', TSPAC_TIMEWIN)]:
+        print(subject, timewin)
+        phasewin = phase[:, window_indices(times, edges)]
+        hfawin = hfa[:, window_indices(hfatimes, edges)]
+
+        if os.path.isfile(shift_file(subject, edges)):
+            shifts = read_mat_array(shift_file(subject, edges), 'shifttrials').astype(np.int64)
+        else:
+            shifts = random_shifts(npair, phase.shape[2], phasewin.shape[1], seed=seed)
+
+        pac[timewin] = calculate_tspac(phasewin, hfawin, shifts)
+
+    return stmc_rows(pairinfo, encoding, pac, pac.pop('tspac'))
+
+if __name__ == "__main__":
+    validation = False # compare with the existing 'stmc' data set instead of saving CSVs
+    overwrite = False # recalculate subjects that already have a CSV
+
+    # Pair labels and ages per subject, and trial outcomes.
+    pairinfo = pd.read_csv(os.path.join(KahData.csvpath, 'kah_multichannel.csv'))
+    for subject in SUBJECTS:
+        if not validation and not overwrite and os.path.isfile(output_file(subject)):
+            print('Skipping ' + subject)
+            continue
+
+        subjpairs = pairinfo[pairinfo['subject'] == subject].sort_values('pair').reset_index(drop=True)
+        trials = KahData.load('stsc', subject=subject, columns=['subject', 'trial', 'encoding']).drop_duplicates('trial').sort_values('trial')
+        rows = run_tspac(subject, subjpairs, trials['encoding'].to_numpy())
+
+        if validation:
+            print(validate(rows, KahData.load('stmc', subject=subject)).to_string(index=False))
+        else:
+            tmpfile = output_file(subject) + '.tmp'
+            rows.to_csv(tmpfile, index=False)
+            os.replace(tmpfile, output_file(subject))
+
+    print('Done.')
@@ -1,38 +1,32 @@
 """ Script for loading Kahana data per subject and aggregating into temporal and frontal measures per trial. """
 
-from kah_data import SUBJECTS, KahData
-import pickle
+from kah_data import SUBJECTS, build_subjects
+from kah_store import save_subjects, load_predictors
 
 # All channels, only theta channels/pairs, only theta and phase encoding, or without theta.
 SUBJECT_TYPES = ['all', 'theta', 'theta_phase', 'notheta']
 
-# Files to save to.
-SUBJECT_FILES = {}
-for subj_type in SUBJECT_TYPES:
-    SUBJECT_FILES[subj_type] = 'data/kah_subjects_{}.pickle'.format(subj_type)
-
-if __name__ == "__main__":
-    # Load subject data.
-    subject_data = {}
-    for subj_type in SUBJECT_TYPES:
-        subject_data[subj_type] = []
+# Channel exclusions for each subject type.
+SUBJECT_VARIANTS = {'all':{}, # for no channel exclusions
+                    'theta':{'enforce_theta':True}, # for excluding channels without theta
+                    'theta_phase':{'enforce_theta':True, 'enforce_phase':True}, # for excluding channels without theta and channel pairs without phase encoding
+                    'notheta':{'exclude_theta':True}} # for excluding channels with theta
 
-    for isubj in range(len(SUBJECTS)):
-        print(SUBJECTS[isubj])
-        
-        # For no channel exclusions.
-        subject_data['all'].append(KahData(subject=SUBJECTS[isubj], include_regions=['ltl', 'lpfc']))
-
-        # For excluding channels without theta.
-        subject_data['theta'].append(KahData(subject=SUBJECTS[isubj], include_regions=['ltl', 'lpfc'], enforce_theta=True, theta_threshtype='bump'))
+# Stores to save to, with one file per subject.
+SUBJECT_STORES = {}
+for subj_type in SUBJECT_TYPES:
+    SUBJECT_STORES[subj_type] = 'data/kah_subjects_{}'.format(subj_type)
 
-        # For excluding channels with theta.
-        subject_data['notheta'].append(KahData(subject=SUBJECTS[isubj], include_regions=['ltl', 'lpfc'], exclude_theta=True, theta_threshtype='bump'))
+# Number of subjects to process in parallel.
+NJOBS = 1
 
-        # For excluding channels without theta and channel pairs without phase encoding.
-        subject_data['theta_phase'].append(KahData(subject=SUBJECTS[isubj], include_regions=['ltl', 'lpfc'], enforce_theta=True, enforce_phase=True, theta_threshtype='bump'))
+if __name__ == "__main__":
+    # Load subject data, sharing loading and theta marking across subject types.
+    subject_data = build_subjects(SUBJECTS, SUBJECT_VARIANTS, n_jobs=NJOBS, verbose=True, include_regions=['ltl', 'lpfc'], theta_threshtype='bump')
 
     # Save to disk.
     for subj_type in SUBJECT_TYPES:
-        with open(SUBJECT_FILES[subj_type], 'wb') as file:
-            pickle.dump(subject_data[subj_type], file) 
+        save_subjects(subject_data[subj_type], SUBJECT_STORES[subj_type])
+
+        # Aggregate and cache predictors for classification.
+        load_predictors(SUBJECT_STORES[subj_type])
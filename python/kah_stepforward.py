@@ -0,0 +1,258 @@
+""" Step-forward feature selection for classifying Kahana data, with results stored in an SQLite database.
+
+Each step fits one model per remaining candidate feature, added to the top features of previous steps. AUCs are
+recorded per subject, feature set, and seed as soon as each model is fit, so an interrupted search resumes exactly where
+it stopped, fitting only the seeds that are missing.
+
+In racing mode, candidates are fit in batches of seeds, and candidates that a paired sign test shows are worse than the
+current leader are dropped before the next batch. Only the remaining candidates are fit with all seeds.
+"""
+
+import json
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+import numpy as np
+from scipy import stats
+from kah_classifier import KahClassifier, SplitCache
+
+# Per-process state for parallel classification, set once per worker.
+_WORKER = {}
+
+class StepforwardStore:
+    """ SQLite database of classification AUCs, keyed by subject, feature set, and seed.
+
+    Parameters
+    ----------
+    dbfile : string
+        Path to the database. Created if it does not exist.
+    method : string, optional
+        The type of classifier the AUCs are from. Recorded when the database is created, and must match when opening one.
+        default: None (don't check, for reading AUCs only)
+    hyperparameters : dict, optional
+        Hyperparameters of the classifier, recorded and checked with method. default: None
+
+    Notes
+    -----
+    Feature sets are stored as JSON lists of [measure, region] pairs, in the order the features were added. The classifier
+    is stored as JSON in a table of metadata, so AUCs of different classifiers are never mixed in one database.
+    """
+
+    def __init__(self, dbfile, method=None, hyperparameters=None):
+        """ Open the database, creating the tables of AUCs and metadata if necessary. """
+
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect(dbfile)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS auc (subject TEXT, features TEXT, seed INTEGER, auc REAL, PRIMARY KEY (subject, features, seed))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+        # Record the classifier of a new database, or check it against the one the AUCs are from.
+        if method is not None:
+            classifier = json.dumps({'method':method, 'hyperparameters':hyperparameters}, sort_keys=True)
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', ('classifier',)).fetchone()
+            if row is None:
+                with self.conn:
+                    self.conn.execute('INSERT INTO meta VALUES (?, ?)', ('classifier', classifier))
+            elif row[0] != classifier:
+                self.conn.close()
+                raise ValueError('Database {} has AUCs of classifier {}, not {}.'.format(dbfile, row[0], classifier))
+
+    @staticmethod
+    def key(features):
+        """ Get the database key of a feature set. """
+
+        return json.dumps([list(feature) for feature in features])
+
+    def add(self, subject, features, seeds, auc):
+        """ Record AUCs of one subject and feature set for some seeds, in a single transaction. """
+
+        key = self.key(features)
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO auc VALUES (?, ?, ?, ?)', [(subject, key, int(seed), float(auc_)) for seed, auc_ in zip(seeds, auc)])
+
+    def missing_seeds(self, subject, features, seeds):
+        """ Get the seeds without a recorded AUC for a subject and feature set. """
+
+        done = set(row[0] for row in self.conn.execute('SELECT seed FROM auc WHERE subject = ? AND features = ?', (subject, self.key(features))))
+
+        return [seed for seed in seeds if seed not in done]
+
+    def get_auc(self, subjects, features, seeds):
+        """ Get AUCs of a feature set as a nsubj x nseed array, with NaN where no AUC is recorded. """
+
+        auc = np.full([len(subjects), len(seeds)], np.nan)
+        isubj = {subject:i for i, subject in enumerate(subjects)}
+        iseed = {seed:i for i, seed in enumerate(seeds)}
+        for subject, seed, auc_ in self.conn.execute('SELECT subject, seed, auc FROM auc WHERE features = ?', (self.key(features),)):
+            if subject in isubj and seed in iseed:
+                auc[isubj[subject], iseed[seed]] = auc_
+
+        return auc
+
+    def top_feature(self, subjects, top_features, predictors_available, seeds):
+        """ Get the candidate feature whose model has the highest median AUC across subjects of the median AUC across seeds. """
+
+        auc = [np.median(np.median(self.get_auc(subjects, [*top_features, pred], seeds), axis=1)) for pred in predictors_available]
+
+        return predictors_available[int(np.argmax(auc))]
+
+    def close(self):
+        """ Close the database. """
+
+        self.conn.close()
+
+def _init_worker(subjects, seeds):
+    """ Give a worker the subjects' predictor matrices once, instead of sending them with every task. """
+
+    _WORKER['subjects'] = subjects
+    _WORKER['seeds'] = seeds
+    _WORKER['splits'] = {}
+
+def _classify_features(isubj, features, seeds, method, hyperparameters):
+    """ Classify one subject with one feature set for some seeds. Returns AUCs and time spent per stage. """
+
+    # Split and scale each subject once per worker, shared by all feature sets.
+    if isubj not in _WORKER['splits']:
+        _WORKER['splits'][isubj] = SplitCache(_WORKER['subjects'][isubj], _WORKER['seeds'])
+
+    clf = KahClassifier(predictors=list(features))
+    auc, _ = clf.classify_seeds(_WORKER['splits'][isubj], seeds, hyperparameters=hyperparameters, method=method)
+
+    return auc, clf.timings_
+
+def sign_test(auc_leader, auc_candidate):
+    """ One-sided p-value of a paired sign test that the leader has higher AUC than a candidate, over shared subjects and seeds. """
+
+    diff = (auc_leader - auc_candidate).ravel()
+    diff = diff[~np.isnan(diff) & (diff != 0)]
+    if len(diff) == 0:
+        return 1.
+
+    return stats.binomtest(int(np.sum(diff > 0)), len(diff), 0.5, alternative='greater').pvalue
+
+def _race(store, subjects, top_features, candidates, seeds, alpha):
+    """ Drop candidates whose AUCs are significantly lower than the current leader's, on the seeds fit so far. """
+
+    auc = {pred:store.get_auc(subjects, [*top_features, pred], seeds) for pred in candidates}
+    leader = candidates[int(np.argmax([np.median(np.median(auc[pred], axis=1)) for pred in candidates]))]
+
+    return [pred for pred in candidates if pred == leader or sign_test(auc[leader], auc[pred]) >= alpha]
+
+def _fit_tasks(tasks, store, names, executor, method, hyperparameters, timings):
+    """ Fit models, serially or over a process pool, recording each one as soon as it is fit. Returns the number of seeds fit. """
+
+    if executor is None:
+        results = (((isubj, features, missing), _classify_features(isubj, features, missing, method, hyperparameters)) for isubj, features, missing in tasks)
+    else:
+        futures = {executor.submit(_classify_features, isubj, features, missing, method, hyperparameters):(isubj, features, missing) for isubj, features, missing in tasks}
+        results = ((futures[future], future.result()) for future in as_completed(futures))
+
+    start = time.perf_counter()
+    for itask, ((isubj, features, missing), (auc, timings_task)) in enumerate(results):
+        store.add(names[isubj], features, missing, auc)
+        for stage in timings_task:
+            timings[stage] = timings.get(stage, 0.) + timings_task[stage]
+
+        elapsed = time.perf_counter() - start
+        print('{}/{} models, {:.0f} s elapsed, {:.0f} s left'.format(itask + 1, len(tasks), elapsed, elapsed / (itask + 1) * (len(tasks) - itask - 1)))
+
+    return sum(len(missing) for _, _, missing in tasks)
+
+def _get_tasks(store, names, top_features, candidates, seeds):
+    """ Get models and seeds not already in the database. """
+
+    tasks = []
+    for predictor in candidates:
+        for isubj, subject in enumerate(names):
+            missing = store.missing_seeds(subject, [*top_features, predictor], seeds)
+            if missing:
+                tasks.append((isubj, (*top_features, predictor), missing))
+
+    return tasks
+
+def stepforward(subjects, predictors, nseed, dbfile, n_jobs=1, method='logistic_numpy', hyperparameters=None, racing=False, batchsize=25, alpha=0.001):
+    """ Select features step by step, adding the feature that most improves median AUC across subjects at each step.
+
+    Parameters
+    ----------
+    subjects : list of PredictorMatrix() objects
+        Subjects to classify. Features are chosen jointly for all subjects.
+    predictors : list of tuples
+        Candidate features. Each tuple is ('measure', 'region').
+    nseed : int
+        Number of random seeds to classify each model with.
+    dbfile : string
+        Path to the database to record AUCs in. Models already in the database are not refit. Raises ValueError if the
+        database has AUCs of another method or hyperparameters.
+    n_jobs : int, optional
+        Number of processes to fit models over. default: 1
+    method : string, optional
+        The type of classifier to use, as in KahClassifier.classify(). default: 'logistic_numpy'
+    hyperparameters : dict, optional
+        Hyperparameters of the classifier, as in KahClassifier.classify_seeds(). default: None
+    racing : boolean, optional
+        Fit candidates in batches of seeds, dropping candidates worse than the leader after each batch. default: False
+    batchsize : int, optional
+        Number of seeds per batch in racing mode. default: 25
+    alpha : float, optional
+        Significance level of the sign test for dropping a candidate in racing mode. default: 0.001
+
+    Returns
+    -------
+    top_features : list of tuples
+        Features in the order they were added.
+    """
+
+    store = StepforwardStore(dbfile, method=method, hyperparameters=hyperparameters)
+    names = [subject.subject for subject in subjects]
+    seeds = list(range(nseed))
+
+    # Fit in this process, or over a pool of processes that is shut down even if a model fails.
+    if n_jobs == 1:
+        _init_worker(subjects, seeds)
+        pool = nullcontext()
+    else:
+        pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(subjects, seeds))
+
+    with pool as executor:
+        # Build one-, then two-, then three- ... feature models, each time building on the most predictive previous models.
+        top_features = []
+        timings = {}
+        for npred in range(len(predictors)):
+            predictors_available = [pred for pred in predictors if pred not in top_features]
+
+            # Fit only the models and seeds not already in the database.
+            if not racing:
+                tasks = _get_tasks(store, names, top_features, predictors_available, seeds)
+                print('Fitting models with {} features: {} of {} models left.'.format(npred + 1, len(tasks), len(predictors_available) * len(names)))
+                _fit_tasks(tasks, store, names, executor, method, hyperparameters, timings)
+                candidates = predictors_available
+
+            # In racing mode, add seeds in batches, keeping only candidates not dominated by the leader.
+            else:
+                candidates = predictors_available
+                nfit = 0
+                for stop in range(batchsize, nseed + batchsize, batchsize):
+                    tasks = _get_tasks(store, names, top_features, candidates, seeds[:stop])
+                    print('Fitting models with {} features, seeds up to {}: {} candidates left.'.format(npred + 1, min(stop, nseed), len(candidates)))
+                    nfit += _fit_tasks(tasks, store, names, executor, method, hyperparameters, timings)
+                    if stop < nseed:
+                        candidates = _race(store, names, top_features, candidates, seeds[:stop], alpha)
+
+                nfull = len(predictors_available) * len(names) * nseed
+                print('Racing fit {} of {} model seeds ({:.1%} saved).'.format(nfit, nfull, 1 - nfit / nfull))
+
+            # Find and add new top feature to list.
+            top_features.append(store.top_feature(names, top_features, candidates, seeds))
+            print('Current list of top features: {}'.format(top_features))
+
+    store.close()
+
+    # Report time spent per stage of classification, summed over processes.
+    clf = KahClassifier()
+    clf.timings_ = timings
+    clf.report_timings()
+
+    return top_features
@@ -0,0 +1,216 @@
+""" Per-subject storage of KahData() objects, so that scripts only load the subjects they analyze.
+
+A store is a directory with one file per subject and data set, and an index listing the subjects and the inputs used to
+create each KahData() object. If pyarrow is installed, data sets are saved as uncompressed Feather files, and loading
+can read only some columns of each data set. Otherwise they are pickled.
+
+Each subject's predictors, aggregated per trial and region, are also cached as a PredictorMatrix() in a .npy file. The
+cache holds PREDICTORS_ALL and any other predictors that have been requested from it.
+"""
+
+import json
+import os
+import pickle
+import numpy as np
+from kah_cache import HAVE_PARQUET
+from kah_classifier import PREDICTORS_ALL, PredictorMatrix
+from kah_data import KahData, DATASETS
+
+if HAVE_PARQUET:
+    import pyarrow.feather as feather
+
+# Name of the index file in each store.
+INDEX = 'index.json'
+
+# Version of the store layout.
+STORE_VERSION = 1
+
+# Version of the predictor aggregation. Cached predictors with another version are rebuilt.
+PREDICTORS_VERSION = 1
+
+def read_index(storedir):
+    """ Get the index of a store. """
+
+    with open(os.path.join(storedir, INDEX)) as file:
+        index = json.load(file)
+
+    if index.get('version') != STORE_VERSION:
+        raise ValueError('Store {} has version {}, expected {}.'.format(storedir, index.get('version'), STORE_VERSION))
+
+    return index
+
+def save_subjects(subjects, storedir):
+    """ Save KahData() objects to a store, one file per subject and data set.
+
+    Parameters
+    ----------
+    subjects : list of KahData() objects
+        Data to save, one object per subject.
+    storedir : string
+        Directory of the store. Subjects already in the store are replaced.
+    """
+
+    os.makedirs(storedir, exist_ok=True)
+    fileformat = 'feather' if HAVE_PARQUET else 'pickle'
+
+    # Add to an existing index, if any.
+    try:
+        index = read_index(storedir)
+    except (OSError, ValueError):
+        index = {'version':STORE_VERSION, 'subjects':{}}
+
+    for data in subjects:
+        files = {}
+        for dataset in DATASETS:
+            files[dataset] = '{}_{}.{}'.format(data.subject, dataset, fileformat)
+            _write_dataset(getattr(data, dataset), os.path.join(storedir, files[dataset]), fileformat)
+
+        # Inputs used to create the object. Any cached predictors are out of date. Phase encoding per pair ('mc') was
+        # only needed to mark phase-encoding pairs, and is not stored.
+        params = {key:value for key, value in vars(data).items() if key not in DATASETS + ['mc']}
+        index['subjects'][data.subject] = {'format':fileformat, 'files':files, 'params':params}
+
+    _write_index(storedir, index)
+
+def load_predictors(storedir, subjects=None, predictors=None, memory_map=True):
+    """ Load cached predictors from a store, aggregating and caching them first if necessary.
+
+    Parameters
+    ----------
+    storedir : string
+        Directory of the store.
+    subjects : list of strings, optional
+        Subjects to load. Subjects not in the store are skipped. default: None (all subjects)
+    predictors : list of tuples, optional
+        Predictors needed in addition to PREDICTORS_ALL, as ('measure', 'region'). Predictors not in the cache are added
+        to it. None or 'all' only needs PREDICTORS_ALL. default: None
+    memory_map : boolean, optional
+        Memory-map the cached predictors instead of reading them. default: True
+
+    Returns
+    -------
+    matrices : list of PredictorMatrix() objects
+        One object per subject, with all predictors in PREDICTORS_ALL followed by any others cached, in the order the
+        subjects were saved.
+    """
+
+    index = read_index(storedir)
+    predictors = [] if predictors is None or predictors == 'all' else [tuple(pred) for pred in predictors]
+
+    matrices = []
+    for subject, entry in index['subjects'].items():
+        if subjects and subject not in subjects:
+            continue
+
+        # Keep cached predictors if they were made the same way, along with any extra predictors cached before.
+        cached = entry.get('predictors')
+        if cached and cached['version'] == PREDICTORS_VERSION and [tuple(pred) for pred in cached['predictors'][:len(PREDICTORS_ALL)]] == PREDICTORS_ALL:
+            extra = [tuple(pred) for pred in cached['predictors'][len(PREDICTORS_ALL):]]
+        else:
+            cached, extra = None, []
+        allpreds = PREDICTORS_ALL + extra + [pred for pred in dict.fromkeys(predictors) if pred not in PREDICTORS_ALL + extra]
+
+        # Aggregate and cache predictors if they are missing.
+        if cached is None or len(allpreds) > len(cached['predictors']):
+            kahdata = load_subjects(storedir, subjects=[subject], columns=_predictor_columns(allpreds))[0]
+            matrix = PredictorMatrix.from_kahdata(kahdata, allpreds)
+            cached = {'version':PREDICTORS_VERSION, 'predictors':allpreds, 'file':'{}_predictors.npy'.format(subject)}
+            _write_array(matrix.values, os.path.join(storedir, cached['file']))
+            entry['predictors'] = cached
+            _write_index(storedir, index)
+
+        values = np.load(os.path.join(storedir, cached['file']), mmap_mode='r' if memory_map else None)
+        matrices.append(PredictorMatrix(values, cached['predictors'], subject))
+
+    return matrices
+
+def _predictor_columns(predictors):
+    """ Get the columns of each data set needed to aggregate some predictors with PredictorMatrix.from_kahdata(). """
+
+    measures = [measure for measure, _ in predictors]
+
+    return {'stsc':['trial', 'lobe', 'encoding'] + measures, 'stmc':['trial', 'direction'] + measures}
+
+def load_subjects(storedir, subjects=None, columns=None):
+    """ Load KahData() objects from a store.
+
+    Parameters
+    ----------
+    storedir : string
+        Directory of the store.
+    subjects : list of strings, optional
+        Subjects to load. Subjects not in the store are skipped. default: None (all subjects)
+    columns : dict of lists of strings, optional
+        Columns to load per data set, keyed by data set name. Columns not in a data set are skipped. default: None (all
+        columns of every data set)
+
+    Returns
+    -------
+    data : list of KahData() objects
+        One object per subject, in the order the subjects were saved.
+
+    Notes
+    -----
+    Feather files are memory-mapped, so only the columns requested are read from disk. Those columns are still copied
+    into Pandas.
+    """
+
+    index = read_index(storedir)
+
+    data = []
+    for subject, entry in index['subjects'].items():
+        if subjects and subject not in subjects:
+            continue
+
+        # Rebuild the object without loading or filtering the full data sets.
+        subjdata = KahData.__new__(KahData)
+        for key, value in entry['params'].items():
+            setattr(subjdata, key, value)
+        for dataset, file in entry['files'].items():
+            setattr(subjdata, dataset, _read_dataset(os.path.join(storedir, file), entry['format'], None if columns is None else columns.get(dataset)))
+        data.append(subjdata)
+
+    return data
+
+def _write_dataset(datacurr, path, fileformat):
+    """ Write one data set atomically. """
+
+    tmpfile = path + '.tmp'
+    if fileformat == 'feather':
+        datacurr.reset_index(drop=True).to_feather(tmpfile, compression='uncompressed')
+    else:
+        with open(tmpfile, 'wb') as file:
+            pickle.dump(datacurr, file)
+    os.replace(tmpfile, path)
+
+def _read_dataset(path, fileformat, columns=None):
+    """ Read one data set, or only some of its columns. """
+
+    if fileformat == 'feather':
+        table = feather.read_table(path, memory_map=True)
+        if columns is not None:
+            table = table.select([column for column in table.column_names if column in columns])
+        return table.to_pandas()
+
+    with open(path, 'rb') as file:
+        datacurr = pickle.load(file)
+    if columns is not None:
+        datacurr = datacurr[[column for column in datacurr.columns if column in columns]]
+
+    return datacurr
+
+def _write_array(values, path):
+    """ Write an array atomically, keeping its memory layout. """
+
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as file:
+        np.save(file, values)
+    os.replace(tmpfile, path)
+
+def _write_index(storedir, index):
+    """ Write the index of a store atomically. """
+
+    tmpfile = os.path.join(storedir, INDEX + '.tmp')
+    with open(tmpfile, 'w') as file:
+        json.dump(index, file, indent=1)
+    os.replace(tmpfile, os.path.join(storedir, INDEX))
@@ -0,0 +1,102 @@
+""" Synthetic data sets with the same layout as the Kahana feature CSVs, for testing and benchmarking. """
+
+import os
+import numpy as np
+import pandas as pd
+from kah_data import CSVFILES
+
+# Regions and the lobe each belongs to.
+REGION_LOBES = {'ltl':'T', 'lpfc':'F', 'mtl':'T', 'occ':'O'}
+
+# Features per time window in each data set.
+TIMEWINS = ['pre', 'early', 'late']
+STSC_FEATURES = ['theta', 'hfa', 'slope', 'rawpac', 'normpac']
+STMC_FEATURES = ['rawpac', 'normpac']
+
+def make_datasets(nsubj=3, nchan=8, ntrial=40, seed=0):
+    """ Make synthetic 'stsc', 'stmc', 'sc', and 'mc' data sets.
+
+    Parameters
+    ----------
+    nsubj : int, optional
+        Number of subjects. default: 3
+    nchan : int, optional
+        Number of channels per subject. All pairs of channels are included in 'stmc'. default: 8
+    ntrial : int, optional
+        Number of trials per subject. default: 40
+    seed : int, optional
+        Random state seed. default: 0
+
+    Returns
+    -------
+    datasets : dict of Pandas Dataframes
+        Data sets, keyed by name.
+    """
+
+    rng = np.random.RandomState(seed)
+    regions = list(REGION_LOBES)
+
+    # Separate random state for phase encoding, so the other data sets are the same as without it.
+    rng_mc = np.random.RandomState(seed + 1)
+
+    stsc, stmc, sc, mc = [], [], [], []
+    for isubj in range(nsubj):
+        subject = 'R{:04d}S'.format(isubj)
+        chans = ['CH{}'.format(ichan) for ichan in range(nchan)]
+        chanregions = [regions[ichan % len(regions)] for ichan in range(nchan)]
+        chanlobes = [REGION_LOBES[region] for region in chanregions]
+        trials = np.arange(1, ntrial + 1)
+        encoding = rng.randint(0, 2, ntrial)
+
+        # Single-channel features.
+        sc.append(pd.DataFrame({'subject':subject, 'age':30. + isubj, 'channel':chans, 'lobe':chanlobes, 'region':chanregions,
+                                'thetabump':rng.randint(0, 2, nchan), 'pvalposttheta':rng.uniform(size=nchan)}))
+
+        # Single-trial, single-channel features.
+        data = {'subject':subject, 'age':30. + isubj, 'channel':np.repeat(chans, ntrial), 'lobe':np.repeat(chanlobes, ntrial),
+                'region':np.repeat(chanregions, ntrial), 'trial':np.tile(trials, nchan), 'encoding':np.tile(encoding, nchan)}
+        for feature in STSC_FEATURES:
+            for timewin in TIMEWINS:
+                data[timewin + feature] = rng.randn(nchan * ntrial)
+        data['posttheta'] = rng.randn(nchan * ntrial)
+        data['posthfa'] = rng.randn(nchan * ntrial)
+        for feature in ['earlytheta_cf', 'latetheta_cf', 'normtspac_cf']:
+            data[feature] = rng.randn(nchan * ntrial)
+        stsc.append(pd.DataFrame(data))
+
+        # Single-trial, multi-channel features.
+        chanA, chanB = np.triu_indices(nchan, k=1)
+        npair = len(chanA)
+        data = {'subject':subject, 'age':30. + isubj, 'pair':np.repeat(np.arange(1, npair + 1), ntrial),
+                'channelA':np.repeat(np.array(chans)[chanA], ntrial), 'channelB':np.repeat(np.array(chans)[chanB], ntrial),
+                'lobeA':np.repeat(np.array(chanlobes)[chanA], ntrial), 'lobeB':np.repeat(np.array(chanlobes)[chanB], ntrial),
+                'regionA':np.repeat(np.array(chanregions)[chanA], ntrial), 'regionB':np.repeat(np.array(chanregions)[chanB], ntrial),
+                'trial':np.tile(trials, npair), 'encoding':np.tile(encoding, npair)}
+        for feature in STMC_FEATURES:
+            for direction in ['AB', 'BA']:
+                for timewin in TIMEWINS:
+                    data[timewin + feature + direction] = rng.randn(npair * ntrial)
+
+        # Between-channel PAC in the strongest direction, labeled by the lobes of the phase and amplitude channels.
+        data['normtspacAB'] = rng.randn(npair * ntrial)
+        data['normtspacBA'] = rng.randn(npair * ntrial)
+        data['normtspacmax'] = np.maximum(data['normtspacAB'], data['normtspacBA'])
+        ab = data['normtspacAB'] > data['normtspacBA']
+        data['direction'] = np.where(ab, np.char.add(data['lobeA'], data['lobeB']), np.char.add(data['lobeB'], data['lobeA']))
+        stmc.append(pd.DataFrame(data))
+
+        # Phase encoding per channel pair.
+        pairdata = {'subject':subject, 'age':30. + isubj, 'pair':np.arange(1, npair + 1)}
+        pairdata.update({column:data[column][::ntrial] for column in ['channelA', 'channelB', 'lobeA', 'lobeB', 'regionA', 'regionB']})
+        pairdata['encodingepisodes'] = rng_mc.randint(0, 3, npair)
+        pairdata['encodingonset'] = np.where(pairdata['encodingepisodes'] > 0, rng_mc.uniform(0, 1.6, npair), np.nan)
+        mc.append(pd.DataFrame(pairdata))
+
+    return {'stsc':pd.concat(stsc, ignore_index=True), 'stmc':pd.concat(stmc, ignore_index=True), 'sc':pd.concat(sc, ignore_index=True),
+            'mc':pd.concat(mc, ignore_index=True)}
+
+def write_csvs(datasets, csvpath):
+    """ Write data sets to CSVs named as KahData expects. """
+
+    for dataset in datasets:
+        datasets[dataset].to_csv(os.path.join(csvpath, CSVFILES[dataset]), index=False)
@@ -0,0 +1,259 @@
+""" Between-channel time-series PAC (tsPAC) of Kahana data, for all channel pairs, directions, trials, and surrogates at once.
+
+Follows kah_calculatepac.m: theta phase of one channel is coupled to HFA amplitude of the other channel in the pair, in
+both directions ('AB' is phase of channel A and HFA of channel B), using the Ozkurt measure. Surrogates circularly shift
+the HFA of each trial by a number of samples, and normalized PAC is the z-score of the raw PAC against its surrogates.
+
+The Ozkurt numerator of every circular shift is the circular cross-correlation of HFA with exp(1j * phase), so all
+shifts of a trial are computed with one inverse FFT. FFTs of each channel's phase and HFA are computed once and shared by
+all pairs.
+"""
+
+import itertools
+import os
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+from kah_psd import is_hdf5_mat, HAVE_H5PY
+
+if HAVE_H5PY:
+    import h5py
+
+# Time windows of the 'stmc' PAC columns, in ms.
+TIMEWINS = {'pre':[-800, 0], 'early':[0, 800], 'late':[800, 1600]}
+
+# Time window of the 'normtspac' columns of 'stmc', in ms: the whole encoding period.
+TSPAC_TIMEWIN = [0, 1600]
+
+# Directions of PAC between channels A and B, as phase channel then amplitude channel.
+DIRECTIONS = ['AB', 'BA']
+
+# Number of surrogates per trial and direction.
+NSURROGATE = 200
+
+# Number of channel pairs to compute at a time.
+PAIRBLOCK = 64
+
+# Identifier columns of 'stmc', before the PAC columns.
+ID_COLUMNS = ['subject', 'age', 'pair', 'channelA', 'channelB', 'lobeA', 'lobeB', 'regionA', 'regionB', 'trial', 'encoding']
+
+# Columns of 'stmc' after the PAC columns: normalized tsPAC of the encoding period in each direction and in the stronger
+# direction, and the stronger direction as the lobes of its phase and amplitude channels (e.g. 'TF').
+TSPAC_COLUMNS = ['normtspacAB', 'normtspacBA', 'normtspacmax', 'direction']
+
+def pac_columns():
+    """ Get the names of the PAC columns of 'stmc', in order. """
+
+    return ['{}{}pac{}'.format(timewin, pactype, direction) for pactype in ['raw', 'norm'] for direction in DIRECTIONS for timewin in TIMEWINS]
+
+def read_mat_array(path, name):
+    """ Read a numeric array from a .mat file, with dimensions in MATLAB order whether or not it was saved with -v7.3. """
+
+    if is_hdf5_mat(path):
+        if not HAVE_H5PY:
+            raise ImportError('h5py is required to read -v7.3 .mat files.')
+        with h5py.File(path, 'r') as file:
+            return file[name][()].T
+
+    return sio.loadmat(path, variable_names=[name])[name]
+
+def memmap_timeseries(path, cachedir):
+    """ Get the 'channels x times x trials' data and times (in seconds) of a phase or HFA .mat file, memory-mapped.
+
+    The data are converted once to a .npy file in cachedir, one channel at a time for -v7.3 files, and the .npy file is
+    reused while it is newer than the .mat file. Nothing is written next to the .mat file.
+    """
+
+    os.makedirs(cachedir, exist_ok=True)
+    npyfile = os.path.join(cachedir, os.path.splitext(os.path.basename(path))[0] + '_data.npy')
+    times = np.squeeze(read_mat_array(path, 'times'))
+    if os.path.isfile(npyfile) and os.path.getmtime(npyfile) >= os.path.getmtime(path):
+        return np.load(npyfile, mmap_mode='r'), times
+
+    tmpfile = npyfile + '.tmp'
+    if is_hdf5_mat(path):
+        if not HAVE_H5PY:
+            raise ImportError('h5py is required to read -v7.3 .mat files.')
+        with h5py.File(path, 'r') as file:
+            # MATLAB stores arrays column-major, so HDF5 datasets have dimensions reversed.
+            dataset = file['data']
+            data = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.float64, shape=dataset.shape[::-1])
+            for ichan in range(data.shape[0]):
+                data[ichan] = dataset[:, :, ichan].T
+            data.flush()
+            del data
+    else:
+        with open(tmpfile, 'wb') as file:
+            np.save(file, sio.loadmat(path, variable_names=['data'])['data'].astype(np.float64))
+    os.replace(tmpfile, npyfile)
+
+    return np.load(npyfile, mmap_mode='r'), times
+
+def window_indices(times, timewin):
+    """ Get the slice of samples from the nearest sample to the start of a time window (in ms) to the nearest to its end. """
+
+    start, stop = [int(np.argmin(np.abs(times - edge / 1000))) for edge in timewin]
+
+    return slice(start, stop + 1)
+
+def pair_indices(nchan):
+    """ Get 0-based channel indices of every pair, in the order of MATLAB's nchoosek(1:nchan, 2), as two arrays. """
+
+    pairs = np.array(list(itertools.combinations(range(nchan), 2)), dtype=np.intp).reshape(-1, 2)
+
+    return pairs[:, 0], pairs[:, 1]
+
+def random_shifts(npair, ntrial, nsamp, nsurrogate=NSURROGATE, seed=0):
+    """ Draw distinct circular shifts per pair, trial, and direction, between 2 and nsamp samples as in
+    kah_4_pac_0_shifttrials.m. Returns a 'pairs x trials x directions x surrogates' array.
+    """
+
+    rng = np.random.RandomState(seed)
+    shifts = np.empty([npair, ntrial, len(DIRECTIONS), nsurrogate], dtype=np.int64)
+    for ipair in range(npair):
+        keys = rng.rand(ntrial, len(DIRECTIONS), nsamp - 1)
+        shifts[ipair] = np.argsort(keys, axis=-1)[..., :nsurrogate] + 2
+
+    return shifts
+
+def ozkurt_pac(phase, amp, shifts):
+    """ Ozkurt PAC of phase and amplitude time series, unshifted and with the amplitude circularly shifted.
+
+    Parameters
+    ----------
+    phase : array
+        Phase time series, with time along the last axis.
+    amp : array
+        Amplitude time series, the same shape as phase.
+    shifts : array
+        Samples to shift amplitude by for each surrogate, as MATLAB's circshift(amp, shift). Same shape as phase, except
+        for the last axis, which has one entry per surrogate.
+
+    Returns
+    -------
+    raw : array
+        PAC of each time series, with the time axis removed.
+    surrogate : array
+        PAC of each shift, the same shape as shifts.
+    """
+
+    nsamp = phase.shape[-1]
+    crosscorr = np.fft.ifft(np.fft.fft(np.exp(1j * phase), axis=-1) * np.conj(np.fft.fft(amp, axis=-1)), axis=-1)
+    norm = np.sqrt(nsamp) * np.sqrt(np.sum(np.asarray(amp) ** 2, axis=-1))
+
+    raw = np.abs(crosscorr[..., 0]) / norm
+    surrogate = np.abs(np.take_along_axis(crosscorr, np.asarray(shifts) % nsamp, axis=-1)) / norm[..., None]
+
+    return raw, surrogate
+
+def calculate_tspac(phase, amp, shifts, pairblock=PAIRBLOCK):
+    """ Calculate raw and normalized tsPAC of every channel pair, direction, and trial.
+
+    Parameters
+    ----------
+    phase : 'channels x times x trials' array
+        Theta phase, limited to the time window. Can be memory-mapped.
+    amp : 'channels x times x trials' array
+        HFA amplitude, limited to the time window. Can be memory-mapped.
+    shifts : 'pairs x trials x directions x surrogates' array
+        Samples to shift HFA by for each surrogate, with pairs in the order of pair_indices().
+    pairblock : int, optional
+        Number of pairs to compute at a time. default: 64
+
+    Returns
+    -------
+    raw : 'pairs x trials x directions' array
+        Raw PAC.
+    norm : 'pairs x trials x directions' array
+        Raw PAC z-scored against the surrogates, with the sample standard deviation as in MATLAB's std().
+    """
+
+    nchan, nsamp, ntrial = phase.shape
+    chanA, chanB = pair_indices(nchan)
+
+    # FFTs and amplitude norms of each channel, as 'channels x trials x frequencies', read one channel at a time.
+    phasefft = np.empty([nchan, ntrial, nsamp], dtype=complex)
+    ampfft = np.empty([nchan, ntrial, nsamp], dtype=complex)
+    ampnorm = np.empty([nchan, ntrial])
+    for ichan in range(nchan):
+        phasefft[ichan] = np.fft.fft(np.exp(1j * np.asarray(phase[ichan]).T), axis=-1)
+        ampchan = np.asarray(amp[ichan]).T
+        ampfft[ichan] = np.conj(np.fft.fft(ampchan, axis=-1))
+        ampnorm[ichan] = np.sqrt(nsamp) * np.sqrt(np.sum(ampchan ** 2, axis=-1))
+
+    raw = np.empty([len(chanA), ntrial, len(DIRECTIONS)])
+    norm = np.empty([len(chanA), ntrial, len(DIRECTIONS)])
+    for start in range(0, len(chanA), pairblock):
+        block = slice(start, start + pairblock)
+
+        # Phase of A with HFA of B, then phase of B with HFA of A.
+        for idir, (phasechan, ampchan) in enumerate([(chanA[block], chanB[block]), (chanB[block], chanA[block])]):
+            crosscorr = np.fft.ifft(phasefft[phasechan] * ampfft[ampchan], axis=-1)
+            surrogate = np.abs(np.take_along_axis(crosscorr, shifts[block, :, idir] % nsamp, axis=-1)) / ampnorm[ampchan][..., None]
+            raw[block, :, idir] = np.abs(crosscorr[..., 0]) / ampnorm[ampchan]
+            norm[block, :, idir] = (raw[block, :, idir] - surrogate.mean(axis=-1)) / surrogate.std(axis=-1, ddof=1)
+
+    return raw, norm
+
+def stmc_rows(pairinfo, encoding, pac, tspac):
+    """ Arrange tsPAC of one subject as rows of the 'stmc' data set, one per pair and trial.
+
+    Parameters
+    ----------
+    pairinfo : Pandas Dataframe
+        One row per pair, in pair order, with 'subject', 'age', 'pair', 'channelA', 'channelB', 'lobeA', 'lobeB',
+        'regionA', and 'regionB'.
+    encoding : 1D array
+        Encoding outcome of each trial.
+    pac : dict
+        (raw, norm) output of calculate_tspac() for each time window in TIMEWINS.
+    tspac : tuple
+        (raw, norm) output of calculate_tspac() for TSPAC_TIMEWIN.
+
+    Returns
+    -------
+    rows : Pandas Dataframe
+        Rows in the 'stmc' column order (ID_COLUMNS, pac_columns(), then TSPAC_COLUMNS), sorted by pair and then trial,
+        with 1-based trial numbers.
+    """
+
+    npair, ntrial = len(pairinfo), len(encoding)
+    rows = pairinfo.loc[np.repeat(np.arange(npair), ntrial), ID_COLUMNS[:-2]].reset_index(drop=True)
+    rows['trial'] = np.tile(np.arange(1, ntrial + 1), npair)
+    rows['encoding'] = np.tile(np.asarray(encoding), npair)
+
+    for pactype, itype in [('raw', 0), ('norm', 1)]:
+        for idir, direction in enumerate(DIRECTIONS):
+            for timewin in TIMEWINS:
+                rows['{}{}pac{}'.format(timewin, pactype, direction)] = pac[timewin][itype][:, :, idir].ravel()
+
+    # Normalized PAC of the encoding period, and the direction it is strongest in, labeled phase lobe then amplitude lobe.
+    for idir, direction in enumerate(DIRECTIONS):
+        rows['normtspac' + direction] = tspac[1][:, :, idir].ravel()
+    rows['normtspacmax'] = np.maximum(rows['normtspacAB'], rows['normtspacBA'])
+    ab = (rows['normtspacAB'] > rows['normtspacBA']).to_numpy()
+    rows['direction'] = np.where(ab, rows['lobeA'] + rows['lobeB'], rows['lobeB'] + rows['lobeA'])
+
+    return rows
+
+def validate(rows, existing):
+    """ Compare computed 'stmc' rows with existing ones, matched by subject, pair, and trial.
+
+    Returns a Dataframe with the number of matched rows, the largest absolute difference, and the correlation of each
+    PAC column, and for 'direction', the share of rows with the same label in 'corr'. Normalized PAC only matches closely
+    if the same surrogate shifts were used.
+    """
+
+    merged = rows.merge(existing, on=['subject', 'pair', 'trial'], suffixes=('', '_existing'))
+    summary = []
+    for column in pac_columns() + TSPAC_COLUMNS[:-1]:
+        new, old = merged[column].to_numpy(), merged[column + '_existing'].to_numpy()
+        valid = np.isfinite(new) & np.isfinite(old)
+        summary.append({'column':column, 'nrows':int(valid.sum()), 'maxdiff':np.max(np.abs(new[valid] - old[valid]), initial=0.),
+                        'corr':np.corrcoef(new[valid], old[valid])[0, 1] if valid.sum() > 1 else np.nan})
+
+    # Share of rows with the same strongest direction.
+    summary.append({'column':'direction', 'nrows':len(merged), 'maxdiff':np.nan,
+                    'corr':np.mean(merged['direction'] == merged['direction_existing']) if len(merged) else np.nan})
+
+    return pd.DataFrame(summary)
@@ -0,0 +1,77 @@
+""" Tests for closed-form aperiodic fits, compared with the curve fits FOOOF does, using synthetic spectra. """
+
+import numpy as np
+import pytest
+from scipy.optimize import curve_fit
+import kah_run_fooof_trials
+from kah_aperiodic import fit_aperiodic, validate, PERCENTILE_THRESH
+from kah_run_fooof_trials import FOOOF_SETTINGS, FREQ_RANGE
+
+def background(freq, offset, exponent):
+    """ FOOOF's 'fixed' background function. """
+
+    return offset - np.log10(freq ** exponent)
+
+def make_psds(nchan=4, ntrial=5, seed=0):
+    """ Make noisy 1/f spectra with a theta peak, as 'channels x frequencies x trials'. """
+
+    rng = np.random.RandomState(seed)
+    freq = np.arange(1, 201, 2.)
+    exponent = rng.uniform(1, 3, (nchan, 1, ntrial))
+    logpower = rng.randn(nchan, 1, ntrial) - exponent * np.log10(freq)[None, :, None] + 0.5 * np.exp(-(freq[None, :, None] - 7) ** 2 / 8)
+    psds = 10 ** (logpower + 0.1 * rng.randn(nchan, len(freq), ntrial))
+
+    return freq, psds
+
+def curve_fit_spectrum(freq, psd, robust):
+    """ Fit one spectrum the way FOOOF fits its background. """
+
+    infreq = (freq >= 2) & (freq <= 150)
+    freq, logpower = freq[infreq], np.log10(psd[infreq])
+    popt, _ = curve_fit(background, freq, logpower, p0=[logpower[0], 2])
+    if robust:
+        flatspec = logpower - background(freq, *popt)
+        flatspec[flatspec < 0] = 0
+        mask = flatspec <= np.percentile(flatspec, PERCENTILE_THRESH)
+        popt, _ = curve_fit(background, freq[mask], logpower[mask], p0=popt)
+
+    return popt
+
+@pytest.mark.parametrize('robust', [False, True])
+def test_fit_aperiodic_matches_curve_fit(robust):
+    """ Test that batched closed-form fits match fitting each spectrum with curve_fit. """
+
+    freq, psds = make_psds()
+    offset, exponent, ok = fit_aperiodic(freq, psds, robust=robust)
+    assert offset.shape == (4, 5) and ok.all()
+
+    for ichan in range(psds.shape[0]):
+        for itrial in range(psds.shape[2]):
+            popt = curve_fit_spectrum(freq, psds[ichan, :, itrial], robust)
+            assert offset[ichan, itrial] == pytest.approx(popt[0], abs=1e-6)
+            assert exponent[ichan, itrial] == pytest.approx(popt[1], abs=1e-6)
+
+def test_fit_aperiodic_marks_failed_fits():
+    """ Test that spectra with non-positive power fail, without affecting other spectra. """
+
+    freq, psds = make_psds()
+    psds[1, 10, 2] = 0
+    offset, exponent, ok = fit_aperiodic(freq, psds)
+    assert not ok[1, 2] and np.isnan(offset[1, 2]) and np.isnan(exponent[1, 2])
+    assert ok.sum() == ok.size - 1
+
+def test_validate_against_fooof():
+    """ Test that closed-form fits match FOOOF, if it is installed. """
+
+    pytest.importorskip('fooof')
+    freq, psds = make_psds()
+    maxdiff = validate(freq, psds, FOOOF_SETTINGS, FREQ_RANGE, nspectra=20)
+    assert maxdiff['status'] == 0
+    assert maxdiff['offset'] < 1e-4 and maxdiff['exponent'] < 1e-4
+
+def test_fooof_engine_requires_fooof(monkeypatch):
+    """ Test that fitting with FOOOF fails up front with ImportError if fooof isn't installed. """
+
+    monkeypatch.setattr(kah_run_fooof_trials, 'HAVE_FOOOF', False)
+    with pytest.raises(ImportError):
+        kah_run_fooof_trials.run_fooof_trials([[0, 800]], '', engine='fooof')
@@ -0,0 +1,124 @@
+""" Tests for the columnar cache of the Kahana feature CSVs, using synthetic data. """
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import kah_cache
+from kah_data import KahData, DATASETS, csv_dtypes, feature_sources
+
+pytest.importorskip('pyarrow')
+
+def write_csv(csvfile, nsubj=3, nchan=4):
+    """ Write a synthetic single-channel CSV, with one row per channel of each subject. """
+
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'subject':['R{:04d}S'.format(isubj) for isubj in range(nsubj) for _ in range(nchan)],
+                         'channel':['CH{}'.format(ichan) for _ in range(nsubj) for ichan in range(nchan)]})
+    data['pvalposttheta'] = rng.uniform(size=len(data))
+    data['thetabump'] = rng.integers(0, 2, size=len(data))
+    data.to_csv(csvfile, index=False)
+
+@pytest.fixture
+def cached_csv(tmp_path):
+    """ Write a synthetic 'sc' CSV and convert it to the cache. """
+
+    csvfile = str(tmp_path / 'sc.csv')
+    write_csv(csvfile)
+    cachedir = str(tmp_path / 'cache' / 'sc')
+    kah_cache.convert_csv(csvfile, cachedir, dtype=csv_dtypes(csvfile))
+
+    return csvfile, cachedir
+
+def test_unchanged_csv_not_hashed(cached_csv, monkeypatch):
+    """ Test that a CSV with the same size and modification time is current without being read. """
+
+    csvfile, cachedir = cached_csv
+    monkeypatch.setattr(kah_cache, 'file_hash', lambda path: pytest.fail('Unchanged CSV was hashed.'))
+    assert kah_cache.is_current(csvfile, cachedir)
+
+def test_touched_csv_kept(cached_csv, monkeypatch):
+    """ Test that touching a CSV keeps its cache, hashing the CSV only once. """
+
+    csvfile, cachedir = cached_csv
+    stat = os.stat(csvfile)
+    os.utime(csvfile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    partitions = {path:os.stat(os.path.join(root, path)).st_mtime_ns for root, _, files in os.walk(cachedir) for path in files if path.endswith('.parquet')}
+
+    nhash = []
+    file_hash = kah_cache.file_hash
+    monkeypatch.setattr(kah_cache, 'file_hash', lambda path: nhash.append(path) or file_hash(path))
+    assert kah_cache.is_current(csvfile, cachedir)
+    assert kah_cache.is_current(csvfile, cachedir)
+    assert len(nhash) == 1
+    assert kah_cache.read_manifest(cachedir)['mtime_ns'] == stat.st_mtime_ns + 10**9
+    assert partitions == {path:os.stat(os.path.join(root, path)).st_mtime_ns for root, _, files in os.walk(cachedir) for path in files if path.endswith('.parquet')}
+
+def test_changed_csv_invalidates(cached_csv):
+    """ Test that changing a CSV's contents invalidates its cache, whether or not its size changed. """
+
+    csvfile, cachedir = cached_csv
+    with open(csvfile) as file:
+        text = file.read()
+    stat = os.stat(csvfile)
+
+    # Same size and modification time, different contents.
+    with open(csvfile, 'w') as file:
+        file.write(text.replace('CH1', 'CH9'))
+    os.utime(csvfile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert os.path.getsize(csvfile) == stat.st_size
+    assert not kah_cache.is_current(csvfile, cachedir)
+
+    # Different size.
+    with open(csvfile, 'w') as file:
+        file.write(text + text.splitlines()[-1] + '\n')
+    assert not kah_cache.is_current(csvfile, cachedir)
+
+    kah_cache.convert_csv(csvfile, cachedir, dtype=csv_dtypes(csvfile))
+    assert kah_cache.is_current(csvfile, cachedir)
+    assert len(kah_cache.read_partitions(cachedir)) == len(text.splitlines())
+
+def test_read_no_rows(cached_csv, tmp_path):
+    """ Test that reads matching no rows keep the data set's columns and types, including data sets with no rows. """
+
+    csvfile, cachedir = cached_csv
+    full = kah_cache.read_partitions(cachedir, columns=['subject', 'channel', 'pvalposttheta'])
+    empty = kah_cache.read_partitions(cachedir, subjects=['R9999S'], columns=['subject', 'channel', 'pvalposttheta'])
+    assert len(empty) == 0
+    pd.testing.assert_series_equal(empty.dtypes, full.dtypes)
+
+    emptyfile = str(tmp_path / 'empty.csv')
+    pd.read_csv(csvfile, nrows=0).to_csv(emptyfile, index=False)
+    emptydir = str(tmp_path / 'cache' / 'empty')
+    kah_cache.convert_csv(emptyfile, emptydir, dtype=csv_dtypes(emptyfile))
+    empty = kah_cache.read_partitions(emptydir)
+    assert len(empty) == 0
+    pd.testing.assert_series_equal(empty.dtypes, kah_cache.read_partitions(cachedir).dtypes)
+
+def test_delta_feature_columns(tmp_path):
+    """ Test that requesting a delta feature loads its source columns, and that missing features raise KeyError. """
+
+    assert feature_sources('earlythetadelta') == ['earlytheta', 'pretheta']
+    assert feature_sources('laterawpacdelta') == ['laterawpac', 'prerawpac']
+    assert feature_sources('earlyhfa') == ['earlyhfa']
+
+    csvpath_prev, cachepath_prev = KahData.csvpath, KahData.cachepath
+    KahData.set_csvpath(str(tmp_path))
+    try:
+        pd.DataFrame(columns=['subject', 'channel', 'trial', 'pretheta', 'earlytheta', 'latetheta', 'prehfa', 'earlyhfa']).to_csv(KahData.paths['stsc'], index=False)
+
+        data = KahData.__new__(KahData)
+        data.features = ['earlythetadelta', 'earlyhfa']
+        assert data._get_columns('stsc') == ['subject', 'channel', 'trial', 'pretheta', 'earlytheta', 'earlyhfa']
+    finally:
+        KahData.set_csvpath(csvpath_prev, cachepath_prev)
+
+    # Features are checked against every data set, after deltas are calculated.
+    for dataset in DATASETS:
+        setattr(data, dataset, pd.DataFrame(columns=['subject']))
+    data.stsc = pd.DataFrame(columns=['subject', 'earlythetadelta', 'earlyhfa'])
+    data._check_features()
+
+    data.features = ['earlythetadelta', 'earlynotafeaturedelta']
+    with pytest.raises(KeyError):
+        data._check_features()
@@ -0,0 +1,118 @@
+""" Tests for the KahClassifier class and its helpers, using synthetic data. """
+
+import pickle
+import numpy as np
+import pytest
+from sklearn import utils
+from sklearn.linear_model import LogisticRegressionCV
+from sklearn.metrics import roc_auc_score
+from sklearn.preprocessing import StandardScaler
+import kah_classify_encoding
+from kah_classifier import KahClassifier, PredictorMatrix, SplitCache, rank_auc, resample_indices
+
+@pytest.mark.parametrize('resample', ['permute', 'bootstrap'])
+def test_rank_auc_matches_resampling_loop(resample):
+    """ Test that batched resampled AUCs match resampling and scoring one resample at a time. """
+
+    rng = np.random.RandomState(0)
+    scores = np.round(rng.rand(60), 2) # rounded to include ties
+    labels = rng.randint(0, 2, 60)
+
+    indices = resample_indices(len(labels), 100, resample)
+    auc = rank_auc(scores[indices] if resample == 'bootstrap' else scores, labels[indices])
+
+    for iresample in range(100):
+        if resample == 'bootstrap':
+            scores_resample, labels_resample = utils.resample(scores, labels, random_state=iresample)
+        else:
+            scores_resample, labels_resample = scores, utils.shuffle(labels, random_state=iresample)
+        assert auc[iresample] == pytest.approx(roc_auc_score(labels_resample, scores_resample), abs=1e-12)
+
+def test_rank_auc_single_class():
+    """ Test that AUC is NaN when only one class is present. """
+
+    assert np.isnan(rank_auc(np.array([0.1, 0.5, 0.9]), np.array([1, 1, 1])))
+
+def make_predictors(ntrial=120, npred=4, seed=0):
+    """ Make a PredictorMatrix() with one informative predictor. """
+
+    rng = np.random.RandomState(seed)
+    values = np.asfortranarray(rng.randn(ntrial, npred + 1).astype(np.float32))
+    values[:, -1] = (values[:, 0] + rng.randn(ntrial) > 0).astype(np.float32)
+    predictors = [('measure{}'.format(ipred), 'T') for ipred in range(npred)]
+
+    return PredictorMatrix(values, predictors, 'R0000S')
+
+def test_logistic_numpy_matches_liblinear():
+    """ Test that the NumPy solver picks the same C and coefficients as LogisticRegressionCV with liblinear. """
+
+    matrix = make_predictors()
+    sklearn_clf = KahClassifier(predictors=matrix.predictors)
+    numpy_clf = KahClassifier(predictors=matrix.predictors)
+    sklearn_clf.classify(matrix, 'logistic')
+    numpy_clf.classify(matrix, 'logistic_numpy')
+
+    for estimator in ['roc_estimator_', 'final_estimator_']:
+        assert getattr(numpy_clf, estimator).C_ == pytest.approx(getattr(sklearn_clf, estimator).C_)
+        np.testing.assert_allclose(getattr(numpy_clf, estimator).coef_, getattr(sklearn_clf, estimator).coef_, atol=1e-3)
+        np.testing.assert_allclose(getattr(numpy_clf, estimator).intercept_, getattr(sklearn_clf, estimator).intercept_, atol=1e-3)
+    assert numpy_clf.roc_auc_ == pytest.approx(sklearn_clf.roc_auc_, abs=1e-6)
+
+def test_classify_seeds_matches_classify():
+    """ Test that classifying many seeds at once gives the same AUCs as classifying one seed at a time. """
+
+    matrix = make_predictors()
+    clf = KahClassifier(predictors=matrix.predictors)
+    auc, auc_resample = clf.classify_seeds(matrix, range(5), resample='permute', nresample=20)
+
+    for seed in range(5):
+        clf.seed = seed
+        clf.classify(matrix, 'logistic', resample='permute', nresample=20)
+        assert auc[seed] == pytest.approx(clf.roc_auc_, abs=1e-6)
+        np.testing.assert_allclose(auc_resample[seed], clf.roc_auc_resample_, atol=1e-6)
+
+@pytest.mark.parametrize('method', ['logistic', 'logistic_numpy'])
+def test_fit_final_single_C_matches_search(method):
+    """ Test that refitting with one C, without cross-validation, matches a search over that single C. """
+
+    matrix = make_predictors()
+    clf = KahClassifier(predictors=matrix.predictors)
+    clf.classify(matrix, method, fit_final=False)
+    assert not hasattr(clf, 'final_estimator_')
+
+    C = clf.fit_final(matrix, method).C_[0]
+    coef = clf.fit_final(matrix, method, hyperparameters={'C':[C]}, need_aggregate=False).coef_
+
+    X = StandardScaler().fit_transform(clf.predvals)
+    search = LogisticRegressionCV(Cs=[C], cv=5, scoring='roc_auc', solver='liblinear', class_weight='balanced').fit(X, clf.labels)
+    np.testing.assert_allclose(coef, search.coef_, atol=1e-3)
+
+def test_split_cache_matches_split_per_subset():
+    """ Test that slicing a shared split and scaling gives the same AUCs as splitting and scaling each predictor subset. """
+
+    matrix = make_predictors()
+    splits = SplitCache(matrix, range(3))
+    for predictors in [matrix.predictors[2:3], [matrix.predictors[3], matrix.predictors[0]]]:
+        clf = KahClassifier(predictors=predictors)
+        for seed in range(3):
+            clf.seed = seed
+            clf.classify(matrix, 'logistic', fit_final=False)
+            auc = clf.roc_auc_
+            clf.classify(splits, 'logistic', fit_final=False)
+            assert clf.roc_auc_ == pytest.approx(auc, abs=1e-6)
+
+def test_classify_encoding_parallel_matches_serial(tmp_path, monkeypatch):
+    """ Test that classifying seeds over several processes gives bit-identical AUCs to classifying them serially. """
+
+    subjects = [make_predictors(seed=seed) for seed in range(2)]
+    monkeypatch.setattr(kah_classify_encoding, 'load_predictors', lambda *args, **kwargs: subjects)
+
+    results = {}
+    for n_jobs in [1, 2]:
+        filename = str(tmp_path / 'auc_{}.pickle'.format(n_jobs))
+        kah_classify_encoding.classify_encoding(('all', None), 5, 10, subjects[0].predictors[:3], filename, n_jobs=n_jobs, chunksize=2)
+        with open(filename, 'rb') as file:
+            results[n_jobs] = pickle.load(file)
+
+    np.testing.assert_array_equal(results[2]['auc'], results[1]['auc'])
+    np.testing.assert_array_equal(results[2]['auc_resample'], results[1]['auc_resample'])
@@ -0,0 +1,169 @@
+""" Tests that vectorized KahData steps match the original row-by-row implementations, using synthetic data. """
+
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+import kah_cache
+from kah_data import KahData, DATASETS, build_subjects, subject_csvs
+from kah_legacy import LegacyKahData
+from kah_synthetic import make_datasets, write_csvs
+
+@pytest.fixture(scope='module')
+def synthetic_csvs(tmp_path_factory):
+    """ Point KahData to synthetic CSVs. """
+
+    csvpath = tmp_path_factory.mktemp('csv')
+    write_csvs(make_datasets(nsubj=3, nchan=8, ntrial=30), str(csvpath))
+
+    csvpath_prev, cachepath_prev = KahData.csvpath, KahData.cachepath
+    KahData.set_csvpath(str(csvpath))
+    yield
+    KahData.set_csvpath(csvpath_prev, cachepath_prev)
+
+def assert_same_data(kwargs):
+    """ Check that KahData() and LegacyKahData() give identical data sets for the same inputs. """
+
+    new = KahData(**kwargs)
+    legacy = LegacyKahData(**kwargs)
+    for dataset in DATASETS:
+        datanew = getattr(new, dataset).reset_index(drop=True)
+        datalegacy = getattr(legacy, dataset).reset_index(drop=True)
+
+        # Direction labels are categorical, but have the same values as the original string labels.
+        for column in datanew.select_dtypes('category'):
+            datanew[column] = datanew[column].astype(datalegacy[column].dtype)
+
+        pd.testing.assert_frame_equal(datanew, datalegacy)
+
+@pytest.mark.parametrize('subject', ['all', 'R0001S'])
+@pytest.mark.parametrize('theta', [{'theta_threshtype':'bump'},
+                                   {'theta_threshtype':'pval', 'theta_threshlevel':0.3},
+                                   {'theta_threshtype':'percent', 'theta_threshlevel':0.5}])
+@pytest.mark.parametrize('exclusion', [{}, {'enforce_theta':True}, {'exclude_theta':True}])
+def test_filters_match_legacy(synthetic_csvs, subject, theta, exclusion):
+    """ Test that filtering and between-channel PAC give the same output as the original implementation. """
+
+    assert_same_data(dict(subject=subject, include_regions=['ltl', 'lpfc'], **theta, **exclusion))
+
+def test_no_region_filter_matches_legacy(synthetic_csvs):
+    """ Test that data are unchanged when no regions are excluded. """
+
+    assert_same_data(dict(subject='R0002S', theta_threshtype='percent', theta_threshlevel=0.4))
+
+@pytest.mark.parametrize('include_regions', ['ltlpfc', 'mtl', ('occ', 'ltl')])
+def test_region_strings_match_legacy(synthetic_csvs, include_regions):
+    """ Test that a string of regions keeps every region that is a substring of it, as in the original implementation. """
+
+    assert_same_data(dict(subject='R0000S', include_regions=include_regions))
+
+def test_betweenpac_direction_categorical(synthetic_csvs):
+    """ Test that direction labels are categorical and flip the region pair when PAC is stronger from B to A. """
+
+    data = KahData(subject='R0000S')
+    for timewin in ['pre', 'early', 'late']:
+        direction = data.stmc[timewin + 'rawpacdir']
+        assert isinstance(direction.dtype, pd.CategoricalDtype)
+
+        ab = data.stmc[timewin + 'rawpacABorBA']
+        assert np.all(direction[ab] == data.stmc['regionA'][ab] + '-' + data.stmc['regionB'][ab])
+        assert np.all(direction[~ab] == data.stmc['regionB'][~ab] + '-' + data.stmc['regionA'][~ab])
+
+def test_enforce_phase(synthetic_csvs):
+    """ Test that enforcing phase encoding keeps exactly the pairs with encoding episodes, matched by subject. """
+
+    data = KahData(enforce_phase=True)
+    encoding = KahData.mc[KahData.mc['encodingepisodes'] > 0]
+    assert len(data.stmc) > 0 and np.all(data.stmc['phasepair'] == 1)
+    assert set(zip(data.stmc['subject'], data.stmc['pair'])) == set(zip(encoding['subject'], encoding['pair']))
+    assert set(KahData().stmc['phasepair']) == {0, 1}
+
+VARIANTS = {'all':{}, 'theta':{'enforce_theta':True}, 'theta_phase':{'enforce_theta':True, 'enforce_phase':True}, 'notheta':{'exclude_theta':True}}
+
+def test_build_variants_match_individual(synthetic_csvs):
+    """ Test that variants built together match KahData() objects built one at a time. """
+
+    variants = KahData.build_variants(VARIANTS, subject='R0001S', include_regions=['ltl', 'lpfc'])
+    for name, exclusions in VARIANTS.items():
+        individual = KahData(subject='R0001S', include_regions=['ltl', 'lpfc'], **exclusions)
+        for dataset in DATASETS:
+            pd.testing.assert_frame_equal(getattr(variants[name], dataset), getattr(individual, dataset))
+
+def test_build_subjects_parallel(synthetic_csvs):
+    """ Test that building subjects over several processes gives the same data as building them serially. """
+
+    serial = build_subjects(['R0000S', 'R0002S'], VARIANTS, n_jobs=1, include_regions=['ltl', 'lpfc'])
+    parallel = build_subjects(['R0000S', 'R0002S'], VARIANTS, n_jobs=2, include_regions=['ltl', 'lpfc'])
+    for name in VARIANTS:
+        assert [data.subject for data in parallel[name]] == ['R0000S', 'R0002S']
+        for dataserial, dataparallel in zip(serial[name], parallel[name]):
+            for dataset in DATASETS:
+                # Row labels depend on whether rows came from the full data set or the subject's partition.
+                pd.testing.assert_frame_equal(getattr(dataserial, dataset).reset_index(drop=True), getattr(dataparallel, dataset).reset_index(drop=True))
+
+def test_combine_subject_csvs(tmp_path):
+    """ Test that per-subject 'stmc' CSVs combine into the same data set, and that only changed CSVs are reconverted. """
+
+    pytest.importorskip('pyarrow')
+    stmc = make_datasets(nsubj=3, nchan=5, ntrial=10)['stmc']
+    for subject, rows in stmc.groupby('subject', sort=False):
+        rows.to_csv(str(tmp_path / 'kah_singletrial_multichannel_{}.csv'.format(subject)), index=False)
+    subjects = list(stmc['subject'].unique())
+
+    csvpath_prev, cachepath_prev = KahData.csvpath, KahData.cachepath
+    KahData.set_csvpath(str(tmp_path))
+    try:
+        combined = KahData.load('stmc')
+        assert sorted(combined['subject'].unique()) == sorted(subjects)
+        pd.testing.assert_frame_equal(combined.sort_values(['subject', 'pair', 'trial']).reset_index(drop=True),
+                                      stmc.astype(combined.dtypes.to_dict()).sort_values(['subject', 'pair', 'trial']).reset_index(drop=True))
+
+        csvfiles = subject_csvs(str(tmp_path), 'stmc')
+        cachedir = KahData.convert('stmc')
+        assert kah_cache.combine_csvs(csvfiles, cachedir) == 0
+
+        # Changing one subject's CSV reconverts only that subject.
+        changed = stmc[stmc['subject'] == subjects[0]].iloc[:3]
+        changed.to_csv(str(tmp_path / 'kah_singletrial_multichannel_{}.csv'.format(subjects[0])), index=False)
+        assert kah_cache.combine_csvs(csvfiles, cachedir) == 1
+        assert len(kah_cache.read_partitions(cachedir, subjects=[subjects[0]])) == 3
+
+        # CSVs with other columns are rejected.
+        changed.drop(columns='trial').to_csv(str(tmp_path / 'kah_singletrial_multichannel_{}.csv'.format(subjects[1])), index=False)
+        with pytest.raises(ValueError):
+            kah_cache.combine_csvs(csvfiles, cachedir)
+    finally:
+        KahData.set_csvpath(csvpath_prev, cachepath_prev)
+
+def test_phase_encoding_optional(tmp_path):
+    """ Test that phase encoding per pair is only required to enforce phase encoding or to get 'phasepair'. """
+
+    write_csvs(make_datasets(nsubj=2, nchan=4, ntrial=10), str(tmp_path))
+    csvpath_prev, cachepath_prev = KahData.csvpath, KahData.cachepath
+    KahData.set_csvpath(str(tmp_path))
+    try:
+        # Phase-encoding pairs are marked when requested, and variants enforcing phase encoding mark them too.
+        data = KahData(features=['earlytheta', 'phasepair'])
+        assert set(data.stmc['phasepair']) == {0, 1}
+        variants = KahData.build_variants({'all':{}, 'phase':{'enforce_phase':True}}, features=['earlytheta'])
+        assert np.all(variants['phase'].stmc['phasepair'] == 1) and len(variants['phase'].stmc) < len(variants['all'].stmc)
+
+        os.remove(KahData.paths['mc'])
+        KahData.clear()
+
+        # Without phase encoding per pair, it is not needed for a subset of features, and pairs are otherwise non-encoding.
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            data = KahData(features=['earlytheta'])
+        assert data.mc is None and 'phasepair' not in data.stmc
+        with pytest.warns(UserWarning, match='phasepair = 0'):
+            data = KahData()
+        assert len(data.stmc) > 0 and np.all(data.stmc['phasepair'] == 0)
+
+        with pytest.raises(FileNotFoundError):
+            KahData(enforce_phase=True)
+        with pytest.raises(FileNotFoundError):
+            KahData(features=['earlytheta', 'phasepair'])
+    finally:
+        KahData.set_csvpath(csvpath_prev, cachepath_prev)
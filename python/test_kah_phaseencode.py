@@ -0,0 +1,118 @@
+""" Tests for batched phase-encoding statistics against direct ports of the CircStat functions, one sample at a time. """
+
+import numpy as np
+import pytest
+from scipy import stats
+from kah_phaseencode import circ_corrcl, circ_wwtest, circ_cmtest, circ_median, phase_encoding_stats, encoding_episodes
+from kah_tspac import pair_indices
+
+def corrcl_scalar(alpha, x):
+    """ circ_corrcl() for one series. """
+
+    rxs = np.corrcoef(np.sin(alpha), x)[0, 1]
+    rxc = np.corrcoef(np.cos(alpha), x)[0, 1]
+    rcs = np.corrcoef(np.sin(alpha), np.cos(alpha))[0, 1]
+    rho = np.sqrt((rxc ** 2 + rxs ** 2 - 2 * rxc * rxs * rcs) / (1 - rcs ** 2))
+
+    return rho, 1 - stats.chi2.cdf(len(alpha) * rho ** 2, 2)
+
+def wwtest_scalar(alpha1, alpha2):
+    """ circ_wwtest() for two groups. """
+
+    resultant = lambda alpha: np.abs(np.sum(np.exp(1j * alpha)))
+    n = len(alpha1) + len(alpha2)
+    rw = (resultant(alpha1) + resultant(alpha2)) / n
+    if rw < 0.53:
+        kappa = 2 * rw + rw ** 3 + 5 * rw ** 5 / 6
+    elif rw < 0.85:
+        kappa = -0.4 + 1.39 * rw + 0.43 / (1 - rw)
+    else:
+        kappa = 1 / (rw ** 3 - 4 * rw ** 2 + 3 * rw)
+    A = resultant(alpha1) + resultant(alpha2) - resultant(np.concatenate([alpha1, alpha2]))
+    B = n - resultant(alpha1) - resultant(alpha2)
+
+    return (1 + 3 / (8 * kappa)) * (n - 2) * A / B
+
+def median_scalar(alpha):
+    """ circ_median() for one series, comparing trials in a loop. """
+
+    alpha = np.mod(alpha, 2 * np.pi)
+    dist = lambda x, y: np.angle(np.exp(1j * x) / np.exp(1j * y))
+    dm = np.array([abs(sum(dist(a, b) >= 0 for a in alpha) - sum(dist(a, b) <= 0 for a in alpha)) for b in alpha])
+    idx = [np.argmin(dm)] if len(alpha) % 2 else np.flatnonzero(dm == dm.min())[:2]
+    md = np.angle(np.sum(np.exp(1j * alpha[idx])))
+    mean = np.angle(np.sum(np.exp(1j * alpha)))
+    if abs(dist(mean, md)) > abs(dist(mean, md + np.pi)):
+        md = np.mod(md + np.pi, 2 * np.pi)
+
+    return md
+
+def cmtest_scalar(alpha1, alpha2):
+    """ circ_cmtest() for two groups. """
+
+    alpha = np.concatenate([alpha1, alpha2])
+    md = median_scalar(alpha)
+    m = np.array([np.sum(np.angle(np.exp(1j * (group - md))) < 0) for group in [alpha1, alpha2]])
+    N, M = len(alpha), m.sum()
+
+    return N ** 2 / (M * (N - M)) * np.sum(m ** 2 / np.array([len(alpha1), len(alpha2)])) - N * M / (N - M)
+
+@pytest.fixture
+def phases():
+    """ Random phases of 3 series x 4 samples x 25 trials, and outcomes of two labelings. """
+
+    rng = np.random.RandomState(0)
+    return rng.uniform(-np.pi, np.pi, [3, 4, 25]), np.array([rng.rand(25) > 0.5, rng.rand(25) > 0.4])
+
+def test_stats_match_circstat(phases):
+    """ Test that batched statistics of each labeling match the CircStat functions on each series and sample. """
+
+    phase, labels = phases
+    rho, pval = circ_corrcl(phase, labels)
+    F, _ = circ_wwtest(phase, labels)
+
+    for index in np.ndindex(phase.shape[:-1]):
+        assert np.isclose(circ_median(phase[index]), median_scalar(phase[index]))
+        for ilabel, label in enumerate(labels):
+            assert np.allclose([rho[index][ilabel], pval[index][ilabel]], corrcl_scalar(phase[index], label))
+            assert np.isclose(F[index][ilabel], wwtest_scalar(phase[index][label], phase[index][~label]))
+
+            # circ_cmtest() puts trials of the first group first, which breaks ties in the median.
+            order = np.concatenate([np.flatnonzero(label), np.flatnonzero(~label)])
+            P, _ = circ_cmtest(phase[index][order], label[None, order])
+            assert np.isclose(P[0], cmtest_scalar(phase[index][label], phase[index][~label]))
+
+@pytest.mark.parametrize('testtype', ['corrcl', 'wwtest', 'cmtest'])
+def test_chunks_and_pairs(phases, testtype):
+    """ Test that chunking samples and blocking channels and pairs does not change statistics, and that pairs use the
+    phase difference A - B.
+    """
+
+    phase, labels = phases
+    results = phase_encoding_stats(phase, labels[0], testtype=testtype, nperm=20, chunksize=3)
+    unchunked = phase_encoding_stats(phase, labels[0], testtype=testtype, nperm=20, chunksize=10)
+    blocked = phase_encoding_stats(phase, labels[0], testtype=testtype, nperm=20, maxbytes=8 * 2 * 3 * labels.shape[1])
+    for name in results:
+        np.testing.assert_allclose(results[name], unchunked[name])
+        np.testing.assert_allclose(blocked[name], unchunked[name])
+
+    chanA, chanB = pair_indices(phase.shape[0])
+    direct = phase_encoding_stats(phase[chanA] - phase[chanB], labels[0], testtype=testtype)
+    np.testing.assert_allclose(results['statpair'], direct['statchan'])
+    assert np.all((results['permpvalpair'] > 0) & (results['permpvalpair'] <= 1))
+
+def test_encoding_episodes():
+    """ Test that episodes are runs of significant samples, longer than the threshold and within the time window. """
+
+    times = np.arange(10) / 10
+    pvalpair = np.ones([3, 10])
+    pvalpair[0, 2:6] = 0.01 # kept
+    pvalpair[0, 7:9] = 0.01 # too short
+    pvalpair[1, 0:4] = 0.01 # starts at time 0
+    statpair = np.full([3, 10], 0.5)
+    results = {'statchan':np.zeros([3, 10]), 'statpair':statpair, 'pvalpair':pvalpair}
+
+    episodes = encoding_episodes(results, times, sampthresh=1.5, timeoi=(0, 1))
+    assert list(episodes['encodingepisodes']) == [1, 0, 0]
+    assert np.isclose(episodes['encodingonset'][0], 0.2) and np.isclose(episodes['encodinglength'][0], 0.3)
+    assert np.isclose(episodes['encodingstrength'][0], 0.25) and np.isnan(episodes['encodingstrength'][1])
@@ -0,0 +1,123 @@
+""" Tests for reading PSDs a block of channels at a time, and saving FOOOF output. """
+
+import os
+import numpy as np
+import pytest
+import scipy.io as sio
+from kah_psd import PSDFile, V73_HEADER, pad_peaks, peaks_cell, save_fooof, load_fooof, fooof_key, file_sha256, is_cached, FIT_OK, FIT_FAILED, SOURCE
+
+def make_psds(seed=0):
+    """ Make random 'channels x frequencies x trials' PSDs. """
+
+    rng = np.random.RandomState(seed)
+    return np.arange(1, 51, dtype=float), rng.rand(11, 50, 6)
+
+def test_v5_blocks_match_whole_file(tmp_path):
+    """ Test that blocks read from a v5 .mat file match the whole PSD array. """
+
+    freq, psds = make_psds()
+    path = str(tmp_path / 'psd.mat')
+    sio.savemat(path, {'freq':freq, 'psds':psds})
+
+    with PSDFile(path) as psdfile:
+        assert not psdfile.streaming and psdfile.shape == psds.shape
+        np.testing.assert_array_equal(psdfile.freq, freq)
+        np.testing.assert_array_equal(np.concatenate([psdfile.read(chans) for chans in psdfile.blocks(4)]), psds)
+        np.testing.assert_allclose(psdfile.mean_trials(4), psds.mean(axis=2))
+
+def test_v73_blocks_match_whole_file(tmp_path):
+    """ Test that blocks streamed from a v7.3 .mat file match the whole PSD array, if h5py is installed. """
+
+    h5py = pytest.importorskip('h5py')
+    freq, psds = make_psds()
+    path = str(tmp_path / 'psd.mat')
+
+    # Write as MATLAB does: a 512-byte text header, then HDF5 datasets with dimensions reversed.
+    with h5py.File(path, 'w', userblock_size=512) as file:
+        file['freq'] = freq[None, :].T
+        file['psds'] = psds.T
+    with open(path, 'r+b') as file:
+        file.write(V73_HEADER.ljust(116))
+
+    with PSDFile(path) as psdfile:
+        assert psdfile.streaming and psdfile.shape == psds.shape
+        np.testing.assert_array_equal(psdfile.freq, freq)
+        np.testing.assert_array_equal(np.concatenate([psdfile.read(chans) for chans in psdfile.blocks(4)]), psds)
+
+def test_fooof_round_trip(tmp_path):
+    """ Test that padded FOOOF output reads back the same from memory-mapped arrays and from the .mat file. """
+
+    peaks, npeaks = pad_peaks([np.array([[5., 1., 2.], [9., .5, 3.]]), None, np.zeros([0, 3])])
+    assert peaks.shape == (3, 2, 3) and list(npeaks) == [2, 0, 0]
+    assert np.all(np.isnan(peaks[1:]))
+
+    path = str(tmp_path / 'fooof.mat')
+    status = np.array([FIT_OK, FIT_FAILED, FIT_OK], dtype=np.int8)
+    save_fooof(path, {'peaks':peaks, 'npeaks':npeaks, 'status':status}, mat_arrays={'fooof':peaks_cell(peaks, npeaks)})
+
+    mapped = load_fooof(path)
+    assert isinstance(mapped['peaks'], np.memmap)
+    np.testing.assert_array_equal(mapped['peaks'], peaks)
+    np.testing.assert_array_equal(mapped['status'], status)
+
+    mat_contents = sio.loadmat(path)
+    np.testing.assert_array_equal(mat_contents['peaks'], peaks)
+    np.testing.assert_array_equal(np.squeeze(mat_contents['npeaks']), npeaks)
+
+    # Cell of each channel's peaks, as read by MATLAB scripts, with empty cells for channels without peaks.
+    assert 'fooof' not in mapped
+    fooof = mat_contents['fooof'].ravel()
+    assert len(fooof) == 3
+    np.testing.assert_array_equal(fooof[0], peaks[0])
+    assert fooof[1].shape == (0, 3) and fooof[2].shape == (0, 3)
+
+def test_fooof_key_invalidates_on_change(tmp_path):
+    """ Test that output is cached only under the key of its PSD file and settings. """
+
+    freq, psds = make_psds()
+    psdpath = str(tmp_path / 'psd.mat')
+    sio.savemat(psdpath, {'freq':freq, 'psds':psds})
+    settings = {'peak_width_limits':[2.5, 12], 'freq_range':[2, 150]}
+    key = fooof_key(psdpath, settings)
+
+    path = str(tmp_path / 'fooof.mat')
+    assert not is_cached(path, key)
+    save_fooof(path, {'slopes':np.ones([2, 3])}, key)
+    assert is_cached(path, key)
+    assert key == fooof_key(psdpath, dict(reversed(list(settings.items()))))
+    assert not is_cached(path, fooof_key(psdpath, {**settings, 'freq_range':[2, 55]}))
+
+    sio.savemat(psdpath, {'freq':freq, 'psds':psds + 1})
+    assert not is_cached(path, fooof_key(psdpath, settings))
+
+def test_file_hash_reused_while_unchanged(tmp_path):
+    """ Test that a PSD file is only hashed again when its size or modification time changes, and that the hash is
+    recorded with the output rather than next to the PSD file.
+    """
+
+    freq, psds = make_psds()
+    psdpath = str(tmp_path / 'psd' / 'psd.mat')
+    os.makedirs(os.path.dirname(psdpath))
+    sio.savemat(psdpath, {'freq':freq, 'psds':psds})
+    path = str(tmp_path / 'fooof' / 'fooof.mat')
+    settings = {'freq_range':[2, 150]}
+    key = fooof_key(psdpath, settings, path)
+    sha256 = file_sha256(psdpath)
+    assert os.listdir(os.path.dirname(psdpath)) == ['psd.mat']
+    assert os.path.isfile(os.path.join(str(tmp_path / 'fooof' / 'fooof'), SOURCE))
+
+    # Rewrite the file with the same size and modification time. The recorded hash is used without reading it.
+    stat = os.stat(psdpath)
+    sio.savemat(psdpath, {'freq':freq, 'psds':psds + 1})
+    os.utime(psdpath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.path.getsize(psdpath) == stat.st_size
+    assert fooof_key(psdpath, settings, path) == key
+    assert fooof_key(psdpath, settings) != key
+
+    # Touching the file rehashes it. The key only depends on its contents.
+    os.utime(psdpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert file_sha256(psdpath) != sha256
+    assert fooof_key(psdpath, settings, path) != key
+    sio.savemat(psdpath, {'freq':freq, 'psds':psds})
+    assert fooof_key(psdpath, settings, path) == key
+    assert os.listdir(os.path.dirname(psdpath)) == ['psd.mat']
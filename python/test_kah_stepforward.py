@@ -0,0 +1,92 @@
+""" Tests for step-forward and best-subset feature selection, using synthetic data. """
+
+import sqlite3
+import numpy as np
+import pytest
+from kah_bestsubset import best_subset
+from kah_stepforward import stepforward, StepforwardStore
+from test_kah_classifier import make_predictors
+
+def make_subjects():
+    """ Make three subjects whose first predictor is informative. """
+
+    subjects = [make_predictors(ntrial=80, npred=4, seed=seed) for seed in range(3)]
+    for isubj, subject in enumerate(subjects):
+        subject.subject = 'R{:04d}S'.format(isubj)
+
+    return subjects
+
+def test_stepforward_resumes_exactly(tmp_path):
+    """ Test that an interrupted search only refits missing seeds and gives the same result as an uninterrupted one. """
+
+    subjects = make_subjects()
+    predictors = subjects[0].predictors
+    full = stepforward(subjects, predictors, 4, str(tmp_path / 'full.sqlite'), method='logistic_numpy')
+    assert full[0] == predictors[0]
+
+    # Drop some recorded seeds, as if the search had been killed.
+    dbfile = str(tmp_path / 'resumed.sqlite')
+    stepforward(subjects, predictors, 4, dbfile, method='logistic_numpy')
+    with sqlite3.connect(dbfile) as conn:
+        conn.execute('DELETE FROM auc WHERE seed >= 2 AND subject = ?', ('R0001S',))
+    conn.close()
+
+    assert stepforward(subjects, predictors, 4, dbfile, method='logistic_numpy') == full
+    store = StepforwardStore(dbfile)
+    auc_full = StepforwardStore(str(tmp_path / 'full.sqlite')).get_auc(['R0000S', 'R0001S', 'R0002S'], full[:2], range(4))
+    assert (store.get_auc(['R0000S', 'R0001S', 'R0002S'], full[:2], range(4)) == auc_full).all()
+
+def test_stepforward_refuses_other_classifier(tmp_path):
+    """ Test that a database of AUCs is only resumed with the method and hyperparameters it was created with. """
+
+    subjects = make_subjects()
+    predictors = subjects[0].predictors[:2]
+    dbfile = str(tmp_path / 'stepforward.sqlite')
+    stepforward(subjects, predictors, 2, dbfile, hyperparameters={'C':[1., 10.]})
+
+    with pytest.raises(ValueError):
+        stepforward(subjects, predictors, 2, dbfile, method='logistic', hyperparameters={'C':[1., 10.]})
+    with pytest.raises(ValueError):
+        stepforward(subjects, predictors, 2, dbfile)
+
+    # The same classifier resumes, and reading AUCs doesn't need the classifier.
+    assert stepforward(subjects, predictors, 2, dbfile, hyperparameters={'C':[1., 10.]})[0] == predictors[0]
+    assert not np.isnan(StepforwardStore(dbfile).get_auc(['R0000S'], predictors[:1], range(2))).any()
+
+def test_stepforward_parallel_matches_serial(tmp_path):
+    """ Test that fitting models over several processes selects the same features as fitting them serially. """
+
+    subjects = make_subjects()
+    serial = stepforward(subjects, subjects[0].predictors, 3, str(tmp_path / 'serial.sqlite'), method='logistic_numpy')
+    parallel = stepforward(subjects, subjects[0].predictors, 3, str(tmp_path / 'parallel.sqlite'), n_jobs=2, method='logistic_numpy')
+    assert parallel == serial
+
+def test_racing_matches_exhaustive(tmp_path):
+    """ Test that racing selects the same features as fitting every candidate with all seeds, while fitting fewer seeds. """
+
+    subjects = make_subjects()
+    predictors = subjects[0].predictors
+    exhaustive = stepforward(subjects, predictors, 20, str(tmp_path / 'exhaustive.sqlite'), method='logistic_numpy')
+    racing = stepforward(subjects, predictors, 20, str(tmp_path / 'racing.sqlite'), method='logistic_numpy', racing=True, batchsize=5, alpha=0.05)
+    assert racing == exhaustive
+
+def test_best_subset_resumes_and_ranks(tmp_path):
+    """ Test that best-subset search resumes from its store, and that its best single predictor matches step-forward. """
+
+    subjects = make_subjects()
+    predictors = subjects[0].predictors
+    storedir = str(tmp_path / 'bestsubset')
+    store = best_subset(subjects, predictors, 3, storedir, chunksize=4)
+    auc = np.array(store.auc)
+
+    # Forget some subsets, as if the search had been killed, and resume over two processes.
+    store.done[1, 5:] = False
+    store.auc[1, 5:] = np.nan
+    store.done.flush()
+    store.auc.flush()
+    resumed = best_subset(subjects, predictors, 3, storedir, n_jobs=2, chunksize=4)
+    np.testing.assert_array_equal(np.array(resumed.auc), auc)
+
+    top = stepforward(subjects, predictors, 3, str(tmp_path / 'stepforward.sqlite'), method='logistic_numpy')
+    assert resumed.top_subsets(1, k=1)[0][0] == [top[0]]
+    assert len(resumed.top_subsets(2, k=100)) == 6
@@ -0,0 +1,115 @@
+""" Tests for the per-subject store of KahData() objects, using synthetic data. """
+
+import numpy as np
+import pandas as pd
+import pytest
+import kah_store
+from kah_classifier import PREDICTORS_ALL, PredictorMatrix
+from kah_data import KahData, DATASETS
+from kah_get_final_coefs import PREDICTORS_TOP3
+from kah_store import save_subjects, load_subjects, load_predictors, read_index
+from kah_synthetic import make_datasets, write_csvs
+
+pytest.importorskip('pyarrow')
+
+@pytest.fixture(scope='module')
+def synthetic_csvs(tmp_path_factory):
+    """ Point KahData to synthetic CSVs. """
+
+    csvpath = tmp_path_factory.mktemp('csv')
+    write_csvs(make_datasets(nsubj=3, nchan=8, ntrial=30), str(csvpath))
+
+    csvpath_prev, cachepath_prev = KahData.csvpath, KahData.cachepath
+    KahData.set_csvpath(str(csvpath))
+    yield
+    KahData.set_csvpath(csvpath_prev, cachepath_prev)
+
+def test_save_load_roundtrip(synthetic_csvs, tmp_path):
+    """ Test that saved subjects load with the same data, data types, categories, and inputs. """
+
+    subjects = [KahData(subject=subject, include_regions=['ltl', 'lpfc'], theta_threshtype='percent', theta_threshlevel=0.4) for subject in ['R0000S', 'R0002S']]
+    storedir = str(tmp_path / 'store')
+    save_subjects(subjects, storedir)
+
+    index = read_index(storedir)
+    assert list(index['subjects']) == ['R0000S', 'R0002S']
+    assert index['subjects']['R0002S']['params'] == {'subject':'R0002S', 'include_regions':['ltl', 'lpfc'], 'enforce_theta':False,
+                                                      'enforce_phase':False, 'theta_threshtype':'percent', 'theta_threshlevel':0.4,
+                                                      'exclude_theta':False, 'features':None}
+
+    loaded = load_subjects(storedir, subjects=['R0002S'])
+    assert len(loaded) == 1 and loaded[0].subject == 'R0002S' and loaded[0].theta_threshlevel == 0.4
+    assert len(loaded[0].stmc) > 0
+    for dataset in DATASETS:
+        pd.testing.assert_frame_equal(getattr(loaded[0], dataset), getattr(subjects[1], dataset).reset_index(drop=True))
+    assert isinstance(loaded[0].stmc['earlyrawpacdir'].dtype, pd.CategoricalDtype)
+
+    # Only the requested columns are loaded.
+    loaded = load_subjects(storedir, subjects=['R0000S'], columns={'stsc':['trial', 'lobe', 'earlyhfa', 'notacolumn']})[0]
+    assert list(loaded.stsc.columns) == ['lobe', 'trial', 'earlyhfa']
+    pd.testing.assert_frame_equal(loaded.stmc, subjects[0].stmc.reset_index(drop=True))
+
+@pytest.fixture
+def store(synthetic_csvs, tmp_path):
+    """ Save two subjects to a store. """
+
+    storedir = str(tmp_path / 'store')
+    save_subjects([KahData(subject=subject) for subject in ['R0000S', 'R0001S']], storedir)
+
+    return storedir
+
+def test_predictors_cached(store, monkeypatch):
+    """ Test that cached predictors match aggregating them directly, and are loaded without aggregating again. """
+
+    matrices = load_predictors(store)
+    assert [matrix.subject for matrix in matrices] == ['R0000S', 'R0001S']
+    expected = PredictorMatrix.from_kahdata(KahData(subject='R0001S'))
+    np.testing.assert_array_equal(matrices[1].values, expected.values)
+    assert isinstance(matrices[1].values, np.memmap)
+
+    monkeypatch.setattr(PredictorMatrix, 'from_kahdata', classmethod(lambda cls, *args: pytest.fail('Cached predictors were aggregated again.')))
+    np.testing.assert_array_equal(load_predictors(store, subjects=['R0001S'])[0].values, expected.values)
+
+def test_predictors_rebuilt(store, monkeypatch):
+    """ Test that cached predictors are rebuilt after a version bump, or after the subject is saved with other inputs. """
+
+    before = load_predictors(store, subjects=['R0000S'])[0].values.copy()
+
+    nbuilt = []
+    from_kahdata = PredictorMatrix.from_kahdata.__func__
+    monkeypatch.setattr(PredictorMatrix, 'from_kahdata', classmethod(lambda cls, *args: nbuilt.append(1) or from_kahdata(cls, *args)))
+    monkeypatch.setattr(kah_store, 'PREDICTORS_VERSION', kah_store.PREDICTORS_VERSION + 1)
+    np.testing.assert_array_equal(load_predictors(store, subjects=['R0000S'])[0].values, before)
+    assert len(nbuilt) == 1
+    assert read_index(store)['subjects']['R0000S']['predictors']['version'] == kah_store.PREDICTORS_VERSION
+
+    save_subjects([KahData(subject='R0000S', exclude_theta=True)], store)
+    after = load_predictors(store, subjects=['R0000S'])[0].values
+    assert len(nbuilt) == 2
+    np.testing.assert_array_equal(after, PredictorMatrix.from_kahdata(KahData(subject='R0000S', exclude_theta=True)).values)
+    assert not np.array_equal(after, before, equal_nan=True)
+
+def test_extra_predictors(store):
+    """ Test that predictors outside PREDICTORS_ALL, such as those of kah_get_final_coefs, are cached and selected. """
+
+    with pytest.raises(KeyError):
+        load_predictors(store, subjects=['R0000S'])[0].select(PREDICTORS_TOP3)
+
+    matrix = load_predictors(store, subjects=['R0000S'], predictors=PREDICTORS_TOP3)[0]
+    assert matrix.predictors[:len(PREDICTORS_ALL)] == PREDICTORS_ALL
+    expected = PredictorMatrix.from_kahdata(KahData(subject='R0000S'), PREDICTORS_TOP3)
+    np.testing.assert_array_equal(matrix.select(PREDICTORS_TOP3), expected.select(PREDICTORS_TOP3))
+    assert not np.isnan(matrix.select(PREDICTORS_TOP3)).all(axis=0).any()
+
+    # Extra predictors stay cached for later loads.
+    np.testing.assert_array_equal(load_predictors(store, subjects=['R0000S'])[0].select(PREDICTORS_TOP3), expected.select(PREDICTORS_TOP3))
+
+def test_predictor_slices_zero_copy(store):
+    """ Test that single predictors and runs of predictors are views of the memory-mapped cache. """
+
+    matrix = load_predictors(store, subjects=['R0000S'])[0]
+    for predictors in [PREDICTORS_ALL[:1], PREDICTORS_ALL[2:6], PREDICTORS_ALL[1:9:2]]:
+        selected = matrix.select(predictors)
+        assert np.shares_memory(selected, matrix.values)
+        np.testing.assert_array_equal(selected, np.asarray(matrix.values)[:, [PREDICTORS_ALL.index(pred) for pred in predictors]])
+    assert not np.shares_memory(matrix.select([PREDICTORS_ALL[3], PREDICTORS_ALL[0]]), matrix.values)
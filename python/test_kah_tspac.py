@@ -0,0 +1,106 @@
+""" Tests for batched between-channel tsPAC against a direct loop over pairs, directions, trials, and shifts. """
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+from kah_tspac import ozkurt_pac, calculate_tspac, pair_indices, random_shifts, stmc_rows, pac_columns, validate, memmap_timeseries, TIMEWINS, ID_COLUMNS, TSPAC_COLUMNS
+from kah_synthetic import make_datasets
+
+def loop_pac(phase, amp):
+    """ Ozkurt PAC of one phase and amplitude time series, as in calculatepac(..., 'ozkurt'). """
+
+    return np.abs(np.sum(amp * np.exp(1j * phase))) / (np.sqrt(len(phase)) * np.sqrt(np.sum(amp ** 2)))
+
+def make_timeseries(nchan=4, nsamp=30, ntrial=5, seed=0):
+    """ Make random 'channels x times x trials' phase and amplitude. """
+
+    rng = np.random.RandomState(seed)
+    return rng.uniform(-np.pi, np.pi, [nchan, nsamp, ntrial]), rng.rand(nchan, nsamp, ntrial) + 0.1
+
+def test_ozkurt_matches_loop():
+    """ Test that unshifted and shifted PAC match PAC of np.roll()ed amplitude. """
+
+    phase, amp = make_timeseries()
+    shifts = np.array([2, 7, 30])
+    raw, surrogate = ozkurt_pac(phase[0, :, 0], amp[0, :, 0], shifts)
+
+    assert np.isclose(raw, loop_pac(phase[0, :, 0], amp[0, :, 0]))
+    np.testing.assert_allclose(surrogate, [loop_pac(phase[0, :, 0], np.roll(amp[0, :, 0], shift)) for shift in shifts])
+
+def test_tspac_matches_loop():
+    """ Test that batched tsPAC matches a loop, with HFA taken from the opposite channel of each pair. """
+
+    phase, amp = make_timeseries()
+    chanA, chanB = pair_indices(phase.shape[0])
+    shifts = random_shifts(len(chanA), phase.shape[2], phase.shape[1], nsurrogate=10)
+    raw, norm = calculate_tspac(phase, amp, shifts, pairblock=4)
+
+    assert list(zip(chanA, chanB))[:3] == [(0, 1), (0, 2), (0, 3)]
+    for ipair in range(len(chanA)):
+        for itrial in range(phase.shape[2]):
+            for idir, (phasechan, ampchan) in enumerate([(chanA[ipair], chanB[ipair]), (chanB[ipair], chanA[ipair])]):
+                rawloop = loop_pac(phase[phasechan, :, itrial], amp[ampchan, :, itrial])
+                surrogate = [loop_pac(phase[phasechan, :, itrial], np.roll(amp[ampchan, :, itrial], shift)) for shift in shifts[ipair, itrial, idir]]
+                assert np.isclose(raw[ipair, itrial, idir], rawloop)
+                assert np.isclose(norm[ipair, itrial, idir], (rawloop - np.mean(surrogate)) / np.std(surrogate, ddof=1))
+
+def make_rows():
+    """ Make 'stmc' rows of three channels, with channel 0 in the temporal lobe and channels 1 and 2 in the frontal lobe. """
+
+    phase, amp = make_timeseries(nchan=3)
+    chanA, chanB = pair_indices(3)
+    pac = {timewin:calculate_tspac(phase, amp, random_shifts(3, 5, 30, nsurrogate=10)) for timewin in TIMEWINS}
+    tspac = calculate_tspac(phase, amp, random_shifts(3, 5, 30, nsurrogate=10, seed=1))
+    pairinfo = pd.DataFrame({'subject':'S1', 'age':30, 'pair':[1, 2, 3], 'channelA':chanA.astype(str), 'channelB':chanB.astype(str),
+                             'lobeA':np.where(chanA == 0, 'T', 'F'), 'lobeB':'F', 'regionA':'ltl', 'regionB':'lpfc'})
+
+    return stmc_rows(pairinfo, np.array([0, 1, 0, 1, 1]), pac, tspac), pac, tspac
+
+def test_stmc_rows_layout():
+    """ Test that rows follow the 'stmc' column order and validate against themselves. """
+
+    rows, pac, tspac = make_rows()
+
+    assert list(rows.columns) == ID_COLUMNS + pac_columns() + TSPAC_COLUMNS
+    assert len(rows) == 15 and list(rows['trial'][:5]) == [1, 2, 3, 4, 5]
+    assert rows['earlyrawpacBA'].iloc[6] == pac['early'][0][1, 1, 1]
+    assert rows['normtspacBA'].iloc[6] == tspac[1][1, 1, 1]
+
+    summary = validate(rows, rows).set_index('column')
+    assert np.all(summary.loc[pac_columns() + TSPAC_COLUMNS[:-1], 'maxdiff'] == 0)
+    assert summary.loc['direction', 'corr'] == 1
+
+def test_stmc_rows_match_synthetic():
+    """ Test that rows have the same columns as the synthetic 'stmc' data set. """
+
+    rows, _, _ = make_rows()
+    assert list(rows.columns) == list(make_datasets(nsubj=1, nchan=3, ntrial=5)['stmc'].columns)
+
+def test_direction_labels():
+    """ Test that the strongest direction is labeled phase lobe then amplitude lobe, with the larger of AB and BA. """
+
+    rows, _, _ = make_rows()
+    ab = rows['normtspacAB'] > rows['normtspacBA']
+    assert np.all(rows['normtspacmax'] == np.maximum(rows['normtspacAB'], rows['normtspacBA']))
+    assert np.all(rows['direction'][ab] == (rows['lobeA'] + rows['lobeB'])[ab])
+    assert np.all(rows['direction'][~ab] == (rows['lobeB'] + rows['lobeA'])[~ab])
+    assert set(rows['direction']) <= {'TF', 'FT', 'FF'}
+
+def test_memmap_in_cachedir(tmp_path):
+    """ Test that time series are converted into the cache directory only, and reused from there. """
+
+    datadir, cachedir = tmp_path / 'data', tmp_path / 'cache'
+    datadir.mkdir()
+    phase, _ = make_timeseries()
+    matfile = str(datadir / 'S1_FR1_thetaphase_cf_-800_1600.mat')
+    sio.savemat(matfile, {'data':phase, 'times':np.linspace(-0.8, 1.6, phase.shape[1])})
+
+    data, times = memmap_timeseries(matfile, str(cachedir))
+    assert np.array_equal(data, phase) and len(times) == phase.shape[1]
+    assert os.listdir(datadir) == [os.path.basename(matfile)]
+    assert os.listdir(cachedir) == ['S1_FR1_thetaphase_cf_-800_1600_data.npy']
+
+    mtime = os.path.getmtime(cachedir / 'S1_FR1_thetaphase_cf_-800_1600_data.npy')
+    memmap_timeseries(matfile, str(cachedir))
+    assert os.path.getmtime(cachedir / 'S1_FR1_thetaphase_cf_-800_1600_data.npy') == mtime